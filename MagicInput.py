@@ -12,16 +12,31 @@ from PIL import Image, ImageTk, ImageGrab
 import datetime
 import platform
 import threading
-from typing import Optional, Any, Sequence, cast
+from typing import Optional, Any, Iterator, Sequence, cast
 import time
 import re
 import json
+import hashlib
+import mmap
+import random
+import math
+import itertools
 import signal
+import struct
+import subprocess
 import queue
+import asyncio
+import concurrent.futures
+import contextvars
 from tkinterdnd2 import TkinterDnD, DND_FILES
 from google import genai
 from google.genai import types
-import pystray
+try:
+    import pystray
+except Exception:
+    # pystray connects to the display on import; without one (the --capture and --batch
+    # command-line modes on a headless machine) the tray icon is simply unavailable
+    pystray = None
 import ctypes
 from ctypes import wintypes
 from io import BytesIO
@@ -98,10 +113,2965 @@ class Theme:
         return Theme.dark()  # Default to dark for modern look
 
 
+# ------------------------------------------------------------------ STREAMING HELPERS
+class TkTextStream:
+    """Collect streamed text on a worker thread and hand it to Tk in batches.
+
+    ``feed`` may be called from any thread; ``on_flush`` always runs on the Tk
+    thread via ``dispatch`` (normally ``InputPopup.call_tk``) and receives the
+    text accumulated since the previous flush.
+    """
+
+    def __init__(self, dispatch, on_flush, interval_ms: int = 80):
+        self._dispatch = dispatch
+        self._on_flush = on_flush
+        self._interval_ms = max(0, int(interval_ms))
+        self._lock = threading.Lock()
+        self._pending: list[str] = []
+        self._parts: list[str] = []
+        self._scheduled = False
+        self.started_at = time.monotonic()
+        self.first_chunk_at: float | None = None
+
+    @property
+    def text(self) -> str:
+        with self._lock:
+            return "".join(self._parts)
+
+    @property
+    def has_output(self) -> bool:
+        return self.first_chunk_at is not None
+
+    def time_to_first_chunk(self) -> float | None:
+        if self.first_chunk_at is None:
+            return None
+        return self.first_chunk_at - self.started_at
+
+    def feed(self, chunk: str) -> None:
+        if not chunk:
+            return
+        schedule = False
+        with self._lock:
+            if self.first_chunk_at is None:
+                self.first_chunk_at = time.monotonic()
+            self._pending.append(chunk)
+            self._parts.append(chunk)
+            if not self._scheduled:
+                self._scheduled = True
+                schedule = True
+        if schedule:
+            self._dispatch(self._flush, self._interval_ms)
+
+    def close(self) -> None:
+        """Flush whatever is still pending (queued behind earlier flushes)."""
+        self._dispatch(self._flush)
+
+    def _flush(self) -> None:
+        with self._lock:
+            chunk = "".join(self._pending)
+            self._pending.clear()
+            self._scheduled = False
+        if chunk:
+            try:
+                self._on_flush(chunk)
+            except Exception:
+                pass
+
+
+class SpeculativeRun:
+    """Output of a background (speculative) call, held until it is adopted or discarded.
+
+    ``feed`` buffers chunks; once ``adopt`` attaches a sink, the buffered text is
+    replayed into it and later chunks are forwarded live. ``finish`` records the
+    outcome and notifies the adopter, if any. All methods are thread-safe.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.job: Any = None
+        # Hash of the context the run gathered (project, git, archive, terminal...); None until gathered
+        self.context_digest: str | None = None
+        self.started_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._chunks: list[str] = []
+        self._sink = None
+        self._on_finish = None
+        self.done = False
+        self.ok = False
+        self.error: Exception | None = None
+
+    @property
+    def text(self) -> str:
+        with self._lock:
+            return "".join(self._chunks)
+
+    def feed(self, chunk: str) -> None:
+        with self._lock:
+            self._chunks.append(chunk)
+            if self._sink is not None:
+                self._sink(chunk)
+
+    def adopt(self, sink, on_finish) -> bool:
+        """Route output to ``sink`` from now on; returns False if the run already finished."""
+        with self._lock:
+            if self.done:
+                return False
+            if self._chunks:
+                sink("".join(self._chunks))
+            self._sink = sink
+            self._on_finish = on_finish
+            return True
+
+    def finish(self, ok: bool, cancelled: bool = False, error: Exception | None = None) -> None:
+        with self._lock:
+            self.done = True
+            self.ok = ok
+            self.error = error
+            on_finish = self._on_finish
+        if on_finish is not None:
+            on_finish(ok, cancelled, error)
+
+
+# ------------------------------------------------------------------ GEMINI HELPERS
+class GeminiUploadManager:
+    """Upload each image once per session through the Gemini Files API and reuse its URI.
+
+    Uploaded files belong to the project of the API key that created them, so
+    handles are tracked per (api key, content hash). A handle is re-uploaded
+    shortly before its server-side expiry; any upload failure falls back to
+    inline bytes so a request never fails because of this cache.
+    """
+
+    # Files API keeps uploads for 48h; refresh a little early
+    DEFAULT_TTL_S = 48 * 3600
+    EXPIRY_MARGIN_S = 600
+    # Below this size an extra upload round trip costs more than inlining
+    MIN_UPLOAD_BYTES = 32 * 1024
+    # Resource names in rejections of a stale reference: "files/abc", "File abc", "CachedContent ..."
+    _STALE_RESOURCE_RE = re.compile(r"\bfiles/|\bfile\b|\bcachedcontents?\b|\bcached ?content")
+
+    def __init__(self, log=None, min_upload_bytes: int | None = None):
+        self._log = log or (lambda *a, **k: None)
+        self._lock = threading.Lock()
+        self._handles: dict[tuple[str, str], dict[str, Any]] = {}
+        self._inflight: dict[tuple[str, str], threading.Lock] = {}
+        self.min_upload_bytes = self.MIN_UPLOAD_BYTES if min_upload_bytes is None else int(min_upload_bytes)
+        self.enabled = True
+
+    @staticmethod
+    def content_hash(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def _valid(self, handle: dict[str, Any] | None) -> bool:
+        return bool(handle) and handle["expires_at"] - self.EXPIRY_MARGIN_S > time.time()
+
+    def lookup(self, api_key: str, data: bytes) -> dict[str, Any] | None:
+        with self._lock:
+            handle = self._handles.get((api_key, self.content_hash(data)))
+        return handle if self._valid(handle) else None
+
+    def part_for(self, client, api_key: str | None, data: bytes, mime_type: str = "image/png",
+                 display_name: str | None = None):
+        """Return a file-reference Part for ``data``, uploading it first if needed."""
+        if not self.enabled or not api_key or client is None or len(data) < self.min_upload_bytes:
+            return types.Part.from_bytes(data=data, mime_type=mime_type)
+        digest = self.content_hash(data)
+        slot = (api_key, digest)
+        with self._lock:
+            gate = self._inflight.setdefault(slot, threading.Lock())
+        # Concurrent requests for the same image wait for a single upload
+        with gate:
+            with self._lock:
+                handle = self._handles.get(slot)
+            if not self._valid(handle):
+                try:
+                    handle = self._upload(client, data, mime_type, display_name or f"magicinput-{digest[:12]}")
+                except Exception as e:
+                    self._log(f"Files API upload failed; sending image inline: {e}")
+                    return types.Part.from_bytes(data=data, mime_type=mime_type)
+                with self._lock:
+                    self._handles[slot] = handle
+                self._log(f"Uploaded image {digest[:12]} ({len(data)} bytes) as {handle['name']}")
+        return types.Part.from_uri(file_uri=handle["uri"], mime_type=handle["mime_type"])
+
+    def _upload(self, client, data: bytes, mime_type: str, display_name: str) -> dict[str, Any]:
+        if cancel_requested():
+            raise RuntimeError("upload skipped: operation cancelled")
+        f = client.files.upload(
+            file=BytesIO(data),
+            config=types.UploadFileConfig(mime_type=mime_type, display_name=display_name),
+        )
+        # Images are usually ACTIVE immediately; poll briefly otherwise
+        deadline = time.monotonic() + 10
+        while (str(getattr(f, "state", "") or "").upper().endswith("PROCESSING") and time.monotonic() < deadline
+               and not cancel_requested()):
+            time.sleep(0.5)
+            f = client.files.get(name=f.name)
+        if str(getattr(f, "state", "") or "").upper().endswith("FAILED") or not getattr(f, "uri", None):
+            raise RuntimeError(f"file {getattr(f, 'name', '?')} is not usable (state={getattr(f, 'state', None)})")
+        expires = getattr(f, "expiration_time", None)
+        expires_at = expires.timestamp() if expires is not None else time.time() + self.DEFAULT_TTL_S
+        return {
+            "name": f.name,
+            "uri": f.uri,
+            "mime_type": getattr(f, "mime_type", None) or mime_type,
+            "expires_at": expires_at,
+            "size": len(data),
+        }
+
+    @classmethod
+    def is_stale_reference_error(cls, err: Exception) -> bool:
+        """True when the server rejected an uploaded file or cached content we referenced.
+
+        Uploaded files and cached contents are per-key resources that can expire or
+        vanish. Only a 403/404 (or a not-found/permission message) that names one of
+        those resources counts; a missing model or a denied key is a real error.
+        """
+        code = getattr(err, "code", None)
+        msg = str(err).lower()
+        if code not in (403, 404) and not any(s in msg for s in ("not found", "permission", "not exist")):
+            return False
+        return bool(cls._STALE_RESOURCE_RE.search(msg))
+
+    def invalidate(self, api_key: str | None = None) -> None:
+        """Forget handles (for one key, or all) e.g. after the server rejected a file reference."""
+        with self._lock:
+            if api_key is None:
+                self._handles.clear()
+            else:
+                for slot in [s for s in self._handles if s[0] == api_key]:
+                    del self._handles[slot]
+
+
+class GeminiContextCache:
+    """Explicit context caching for the stable part of an analysis prompt.
+
+    The project brief files barely change between calls, so they
+    are stored once as cached content (per api key and model, keyed by a hash
+    of the text) and referenced by name until the text changes or the cache
+    expires. Blocks that are too small to cache are remembered, and a model
+    that does not support caching is skipped for ``UNSUPPORTED_RETRY_S``; any
+    other failure only pauses caching for that model for ``FAILURE_RETRY_S``.
+    Meanwhile the caller simply sends the text inline.
+    """
+
+    DEFAULT_TTL_S = 900
+    EXPIRY_MARGIN_S = 30
+    # Gemini rejects caches below ~1024 tokens; ~4 chars per token locally
+    MIN_TOKENS = 1024
+    UNSUPPORTED_RETRY_S = 3600.0
+    FAILURE_RETRY_S = 120.0
+
+    def __init__(self, log=None, ttl_s: int | None = None):
+        self._log = log or (lambda *a, **k: None)
+        self._lock = threading.Lock()
+        self._entries: dict[tuple[str, str], dict[str, Any]] = {}
+        self._inflight: dict[tuple[str, str], threading.Lock] = {}
+        # model -> time.time() until which cache creation is not attempted
+        self._model_paused_until: dict[str, float] = {}
+        self._too_small: set[str] = set()
+        self.ttl_s = int(ttl_s or self.DEFAULT_TTL_S)
+        self.enabled = True
+
+    @staticmethod
+    def content_hash(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8", errors="ignore")).hexdigest()
+
+    def handle_for(self, client, api_key: str | None, model: str, text: str) -> str | None:
+        """Return a cached-content name holding ``text``, or None to send it inline."""
+        if (not self.enabled or client is None or not api_key or not text
+                or self._model_paused_until.get(model, 0.0) > time.time() or len(text) // 4 < self.MIN_TOKENS):
+            return None
+        digest = self.content_hash(text)
+        if digest in self._too_small:
+            return None
+        slot = (api_key, model)
+        with self._lock:
+            gate = self._inflight.setdefault(slot, threading.Lock())
+        with gate:
+            with self._lock:
+                entry = self._entries.get(slot)
+            if entry and entry["hash"] == digest and entry["expires_at"] - self.EXPIRY_MARGIN_S > time.time():
+                return entry["name"]
+            try:
+                cache = client.caches.create(
+                    model=model,
+                    config=types.CreateCachedContentConfig(
+                        contents=[types.Content(role="user", parts=[types.Part.from_text(text=text)])],
+                        ttl=f"{self.ttl_s}s",
+                        display_name=f"magicinput-{digest[:12]}",
+                    ),
+                )
+            except Exception as e:
+                self._remember_failure(model, digest, e)
+                return None
+            expires = getattr(cache, "expire_time", None)
+            new_entry = {
+                "name": cache.name,
+                "hash": digest,
+                "expires_at": expires.timestamp() if expires is not None else time.time() + self.ttl_s,
+            }
+            with self._lock:
+                self._entries[slot] = new_entry
+            self._log(f"Created context cache {cache.name} for {model} ({len(text)} chars)")
+            # The superseded cache would keep accruing storage until its TTL runs out
+            if entry and entry["name"] != cache.name:
+                self._delete_quietly(client, entry["name"])
+            return cache.name
+
+    def _remember_failure(self, model: str, digest: str, err: Exception) -> None:
+        msg = str(err).lower()
+        if "too small" in msg or "min_total_token_count" in msg:
+            self._too_small.add(digest)
+            self._log(f"Context block too small to cache for {model}; sending it inline")
+            return
+        if getattr(err, "code", None) == 404 or "not support" in msg:
+            pause = self.UNSUPPORTED_RETRY_S
+        else:
+            # Anything else (a one-off invalid argument, a size limit, a server error) may pass next time
+            pause = self.FAILURE_RETRY_S
+        with self._lock:
+            self._model_paused_until[model] = time.time() + pause
+        self._log(f"Context caching unavailable for {model} for {pause:.0f}s; sending context inline: {err}")
+
+    def _delete_quietly(self, client, name: str) -> None:
+        try:
+            client.caches.delete(name=name)
+        except Exception:
+            pass
+
+    def invalidate(self, api_key: str | None = None) -> None:
+        with self._lock:
+            if api_key is None:
+                self._entries.clear()
+            else:
+                for slot in [s for s in self._entries if s[0] == api_key]:
+                    del self._entries[slot]
+
+
+class GeminiKeyScheduler:
+    """Per-key RPM/TPM token buckets that decide which API key the next call uses.
+
+    Each key has a request bucket (``rpm`` per minute) and a token bucket (``tpm``
+    per minute). Calls go to the key with the most headroom; a rate-limited key is
+    put in cooldown for the server's retry-after hint. Limits reported by the server
+    (quota violations in the 429 body) replace the defaults (``default_rpm`` /
+    ``default_tpm``, set in Settings), and the learned limits and cooldowns are
+    exported to config.json so they survive restarts. A learned limit is not
+    permanent: after ``GROWBACK_SUCCESSES`` calls in a row without a 429 it grows
+    back toward the default.
+    """
+
+    DEFAULT_RPM = 10
+    DEFAULT_TPM = 250_000
+    GROWBACK_SUCCESSES = 20
+    GROWBACK_FACTOR = 1.25
+    DEFAULT_COOLDOWN_S = 30.0
+    MAX_COOLDOWN_S = 300.0
+    DAILY_COOLDOWN_S = 3600.0
+    # Format of export_state, saved as ``key_quota_version`` next to ``key_quota``
+    STATE_VERSION = 2
+
+    def __init__(self, log=None, default_rpm: int | None = None, default_tpm: int | None = None):
+        self._log = log or (lambda *a, **k: None)
+        self._lock = threading.Lock()
+        self.default_rpm = max(1, int(default_rpm or self.DEFAULT_RPM))
+        self.default_tpm = max(1, int(default_tpm or self.DEFAULT_TPM))
+        # fingerprint -> {"rpm", "tpm", "req", "tok", "stamp", "cooldown_until", "strikes", "streak"}
+        self._state: dict[str, dict[str, Any]] = {}
+
+    def set_defaults(self, rpm: int, tpm: int) -> None:
+        """Change the per-key limits used until the server reports lower ones."""
+        with self._lock:
+            old_rpm, old_tpm = self.default_rpm, self.default_tpm
+            self.default_rpm, self.default_tpm = max(1, int(rpm)), max(1, int(tpm))
+            for st in self._state.values():
+                # Keys still on the old default follow the new one; learned limits stay (capped)
+                st["rpm"] = self.default_rpm if st["rpm"] >= old_rpm else min(st["rpm"], self.default_rpm)
+                st["tpm"] = self.default_tpm if st["tpm"] >= old_tpm else min(st["tpm"], self.default_tpm)
+
+    @staticmethod
+    def fingerprint(api_key: str) -> str:
+        """Stable id for persisting per-key state without writing the key twice."""
+        return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+    # ---------- error classification ----------
+    @staticmethod
+    def rate_limit_info(err: Exception) -> dict[str, Any] | None:
+        """Return retry/quota hints if ``err`` is a rate-limit error, else None.
+
+        Uses the structured APIError fields (HTTP code, status, RetryInfo and
+        QuotaFailure details) rather than matching words in the message.
+        """
+        code = getattr(err, "code", None)
+        status = str(getattr(err, "status", "") or "")
+        if code != 429 and status != "RESOURCE_EXHAUSTED":
+            # Errors without structured fields (e.g. from a proxy) still carry the HTTP code
+            if code is not None or not str(err).startswith(("429", "RESOURCE_EXHAUSTED")):
+                return None
+        info: dict[str, Any] = {"retry_after": None, "rpm": None, "tpm": None, "daily": False}
+        body = getattr(err, "details", None)
+        if isinstance(body, dict) and isinstance(body.get("error"), dict):
+            body = body["error"]
+        details = body.get("details", []) if isinstance(body, dict) else []
+        for item in details if isinstance(details, list) else []:
+            if not isinstance(item, dict):
+                continue
+            kind = str(item.get("@type", ""))
+            if kind.endswith("RetryInfo"):
+                delay = str(item.get("retryDelay", "")).rstrip("s")
+                try:
+                    info["retry_after"] = float(delay)
+                except ValueError:
+                    pass
+            elif kind.endswith("QuotaFailure"):
+                for v in item.get("violations", []) or []:
+                    quota_id = str(v.get("quotaId", ""))
+                    try:
+                        value = int(v.get("quotaValue"))
+                    except (TypeError, ValueError):
+                        value = None
+                    if "PerDay" in quota_id:
+                        info["daily"] = True
+                    elif "PerMinute" in quota_id and value:
+                        if "Token" in quota_id:
+                            info["tpm"] = value
+                        else:
+                            info["rpm"] = value
+        if info["retry_after"] is None:
+            try:
+                header = getattr(err, "response", None).headers.get("retry-after")  # type: ignore[union-attr]
+                if header:
+                    info["retry_after"] = float(header)
+            except Exception:
+                pass
+        return info
+
+    # ---------- buckets ----------
+    def _slot(self, api_key: str) -> dict[str, Any]:
+        fp = self.fingerprint(api_key)
+        st = self._state.get(fp)
+        if st is None:
+            st = {"rpm": self.default_rpm, "tpm": self.default_tpm, "cooldown_until": 0.0, "strikes": 0}
+            self._state[fp] = st
+        if "stamp" not in st:
+            # Buckets start full; only limits and cooldowns are persisted
+            st["req"] = float(st["rpm"])
+            st["tok"] = float(st["tpm"])
+            st["stamp"] = time.monotonic()
+        return st
+
+    def _refill(self, st: dict[str, Any]) -> None:
+        now = time.monotonic()
+        elapsed = max(0.0, now - st["stamp"])
+        st["stamp"] = now
+        st["req"] = min(float(st["rpm"]), st["req"] + elapsed * st["rpm"] / 60.0)
+        st["tok"] = min(float(st["tpm"]), st["tok"] + elapsed * st["tpm"] / 60.0)
+
+    def _wait_for(self, st: dict[str, Any], tokens: int) -> float:
+        """Seconds until ``st`` can take one request of ``tokens`` (0 when it can now)."""
+        wait = max(0.0, st["cooldown_until"] - time.time())
+        if st["req"] < 1.0:
+            wait = max(wait, (1.0 - st["req"]) * 60.0 / st["rpm"])
+        # A request larger than the whole bucket only needs a full bucket
+        need = min(float(tokens), float(st["tpm"]))
+        if st["tok"] < need:
+            wait = max(wait, (need - st["tok"]) * 60.0 / st["tpm"])
+        return wait
+
+    def acquire(self, keys: list[str], tokens: int = 0, exclude: Sequence[str] = ()) -> tuple[str | None, float]:
+        """Reserve capacity on the key with the most headroom.
+
+        ``keys`` is in preference order (ties keep that order); keys in
+        ``exclude`` are skipped. Returns
+        ``(key, 0.0)`` on success, or ``(None, wait_s)`` when every key is
+        exhausted, with the time until the first one frees up.
+        """
+        with self._lock:
+            best: str | None = None
+            best_room = -1.0
+            soonest: float | None = None
+            for key in keys:
+                if key in exclude:
+                    continue
+                st = self._slot(key)
+                self._refill(st)
+                wait = self._wait_for(st, tokens)
+                if wait > 0:
+                    soonest = wait if soonest is None else min(soonest, wait)
+                    continue
+                room = min(st["req"] / st["rpm"], st["tok"] / st["tpm"])
+                if room > best_room:
+                    best, best_room = key, room
+            if best is None:
+                return None, (soonest if soonest is not None else 0.0)
+            st = self._slot(best)
+            st["req"] -= 1.0
+            st["tok"] -= min(float(tokens), float(st["tpm"]))
+            return best, 0.0
+
+    def record_success(self, api_key: str, estimated: int = 0, actual: int | None = None) -> None:
+        """Settle a finished call: charge the real token count if known, clear strikes and
+        let a lowered limit grow back after enough successes in a row."""
+        with self._lock:
+            st = self._slot(api_key)
+            st["strikes"] = 0
+            if actual is not None:
+                st["tok"] -= max(0, actual - min(estimated, st["tpm"]))
+            st["streak"] = int(st.get("streak", 0)) + 1
+            if st["streak"] >= self.GROWBACK_SUCCESSES and (st["rpm"] < self.default_rpm or st["tpm"] < self.default_tpm):
+                st["streak"] = 0
+                st["rpm"] = min(self.default_rpm, max(st["rpm"] + 1, int(st["rpm"] * self.GROWBACK_FACTOR)))
+                st["tpm"] = min(self.default_tpm, max(st["tpm"] + 1, int(st["tpm"] * self.GROWBACK_FACTOR)))
+                self._log(f"Key {self.fingerprint(api_key)[:6]} limits grown back to rpm={st['rpm']}, tpm={st['tpm']}")
+
+    def record_rate_limit(self, api_key: str, info: dict[str, Any] | None = None) -> float:
+        """Put ``api_key`` in cooldown after a 429 and learn any reported limits. Returns the cooldown."""
+        info = info or {}
+        with self._lock:
+            st = self._slot(api_key)
+            if info.get("rpm"):
+                st["rpm"] = int(info["rpm"])
+            if info.get("tpm"):
+                st["tpm"] = int(info["tpm"])
+            st["strikes"] = int(st.get("strikes", 0)) + 1
+            st["streak"] = 0
+            if info.get("retry_after"):
+                cooldown = float(info["retry_after"])
+            elif info.get("daily"):
+                cooldown = self.DAILY_COOLDOWN_S
+            else:
+                # No hint: back off harder on repeated limits
+                cooldown = min(self.MAX_COOLDOWN_S, self.DEFAULT_COOLDOWN_S * (2 ** (st["strikes"] - 1)))
+            st["cooldown_until"] = max(st["cooldown_until"], time.time() + cooldown)
+            # The server disagreed with our bucket: drain it so we don't immediately retry
+            st["req"] = min(st.get("req", 0.0), 0.0)
+            self._log(f"Key {self.fingerprint(api_key)[:6]} rate limited; cooling down {cooldown:.0f}s (rpm={st['rpm']}, tpm={st['tpm']})")
+            return cooldown
+
+    def describe(self, api_key: str) -> str:
+        """Short status for the Settings key list (empty when the key is fully available)."""
+        with self._lock:
+            st = self._slot(api_key)
+            self._refill(st)
+            left = st["cooldown_until"] - time.time()
+            if left > 0:
+                return f"cooling down {left:.0f}s"
+            return f"{int(st['req'])}/{st['rpm']} req/min left"
+
+    # ---------- persistence ----------
+    def export_state(self) -> dict[str, Any]:
+        """Learned limits (only those below the defaults) and active cooldowns, by key fingerprint."""
+        with self._lock:
+            now = time.time()
+            out: dict[str, Any] = {}
+            for fp, st in self._state.items():
+                item: dict[str, Any] = {}
+                if st["rpm"] < self.default_rpm:
+                    item["rpm"] = int(st["rpm"])
+                if st["tpm"] < self.default_tpm:
+                    item["tpm"] = int(st["tpm"])
+                if st["cooldown_until"] > now:
+                    item["cooldown_until"] = round(st["cooldown_until"], 1)
+                if item:
+                    out[fp] = item
+            return out
+
+    def import_state(self, data: Any, version: int = STATE_VERSION) -> None:
+        """Load what ``export_state`` saved. Before version 2 every key was stored with its
+        current limits, so the built-in defaults there mean nothing was learned."""
+        if not isinstance(data, dict):
+            return
+        with self._lock:
+            for fp, item in data.items():
+                if not isinstance(item, dict):
+                    continue
+                try:
+                    rpm = max(1, int(item.get("rpm", self.default_rpm)))
+                    tpm = max(1, int(item.get("tpm", self.default_tpm)))
+                    if version < 2 and (rpm, tpm) == (self.DEFAULT_RPM, self.DEFAULT_TPM):
+                        rpm, tpm = self.default_rpm, self.default_tpm
+                    self._state[str(fp)] = {
+                        "rpm": min(rpm, self.default_rpm),
+                        "tpm": min(tpm, self.default_tpm),
+                        "cooldown_until": float(item.get("cooldown_until", 0) or 0),
+                        "strikes": 0,
+                    }
+                except (TypeError, ValueError):
+                    continue
+
+
+class GeminiRetryPolicy:
+    """Exponential backoff with full jitter for transient Gemini failures.
+
+    Only errors that cannot have produced output are retried (5xx, 408, timeouts
+    and dropped connections before a response); generate calls have no side
+    effects, so repeating them is safe. Streams are never retried once text has
+    been delivered. Rate limits are handled by the key scheduler, not here.
+    """
+
+    RETRYABLE_CODES = (408, 500, 502, 503, 504)
+    RETRYABLE_STATUSES = ("UNAVAILABLE", "INTERNAL", "DEADLINE_EXCEEDED")
+    # Transport errors from httpx (used by google-genai), matched by name to avoid importing it
+    RETRYABLE_ERROR_NAMES = ("TimeoutException", "NetworkError", "RemoteProtocolError")
+
+    def __init__(self, max_retries: int = 2, base_delay_s: float = 1.0, max_delay_s: float = 16.0):
+        self.max_retries = max(0, int(max_retries))
+        self.base_delay_s = max(0.0, float(base_delay_s))
+        self.max_delay_s = max(self.base_delay_s, float(max_delay_s))
+
+    def is_retryable(self, err: Exception) -> bool:
+        if isinstance(err, (TimeoutError, ConnectionError)):
+            return True
+        code = getattr(err, "code", None)
+        if code in self.RETRYABLE_CODES or str(getattr(err, "status", "") or "") in self.RETRYABLE_STATUSES:
+            return True
+        return any(cls.__name__ in self.RETRYABLE_ERROR_NAMES for cls in type(err).__mro__)
+
+    def backoff(self, retry: int) -> float:
+        """Delay before retry number ``retry`` (0-based): uniform in [0, min(max, base * 2**retry)]."""
+        return random.uniform(0.0, min(self.max_delay_s, self.base_delay_s * (2 ** retry)))
+
+
+# ------------------------------------------------------------------ PROMPT TEMPLATES
+def analysis_headings(mode: str) -> list[str]:
+    """Section headings a Visionize answer must use for ``mode`` (plan | describe | combine)."""
+    if mode == "plan":
+        return ["Overview:", "Plan:"]
+    if mode == "describe":
+        return ["Overview:", "Describe Image:"]
+    return ["Overview:", "Describe Image:", "Plan:"]
+
+
+def build_analysis_prompt(mode: str, user_prompt: str, context_block: str, cached: bool = False,
+                          sections: Sequence[str] | None = None) -> str:
+    """The Visionize instruction text; ``cached`` notes that stable context was sent as cached content.
+
+    ``sections`` restricts the answer to a subset of headings (parallel Combine sub-requests).
+    """
+    # Choose prompt template based on mode (plan | describe | combine)
+    sel_mode = (mode or "").lower()
+    if sel_mode not in ("plan", "describe", "combine"):
+        sel_mode = "plan"
+    headings = list(sections) if sections else analysis_headings(sel_mode)
+
+    # Guidance per section (used in instructions; do not echo verbatim)
+    overview_req = (
+        "Write 2–4 sentences summarizing what the image(s) show and the intended purpose inferred from USER REQUEST. "
+        "Keep it factual and task‑oriented; avoid fluff or speculation beyond the given CONTEXT."
+    )
+    describe_req = (
+        "Provide a highly detailed, context‑aware description tailored to the USER REQUEST. If the task is UI/UX, cover layout, hierarchy, states, components, labels, icons, colors, typography, spacing, and affordances. "
+        "If the task is debugging/implementation/backend, focus on visible workflows, data/values, architectural hints, logs/console outputs, and any code/UI cues relevant to functionality. "
+        "Start with the user’s target area, then cover other relevant areas. Explicitly note uncertainties."
+    )
+    plan_req = (
+        "Provide a concise, actionable plan connected to the description (5–10 bullets). Each bullet should state what to do, why it matters, and the expected impact. "
+        "Scope the actions to this project/app and align them with the USER REQUEST (may include UI changes, debugging steps, code changes, tests, or backend tasks)."
+    )
+
+    headings_block = "\n\n".join(headings)
+    cached_note = (
+        "The project brief (README, plan and docs files, as a PROJECT BRIEF section) was supplied earlier as cached context. "
+        "The INCLUDED CONTEXT below holds the parts picked for this request: ranked project excerpts, past prompts, "
+        "git changes, terminal output and attached files, as present.\n"
+        if cached else ""
+    )
+    return f"""
+You are a senior software engineer and product‑minded builder analyzing the provided image(s) for the USER REQUEST using the given CONTEXT. Do not hallucinate.
+
+Analyze ALL available inputs:
+1) The image(s) provided.
+2) The INCLUDED CONTEXT below which may contain: a project brief with listed files and snippets, the prompts archive, and terminal logs or outputs.
+Always incorporate relevant evidence from these sources; do not ignore them.
+{cached_note}
+=== USER REQUEST ===
+{user_prompt}
+
+{context_block}
+
+Write the answer in Markdown with EXACTLY the following section headings (and nothing else), in this order:
+
+{headings_block}
+
+Content requirements (adapt based on the nature of the USER REQUEST—UI/UX, debugging, backend functionality, feature implementation, or anything else what asking the user):
+- Overview: {overview_req if 'Overview:' in headings else 'Skip this section entirely.'}
+- Describe Image: {describe_req if 'Describe Image:' in headings else 'Skip this section entirely.'}
+- Plan: {plan_req if 'Plan:' in headings else 'Skip this section entirely.'}
+
+Constraints:
+- Base everything strictly on the provided image(s) and CONTEXT. If something is unknown, state it briefly in the relevant section.
+- If multiple images are provided, use “Image N:” prefixes where helpful and keep the final output within the same sections above.
+"""
+
+
+# ------------------------------------------------------------------ CONTEXT BUDGET
+class ContextBudgeter:
+    """Estimate tokens per context section and pack them into a token budget by priority.
+
+    Sections, most important first: the prompt (instructions + user request) and
+    images are always sent whole; attached files, git changes, terminal output,
+    project brief and prompts archive share what is left. Every non-empty flexible section is first
+    guaranteed a small floor, then the remainder is handed out in priority order.
+    Estimates are local (~4 UTF-8 bytes per token) and can be calibrated against
+    the API's ``count_tokens``.
+    """
+
+    SECTIONS = ("prompt", "images", "files", "git", "terminal", "brief", "archive")
+    FLEXIBLE = ("files", "git", "terminal", "brief", "archive")
+    FLOOR_SHARE = 0.05
+    # Input limits of the model families offered in Settings; the configured budget usually binds first
+    MODEL_WINDOWS = {"gemini-1.5-pro": 2_097_152}
+    DEFAULT_WINDOW = 1_048_576
+    IMAGE_TILE_TOKENS = 258
+
+    def __init__(self, budget_tokens: int = 32_000):
+        self.budget_tokens = budget_tokens
+        # Ratio of counted to estimated tokens, learned from count_tokens
+        self.calibration = 1.0
+
+    def budget_for(self, model: str, budget_tokens: int | None = None) -> int:
+        window = next((w for prefix, w in self.MODEL_WINDOWS.items() if model.startswith(prefix)), self.DEFAULT_WINDOW)
+        return max(1000, min(int(budget_tokens or self.budget_tokens), window))
+
+    def estimate(self, text: str) -> int:
+        if not text:
+            return 0
+        return int((len(text.encode("utf-8")) + 3) // 4 * self.calibration) + 1
+
+    @classmethod
+    def image_tokens(cls, data: bytes) -> int:
+        """Gemini bills small images as one 258-token tile and larger ones per 768x768 tile."""
+        try:
+            with Image.open(BytesIO(data)) as img:
+                w, h = img.size
+        except Exception:
+            return cls.IMAGE_TILE_TOKENS
+        if w <= 384 and h <= 384:
+            return cls.IMAGE_TILE_TOKENS
+        return -(-w // 768) * -(-h // 768) * cls.IMAGE_TILE_TOKENS
+
+    def calibrate(self, estimated: int, counted: int) -> None:
+        """Blend in the ratio between a local estimate and the API's count for the same text."""
+        if estimated > 0 and counted > 0:
+            ratio = counted / (estimated / self.calibration)
+            self.calibration = round(0.5 * self.calibration + 0.5 * min(4.0, max(0.25, ratio)), 3)
+
+    def allocate(self, requested: dict[str, int], budget: int) -> dict[str, int]:
+        """Grant tokens per section: fixed sections in full, then floors, then priority order."""
+        granted = {name: 0 for name in self.SECTIONS}
+        remaining = budget
+        for name in ("prompt", "images"):
+            granted[name] = requested.get(name, 0)
+            remaining -= granted[name]
+        remaining = max(0, remaining)
+        floor = int(budget * self.FLOOR_SHARE)
+        for name in self.FLEXIBLE:
+            give = min(requested.get(name, 0), floor, remaining)
+            granted[name] = give
+            remaining -= give
+        for name in self.FLEXIBLE:
+            give = min(requested.get(name, 0) - granted[name], remaining)
+            granted[name] += give
+            remaining -= give
+        return granted
+
+    # ---------- trimming ----------
+    def trim_head(self, text: str, tokens: int) -> str:
+        """Keep whole lines from the start (newest-first archives, briefs)."""
+        if self.estimate(text) <= tokens:
+            return text
+        kept: list[str] = []
+        used = self.estimate("\n[... truncated to fit the context budget]")
+        for line in text.splitlines(keepends=True):
+            cost = self.estimate(line)
+            if used + cost > tokens:
+                break
+            kept.append(line)
+            used += cost
+        return "".join(kept).rstrip("\n") + "\n[... truncated to fit the context budget]"
+
+    def trim_tail(self, text: str, tokens: int) -> str:
+        """Keep whole lines from the end (terminal output: the latest lines matter most)."""
+        if self.estimate(text) <= tokens:
+            return text
+        kept: list[str] = []
+        used = self.estimate("[... earlier output truncated]\n")
+        for line in reversed(text.splitlines(keepends=True)):
+            cost = self.estimate(line)
+            if used + cost > tokens:
+                break
+            kept.append(line)
+            used += cost
+        return "[... earlier output truncated]\n" + "".join(reversed(kept))
+
+    def trim_around(self, lines: list[str], start: int, end: int, tokens: int) -> tuple[int, int]:
+        """Grow the 1-based line range [start, end] outward while it fits in ``tokens``.
+
+        The requested range itself is always kept, clamped to the lines that exist
+        (the file may have shrunk since the range was recorded). Returns the final
+        (first, last); ``(1, 0)`` when there are no lines.
+        """
+        if not lines:
+            return 1, 0
+        first = min(max(1, start), len(lines))
+        last = min(len(lines), max(first, end))
+        used = sum(self.estimate(l) for l in lines[first - 1:last])
+        grew = True
+        while grew:
+            grew = False
+            if first > 1 and used + self.estimate(lines[first - 2]) <= tokens:
+                first -= 1
+                used += self.estimate(lines[first - 1])
+                grew = True
+            if last < len(lines) and used + self.estimate(lines[last]) <= tokens:
+                last += 1
+                used += self.estimate(lines[last - 1])
+                grew = True
+        return first, last
+
+    def pack_files(self, files: list["FileExcerpt"], tokens: int) -> list[str]:
+        """Format attached file excerpts into blocks that fit ``tokens`` together.
+
+        Each excerpt may carry the (start, end, total) line range the user pointed at.
+        Those lines are always kept; the rest of the budget is shared evenly, with small
+        files taking only what they need. Excerpts of large files keep up to a quarter of
+        their share for the outline of the parts that were not read.
+        """
+        if not files:
+            return []
+        sizes = [max(1, self.file_tokens(f)) for f in files]
+        shares = [0] * len(files)
+        remaining = tokens
+        order = sorted(range(len(files)), key=lambda i: sizes[i])
+        for n, i in enumerate(order):
+            shares[i] = min(sizes[i], remaining // (len(files) - n))
+            remaining -= shares[i]
+        blocks: list[str] = []
+        for f, share in zip(files, shares):
+            outline = ""
+            if f.outline:
+                outline = self.trim_head("\n".join(f.outline), share // 4)
+                share -= self.estimate(outline)
+                outline = f"\nOutline of the rest of the file:\n{outline}"
+            lines = f.text.splitlines(keepends=True) or [""]
+            offset = (f.first_line or 1) - 1
+            if f.meta:
+                s_line, e_line, n_lines = f.meta
+                if not f.text:
+                    blocks.append(f"File: {f.name} (lines {s_line}-{e_line}/{n_lines}; file changed, "
+                                  f"those lines no longer exist)\n---\n---{outline}")
+                    continue
+                first, last = self.trim_around(lines, s_line - offset, e_line - offset, share)
+                first, last = first + offset, last + offset
+                shown = "" if (first, last) == (1, n_lines) else f"; showing {first}-{last}"
+                if s_line - offset > len(lines):
+                    shown += "; file changed, the requested lines are past its end"
+                body = "".join(lines[first - offset - 1:last - offset])
+                blocks.append(f"File: {f.name} (lines {s_line}-{e_line}/{n_lines}{shown})\n---\n{body}\n---{outline}")
+            else:
+                head = f" ({f.note})" if f.note else ""
+                trim = self.trim_tail if f.first_line is None else self.trim_head
+                blocks.append(f"File: {f.name}{head}\n---\n{trim(f.text, share)}\n---{outline}")
+        return blocks
+
+    def file_tokens(self, excerpt: "FileExcerpt") -> int:
+        return self.estimate(excerpt.text) + sum(self.estimate(l) + 1 for l in excerpt.outline)
+
+    def pack_ranked(self, blocks: list[str], tokens: int) -> list[str]:
+        """Whole blocks in rank order while they fit; the first one is trimmed rather than dropped."""
+        out: list[str] = []
+        remaining = tokens
+        for block in blocks:
+            cost = self.estimate(block)
+            if cost <= remaining:
+                out.append(block)
+                remaining -= cost
+            elif not out:
+                out.append(self.trim_head(block, remaining))
+                break
+        return out
+
+    @staticmethod
+    def summary(requested: dict[str, int], granted: dict[str, int], budget: int) -> str:
+        """One-line allocation, e.g. ``ctx 14.2k/32k tok · files 3.1k/5.0k · brief 8.0k``."""
+        def k(n: int) -> str:
+            return f"{n / 1000:.1f}k" if n >= 1000 else str(n)
+        parts = []
+        for name in ContextBudgeter.SECTIONS:
+            req, got = requested.get(name, 0), granted.get(name, 0)
+            if not req:
+                continue
+            parts.append(f"{name} {k(got)}" + (f"/{k(req)}" if got < req else ""))
+        return f"ctx {k(sum(granted.values()))}/{k(budget)} tok · " + " · ".join(parts)
+
+
+# ------------------------------------------------------------------ CONTEXT DEDUP
+class ContextDeduper:
+    """Drops spans of context that an earlier part of the same request already contains.
+
+    Text is indexed as hashed windows of ``WINDOW`` consecutive non-blank lines
+    (whitespace-normalized). ``dedupe`` replaces every run of lines covered by windows
+    seen before with a one-line back-reference to where they first appeared, then
+    indexes the block under its own label. ``seed`` only indexes (for parts that are
+    sent as they are, like the user's prompt). Windows shorter than
+    ``MIN_WINDOW_CHARS`` are ignored, so braces and separators never match.
+    """
+
+    WINDOW = 4
+    MIN_WINDOW_CHARS = 60
+
+    def __init__(self):
+        self._seen: dict[int, str] = {}
+        self.saved_chars = 0
+
+    def _windows(self, lines: list[str]) -> list[tuple[int, int, int]]:
+        """(first line, end line, hash) of each window."""
+        idx = [i for i, l in enumerate(lines) if l.strip()]
+        norm = [" ".join(lines[i].split()) for i in idx]
+        out: list[tuple[int, int, int]] = []
+        for k in range(len(idx) - self.WINDOW + 1):
+            seg = norm[k:k + self.WINDOW]
+            if sum(len(s) for s in seg) >= self.MIN_WINDOW_CHARS:
+                out.append((idx[k], idx[k + self.WINDOW - 1] + 1, hash("\n".join(seg))))
+        return out
+
+    def seed(self, label: str, text: str) -> None:
+        for _, _, h in self._windows(text.split("\n")):
+            self._seen.setdefault(h, label)
+
+    def dedupe(self, label: str, text: str) -> str:
+        lines = text.split("\n")
+        windows = self._windows(lines)
+        source: list[str | None] = [None] * len(lines)
+        for start, end, h in windows:
+            src = self._seen.get(h)
+            if src is not None:
+                for i in range(start, end):
+                    source[i] = source[i] or src
+        for _, _, h in windows:
+            self._seen.setdefault(h, label)
+        if not any(source):
+            return text
+        out: list[str] = []
+        i, n = 0, len(lines)
+        while i < n:
+            if source[i] is None:
+                out.append(lines[i])
+                i += 1
+                continue
+            j = i
+            while j < n and (source[j] is not None or (not lines[j].strip() and j + 1 < n and source[j + 1] is not None)):
+                j += 1
+            marker = f"[... {j - i} lines omitted: already included above in {source[i]}]"
+            dropped = sum(len(l) + 1 for l in lines[i:j])
+            if dropped > len(marker):
+                out.append(marker)
+                self.saved_chars += dropped - len(marker)
+            else:
+                out.extend(lines[i:j])
+            i = j
+        return "\n".join(out)
+
+
+# ------------------------------------------------------------------ FILE CONTEXT
+class FileExcerpt:
+    """The part of an attached file that is offered to the model.
+
+    ``text`` starts at line ``first_line`` of the file (None when unknown, e.g. a tail
+    of a huge log). ``meta`` is the (start, end, total) range the user pointed at.
+    ``outline`` lists symbol lines from the rest of the file, and ``note`` says what was
+    left out.
+    """
+
+    def __init__(self, name: str, text: str, meta: tuple[int, int, int] | None = None,
+                 first_line: int | None = 1, outline: list[str] | None = None, note: str = ""):
+        self.name = name
+        self.text = text
+        self.meta = meta
+        self.first_line = first_line
+        self.outline = outline or []
+        self.note = note
+
+    @property
+    def partial(self) -> bool:
+        return bool(self.note)
+
+
+class FileContextExtractor:
+    """Bounded reads of attached files.
+
+    Files up to ``WHOLE_FILE_BYTES`` are read whole. Larger ones are memory-mapped:
+    with a recorded line range the extractor jumps to it and reads it plus ``margin``
+    lines on each side; without one it reads the head (or the tail, for logs). At most
+    ``WINDOW_BYTES`` are decoded either way, and a symbol outline of the rest of the
+    file (from its first ``OUTLINE_SCAN_BYTES``) stands in for what was skipped.
+    """
+
+    WHOLE_FILE_BYTES = 512_000
+    WINDOW_BYTES = 256_000
+    OUTLINE_SCAN_BYTES = 8_000_000
+    OUTLINE_MAX = 200
+    LOG_SUFFIXES = (".log", ".out", ".err")
+    SYMBOL_RE = re.compile(
+        rb"^[ \t]*(?:export[ \t]+)?(?:default[ \t]+)?(?:pub(?:\([a-z]+\))?[ \t]+)?(?:async[ \t]+)?"
+        rb"(?:def|class|function|interface|struct|enum|impl|trait|fn|func|module|namespace)[ \t]+[A-Za-z_$][^\n]*"
+        rb"|^#{1,6}[ \t][^\n]*",
+        re.M,
+    )
+    _BLOCK = 1 << 20
+
+    def __init__(self, margin_lines: int = 60):
+        self.margin_lines = margin_lines
+
+    def extract(self, path: str, meta: tuple[int, int, int] | None = None) -> FileExcerpt:
+        name = os.path.basename(path)
+        size = os.path.getsize(path)
+        if size <= self.WHOLE_FILE_BYTES:
+            with open(path, "r", encoding="utf-8", errors="ignore") as f:
+                return FileExcerpt(name, f.read(), meta)
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if meta:
+                return self._around(mm, name, meta)
+            if name.lower().endswith(self.LOG_SUFFIXES):
+                return self._tail(mm, name)
+            return self._head(mm, name)
+
+    # ---------- windows ----------
+    def _around(self, mm: mmap.mmap, name: str, meta: tuple[int, int, int]) -> FileExcerpt:
+        s_line, e_line, _ = meta
+        first = max(1, s_line - self.margin_lines)
+        start = self._seek_line(mm, first)
+        # Margin above the range, then the range itself, then the margin below
+        range_start = self._seek_line(mm, s_line, start, first)
+        range_end = self._seek_line(mm, e_line + 1, range_start, s_line)
+        end = self._seek_line(mm, e_line + 1 + self.margin_lines, range_end, e_line + 1)
+        if end - start > self.WINDOW_BYTES:
+            # Drop the margins before the range itself; a huge range is cut at a line end
+            first, start, end = s_line, range_start, range_end
+            if end - start > self.WINDOW_BYTES:
+                cut = mm.rfind(b"\n", start, start + self.WINDOW_BYTES)
+                end = cut + 1 if cut > start else start + self.WINDOW_BYTES
+        text = mm[start:end].decode("utf-8", errors="ignore")
+        last = first + text.count("\n") - (1 if text.endswith("\n") else 0)
+        outline = self._outline(mm, skip=(first, last))
+        return FileExcerpt(name, text, meta, first, outline, note=f"lines {first}-{last} of {self._size(len(mm))}")
+
+    def _head(self, mm: mmap.mmap, name: str) -> FileExcerpt:
+        cut = mm.rfind(b"\n", 0, self.WINDOW_BYTES)
+        end = cut + 1 if cut > 0 else self.WINDOW_BYTES
+        text = mm[:end].decode("utf-8", errors="ignore")
+        last = text.count("\n")
+        return FileExcerpt(name, text, None, 1, self._outline(mm, skip=(1, last)),
+                           note=f"first {self._size(end)} of {self._size(len(mm))}")
+
+    def _tail(self, mm: mmap.mmap, name: str) -> FileExcerpt:
+        size = len(mm)
+        nl = mm.find(b"\n", size - self.WINDOW_BYTES)
+        start = nl + 1 if 0 <= nl < size - 1 else size - self.WINDOW_BYTES
+        text = mm[start:].decode("utf-8", errors="ignore")
+        return FileExcerpt(name, text, None, None, note=f"last {self._size(size - start)} of {self._size(size)}")
+
+    # ---------- helpers ----------
+    @classmethod
+    def _seek_line(cls, mm: mmap.mmap, line: int, pos: int = 0, at: int = 1) -> int:
+        """Byte offset where 1-based ``line`` starts, scanning from ``pos`` (the start of line ``at``)."""
+        need = line - at
+        size = len(mm)
+        while need > 0 and pos < size:
+            block = mm[pos:pos + cls._BLOCK]
+            count = block.count(b"\n")
+            if count < need:
+                need -= count
+                pos += len(block)
+                continue
+            idx = -1
+            for _ in range(need):
+                idx = block.find(b"\n", idx + 1)
+            return pos + idx + 1
+        return min(pos, size)
+
+    @classmethod
+    def _outline(cls, mm: mmap.mmap, skip: tuple[int, int]) -> list[str]:
+        """``L<n>: <line>`` for symbol lines outside the ``skip`` range."""
+        limit = min(len(mm), cls.OUTLINE_SCAN_BYTES)
+        out: list[str] = []
+        line, pos = 1, 0
+        for m in cls.SYMBOL_RE.finditer(mm, 0, limit):
+            line += mm[pos:m.start()].count(b"\n")
+            pos = m.start()
+            if skip[0] <= line <= skip[1]:
+                continue
+            out.append(f"L{line}: " + m.group(0).decode("utf-8", errors="ignore").strip()[:120])
+            if len(out) >= cls.OUTLINE_MAX:
+                break
+        if out and limit < len(mm):
+            out.append(f"[... outline covers the first {cls._size(limit)}]")
+        return out
+
+    @staticmethod
+    def _size(n: int) -> str:
+        return f"{n / 1_000_000:.1f} MB" if n >= 1_000_000 else f"{n // 1000} KB"
+
+
+# ------------------------------------------------------------------ LATENCY PROFILES
+class LatencyProfiles:
+    """Named speed/quality tiers for Gemini calls, chosen per action.
+
+    A profile bundles the model, thinking budget, image resolution cap, context
+    budget and whether the answer is streamed. ``None`` means "use the Settings
+    value" (model, context budget) or "model default" (thinking, image size), so
+    ``balanced`` behaves exactly like a call without profiles. Any field can be
+    overridden in config.json under ``latency_profiles``.
+
+    ``balanced`` is the default. ``auto`` (opt-in) picks a tier from the input
+    size the context budget would grant at the Settings model: refines and small
+    text-only requests go to ``fast``, large or many-image analyses to ``thorough``.
+    The chosen profile and model are shown in the status line.
+    """
+
+    NAMES = ("fast", "balanced", "thorough")
+    AUTO = "auto"
+    DEFAULTS: dict[str, dict[str, Any]] = {
+        "fast": {"model": "gemini-2.5-flash-lite", "thinking_budget": 0, "max_image_side": 1024,
+                 "context_budget_tokens": 12_000, "stream": True},
+        "balanced": {"model": None, "thinking_budget": None, "max_image_side": None,
+                     "context_budget_tokens": None, "stream": True},
+        "thorough": {"model": "gemini-2.5-pro", "thinking_budget": -1, "max_image_side": None,
+                     "context_budget_tokens": 128_000, "stream": True},
+    }
+    # Auto-selection thresholds (input tokens granted by the budget at the Settings model)
+    FAST_MAX_TOKENS = 4_000
+    REFINE_FAST_MAX_TOKENS = 16_000
+    THOROUGH_MIN_TOKENS = 64_000
+    THOROUGH_MIN_IMAGES = 4
+
+    def __init__(self):
+        self.overrides: dict[str, dict[str, Any]] = {}
+
+    def import_overrides(self, data: Any) -> None:
+        if not isinstance(data, dict):
+            return
+        for name, fields in data.items():
+            if name in self.NAMES and isinstance(fields, dict):
+                self.overrides[name] = {k: v for k, v in fields.items() if k in self.DEFAULTS[name]}
+
+    def choose(self, action: str, input_tokens: int, images: int = 0) -> str:
+        """Tier for ``auto``: fast for refines/small prompts, thorough for heavy analyses."""
+        if action == "refine":
+            return "fast" if input_tokens <= self.REFINE_FAST_MAX_TOKENS else "balanced"
+        if images == 0 and input_tokens <= self.FAST_MAX_TOKENS:
+            return "fast"
+        if input_tokens >= self.THOROUGH_MIN_TOKENS or images >= self.THOROUGH_MIN_IMAGES:
+            return "thorough"
+        return "balanced"
+
+    def resolve(self, name: str, model: str, context_budget_tokens: int) -> dict[str, Any]:
+        """Concrete settings for profile ``name``, falling back to the Settings model and budget."""
+        if name not in self.NAMES:
+            name = "balanced"
+        spec = dict(self.DEFAULTS[name])
+        spec.update(self.overrides.get(name, {}))
+        thinking = spec.get("thinking_budget")
+        return {
+            "name": name,
+            "model": str(spec.get("model") or model),
+            "thinking_budget": int(thinking) if thinking is not None else None,
+            "max_image_side": int(spec["max_image_side"]) if spec.get("max_image_side") else None,
+            "context_budget_tokens": int(spec.get("context_budget_tokens") or context_budget_tokens),
+            "stream": bool(spec.get("stream", True)),
+        }
+
+    @staticmethod
+    def generation_config(profile: dict[str, Any], cached_content: str | None = None,
+                          **kwargs: Any) -> types.GenerateContentConfig | None:
+        """GenerateContentConfig for a resolved profile; None when nothing needs setting."""
+        if profile.get("thinking_budget") is not None and profile["model"].startswith("gemini-2.5"):
+            kwargs["thinking_config"] = types.ThinkingConfig(thinking_budget=profile["thinking_budget"])
+        if cached_content:
+            kwargs["cached_content"] = cached_content
+        return types.GenerateContentConfig(**kwargs) if kwargs else None
+
+    @staticmethod
+    def cap_image(data: bytes, max_side: int | None) -> bytes:
+        """Downscale an image so its longer side is at most ``max_side`` (PNG); unchanged if smaller."""
+        if not max_side:
+            return data
+        try:
+            with Image.open(BytesIO(data)) as img:
+                if max(img.size) <= max_side:
+                    return data
+                img = img.copy()
+                img.thumbnail((max_side, max_side), Image.LANCZOS)
+                out = BytesIO()
+                img.save(out, format="PNG")
+                return out.getvalue()
+        except Exception:
+            return data
+
+
+async def open_generation(client, profile: dict[str, Any], contents: Any, config: Any):
+    """Start a call for ``profile``: a streaming call, or one response wrapped as a one-chunk stream."""
+    if profile.get("stream", True):
+        return await client.aio.models.generate_content_stream(model=profile["model"], contents=contents, config=config)
+    response = await client.aio.models.generate_content(model=profile["model"], contents=contents, config=config)
+
+    async def _single():
+        yield response
+    return _single()
+
+
+# ------------------------------------------------------------------ PROJECT INDEX
+def bm25_scores(terms, postings: dict[str, dict[Any, int]], doc_len, n_docs: int, avgdl: float,
+                k1: float = 1.2, b: float = 0.75) -> dict[Any, float]:
+    """Okapi BM25 score per document for ``terms``; ``postings`` maps term -> {doc: tf}."""
+    scores: dict[Any, float] = {}
+    for term in terms:
+        posting = postings.get(term)
+        if not posting:
+            continue
+        idf = math.log(1 + (n_docs - len(posting) + 0.5) / (len(posting) + 0.5))
+        for doc, tf in posting.items():
+            norm = tf + k1 * (1 - b + b * doc_len(doc) / max(avgdl, 1e-9))
+            scores[doc] = scores.get(doc, 0.0) + idf * tf * (k1 + 1) / norm
+    return scores
+
+
+class ProjectIndex:
+    """Local BM25 index over the project's text files, in overlapping line chunks.
+
+    The index is kept per file (mtime + size), so ``update`` only re-reads files
+    that changed and drops deleted ones; postings are patched in place. It is
+    saved as JSON next to the config. ``search`` ranks chunks for a query with
+    Okapi BM25 and returns (path, first line, last line, score); chunk text is
+    read back from the file when it is used.
+    """
+
+    VERSION = 1
+    CHUNK_LINES = 40
+    CHUNK_OVERLAP = 10
+    MAX_FILE_BYTES = 512_000
+    MAX_FILES = 5000
+    RESCAN_INTERVAL_S = 5.0
+    K1 = 1.2
+    B = 0.75
+    TEXT_EXTENSIONS = (
+        ".py", ".pyi", ".js", ".jsx", ".ts", ".tsx", ".mjs", ".cjs", ".json", ".md", ".txt", ".rst", ".toml",
+        ".yaml", ".yml", ".ini", ".cfg", ".html", ".htm", ".css", ".scss", ".vue", ".svelte", ".java", ".kt",
+        ".go", ".rs", ".c", ".h", ".cpp", ".hpp", ".cc", ".cs", ".rb", ".php", ".swift", ".sh", ".ps1", ".bat",
+        ".sql", ".xml", ".gradle", ".dart", ".lua",
+    )
+    SKIP_DIRS = {
+        ".git", ".hg", ".svn", "node_modules", "__pycache__", ".venv", "venv", "env", "dist", "build",
+        ".idea", ".vscode", ".mypy_cache", ".pytest_cache", ".ruff_cache", ".tox", ".next", "target",
+        "MagicInput",  # the app's own data folder
+    }
+    STOPWORDS = frozenset(
+        "a an and are as at be by for from has have i in is it its of on or that the this to was were will with "
+        "you your we our me my please can should would could do does did not no yes so if then than but into "
+        "about what which when where how why there here just also".split()
+    )
+    # Word characters plus Indic vowel signs, which \w does not cover
+    _WORD_RE = re.compile(r"(?:\w|[\u0900-\u0DFF])+")
+    _CAMEL_RE = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+")
+
+    def __init__(self, root: str, index_path: str, log=None):
+        self.root = os.path.abspath(root)
+        self.index_path = index_path
+        self._log = log or (lambda *a, **k: None)
+        self._lock = threading.Lock()
+        # rel path -> {"mtime": ns, "size": bytes, "chunks": [[first, last, length, {term: tf}], ...]}
+        self.files: dict[str, dict[str, Any]] = {}
+        self._postings: dict[str, dict[tuple[str, int], int]] = {}
+        self._total_len = 0
+        self._n_chunks = 0
+        self._last_scan = 0.0
+        self._load()
+
+    # ---------- tokenizing ----------
+    @classmethod
+    def tokenize(cls, text: str) -> list[str]:
+        """Lower-cased words (any script); identifiers also contribute their camelCase/snake_case parts."""
+        out: list[str] = []
+        for word in cls._WORD_RE.findall(text):
+            low = word.lower()
+            if len(low) > 1 and low not in cls.STOPWORDS:
+                out.append(low)
+            if word.isascii() and ("_" in word or (not word.islower() and not word.isupper())):
+                parts = [p.lower() for piece in word.split("_") for p in cls._CAMEL_RE.findall(piece)]
+                if len(parts) > 1:
+                    out.extend(p for p in parts if len(p) > 1 and p not in cls.STOPWORDS)
+        return out
+
+    def _chunk(self, text: str) -> list[list[Any]]:
+        lines = text.splitlines()
+        chunks: list[list[Any]] = []
+        step = self.CHUNK_LINES - self.CHUNK_OVERLAP
+        for start in range(0, max(1, len(lines)), step):
+            terms = self.tokenize("\n".join(lines[start:start + self.CHUNK_LINES]))
+            if terms:
+                tf: dict[str, int] = {}
+                for t in terms:
+                    tf[t] = tf.get(t, 0) + 1
+                chunks.append([start + 1, min(len(lines), start + self.CHUNK_LINES), len(terms), tf])
+            if start + self.CHUNK_LINES >= len(lines):
+                break
+        return chunks
+
+    # ---------- postings ----------
+    def _add_file(self, rel: str, entry: dict[str, Any]) -> None:
+        self.files[rel] = entry
+        for i, (_, _, length, tf) in enumerate(entry["chunks"]):
+            self._total_len += length
+            self._n_chunks += 1
+            for term, n in tf.items():
+                self._postings.setdefault(term, {})[(rel, i)] = n
+
+    def _remove_file(self, rel: str) -> None:
+        entry = self.files.pop(rel, None)
+        if entry is None:
+            return
+        for i, (_, _, length, tf) in enumerate(entry["chunks"]):
+            self._total_len -= length
+            self._n_chunks -= 1
+            for term in tf:
+                posting = self._postings.get(term)
+                if posting is not None:
+                    posting.pop((rel, i), None)
+                    if not posting:
+                        del self._postings[term]
+
+    # ---------- maintenance ----------
+    def _walk(self) -> dict[str, os.stat_result]:
+        found: dict[str, os.stat_result] = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if d not in self.SKIP_DIRS and not d.startswith(".")]
+            for name in filenames:
+                if not name.lower().endswith(self.TEXT_EXTENSIONS):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if st.st_size <= self.MAX_FILE_BYTES:
+                    found[os.path.relpath(path, self.root).replace(os.sep, "/")] = st
+                if len(found) >= self.MAX_FILES:
+                    return found
+        return found
+
+    def update(self, force: bool = False) -> int:
+        """Re-index changed files and drop deleted ones; returns how many files changed."""
+        with self._lock:
+            if not force and time.monotonic() - self._last_scan < self.RESCAN_INTERVAL_S:
+                return 0
+            current = self._walk()
+            changed = 0
+            for rel in [r for r in self.files if r not in current]:
+                self._remove_file(rel)
+                changed += 1
+            for rel, st in current.items():
+                if cancel_requested():
+                    break
+                entry = self.files.get(rel)
+                if entry is not None and entry["mtime"] == st.st_mtime_ns and entry["size"] == st.st_size:
+                    continue
+                try:
+                    with open(os.path.join(self.root, rel), "r", encoding="utf-8", errors="ignore") as f:
+                        text = f.read()
+                except OSError:
+                    continue
+                self._remove_file(rel)
+                self._add_file(rel, {"mtime": st.st_mtime_ns, "size": st.st_size, "chunks": self._chunk(text)})
+                changed += 1
+            self._last_scan = time.monotonic()
+            if changed:
+                self._log(f"Project index: {changed} file(s) updated; {len(self.files)} files, {self._n_chunks} chunks")
+                self._save()
+            return changed
+
+    def search(self, query: str, k: int = 8) -> list[tuple[str, int, int, float]]:
+        """Top ``k`` chunks for ``query`` by BM25: (path, first line, last line, score)."""
+        terms = set(self.tokenize(query))
+        with self._lock:
+            n = self._n_chunks
+            if not n or not terms:
+                return []
+            scores = bm25_scores(terms, self._postings, lambda key: self.files[key[0]]["chunks"][key[1]][2],
+                                 n, self._total_len / n, self.K1, self.B)
+            best = sorted(scores.items(), key=lambda kv: -kv[1])[:k]
+            return [(rel, self.files[rel]["chunks"][i][0], self.files[rel]["chunks"][i][1], round(score, 3))
+                    for (rel, i), score in best]
+
+    def read_lines(self, rel: str, first: int, last: int) -> str:
+        try:
+            with open(os.path.join(self.root, rel), "r", encoding="utf-8", errors="ignore") as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return ""
+        return "\n".join(lines[first - 1:last])
+
+    # ---------- persistence ----------
+    def _load(self) -> None:
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("version") != self.VERSION or data.get("root") != self.root:
+            return
+        for rel, entry in (data.get("files") or {}).items():
+            try:
+                self._add_file(rel, entry)
+            except Exception:
+                self._remove_file(rel)
+
+    def _save(self) -> None:
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            tmp = self.index_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"version": self.VERSION, "root": self.root, "files": self.files}, f, separators=(",", ":"))
+            os.replace(tmp, self.index_path)
+        except Exception as e:
+            self._log(f"Project index: could not save: {e}")
+
+
+class PromptArchive:
+    """Append-only store for archived prompts: numbered text segments plus an offset index.
+
+    Each entry is appended to the current segment (``segment-000001.txt``, ...) in
+    the readable archive format, ``[timestamp]`` line, prompt, separator line, and
+    a fixed-size record (segment number, byte offset, byte length) is appended to
+    ``index.bin``. Archiving a prompt therefore costs one small append however big
+    the archive grows. Readers seek straight to an entry through the index;
+    ``iter_newest`` walks it backwards so recent prompts come first.
+
+    The old single ``Prompts Archive.txt`` (newest entry at the top, rewritten on
+    every send) is migrated once, in timestamp order, and then renamed.
+    """
+
+    SEGMENT_BYTES = 1 << 20
+    RECORD = struct.Struct("<IQI")  # segment number, byte offset, byte length
+    INDEX_NAME = "index.bin"
+    MIGRATED_MARK = "migrated"
+    SEGMENT_NAME = "segment-{:06d}.txt"
+    SEPARATOR = "-" * 50
+    HEADER_RE = re.compile(r"(?m)^(\[\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\][^\n]*)\n")
+    READ_BATCH = 256
+
+    def __init__(self, directory: str, legacy_path: str | None = None, log=None):
+        self.directory = directory
+        self.index_path = os.path.join(directory, self.INDEX_NAME)
+        self._log = log or (lambda *a, **k: None)
+        self._lock = threading.Lock()
+        if legacy_path and os.path.isfile(legacy_path):
+            self._migrate(legacy_path)
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            self._recover()
+
+    # ---------- writing ----------
+    def _segment_path(self, number: int) -> str:
+        return os.path.join(self.directory, self.SEGMENT_NAME.format(number))
+
+    def _last_record(self) -> tuple[int, int, int] | None:
+        try:
+            with open(self.index_path, "rb") as f:
+                size = f.seek(0, os.SEEK_END)
+                if size < self.RECORD.size:
+                    return None
+                f.seek(size - size % self.RECORD.size - self.RECORD.size)
+                return self.RECORD.unpack(f.read(self.RECORD.size))
+        except OSError:
+            return None
+
+    def _append(self, header: str, text: str) -> None:
+        data = f"{header}\n{text.strip()}\n{self.SEPARATOR}\n".encode("utf-8")
+        last = self._last_record()
+        number = last[0] if last else 1
+        path = self._segment_path(number)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = 0
+        if size and size + len(data) > self.SEGMENT_BYTES:
+            number, size = number + 1, 0
+            path = self._segment_path(number)
+        with open(path, "ab") as f:
+            f.write(data)
+        # The index record goes last: an entry is visible once its record is complete
+        with open(self.index_path, "ab") as f:
+            f.write(self.RECORD.pack(number, size, len(data)))
+
+    def append(self, header: str, text: str) -> None:
+        """Archive ``text`` under ``header`` (``[YYYY-mm-dd HH:MM:SS]``, optionally followed by a note)."""
+        with self._lock:
+            self._append(header, text)
+
+    # ---------- reading ----------
+    def count(self) -> int:
+        try:
+            return os.path.getsize(self.index_path) // self.RECORD.size
+        except OSError:
+            return 0
+
+    def _parse_entry(self, data: bytes) -> tuple[str, str]:
+        header, _, body = data.decode("utf-8", errors="ignore").partition("\n")
+        body = body.rstrip()
+        if body.endswith(self.SEPARATOR):
+            body = body[: -len(self.SEPARATOR)].rstrip()
+        m = self.HEADER_RE.match(header + "\n")
+        return (m.group(1)[1:20] if m else ""), body
+
+    def entries(self, start: int = 0, stop: int | None = None, newest_first: bool = False) -> Iterator[tuple[str, str]]:
+        """Entries ``start..stop`` (by age, oldest is 0) as (timestamp, text).
+
+        With ``newest_first`` the index is read backwards in batches of records,
+        so only the part of the archive that is consumed gets read.
+        """
+        with self._lock:
+            stop = self.count() if stop is None else min(stop, self.count())
+        if start >= stop:
+            return
+        handles: dict[int, Any] = {}
+        try:
+            with open(self.index_path, "rb") as index:
+                pos = stop if newest_first else start
+                while start < pos if newest_first else pos < stop:
+                    if newest_first:
+                        first, last = max(start, pos - self.READ_BATCH), pos
+                    else:
+                        first, last = pos, min(stop, pos + self.READ_BATCH)
+                    index.seek(first * self.RECORD.size)
+                    block = index.read((last - first) * self.RECORD.size)
+                    records = [self.RECORD.unpack_from(block, i * self.RECORD.size)
+                               for i in range(len(block) // self.RECORD.size)]
+                    for number, offset, length in (reversed(records) if newest_first else records):
+                        seg = handles.get(number)
+                        if seg is None:
+                            seg = handles[number] = open(self._segment_path(number), "rb")
+                        seg.seek(offset)
+                        yield self._parse_entry(seg.read(length))
+                    pos = first if newest_first else last
+        except OSError as e:
+            self._log(f"Prompt archive: read failed: {e}")
+        finally:
+            for seg in handles.values():
+                seg.close()
+
+    def iter_newest(self) -> Iterator[tuple[str, str]]:
+        """All entries as (timestamp, text), newest first."""
+        return self.entries(newest_first=True)
+
+    # ---------- maintenance ----------
+    def _scan_segment(self, number: int, start: int = 0) -> list[tuple[int, int, int]]:
+        """Index records for the entries of segment ``number`` from byte ``start`` on."""
+        try:
+            with open(self._segment_path(number), "rb") as f:
+                f.seek(start)
+                content = f.read().decode("utf-8", errors="ignore")
+        except OSError:
+            return []
+        starts = [m.start() for m in self.HEADER_RE.finditer(content)] + [len(content)]
+        records = []
+        for a, b in zip(starts, starts[1:]):
+            offset = start + len(content[:a].encode("utf-8"))
+            length = len(content[a:b].encode("utf-8"))
+            records.append((number, offset, length))
+        return records
+
+    def _recover(self) -> None:
+        """Make the index agree with the segments after an interrupted write."""
+        numbers = sorted(int(m.group(1)) for name in os.listdir(self.directory)
+                         if (m := re.fullmatch(r"segment-(\d{6})\.txt", name)))
+        size = os.path.getsize(self.index_path) if os.path.isfile(self.index_path) else 0
+        last = self._last_record()
+        if not numbers:
+            if size:
+                os.remove(self.index_path)
+            return
+        tail = os.path.getsize(self._segment_path(numbers[-1]))
+        if size % self.RECORD.size == 0 and last and last[0] == numbers[-1] and last[1] + last[2] == tail:
+            return
+        if size % self.RECORD.size == 0 and last and last[0] == numbers[-1] and last[1] + last[2] < tail:
+            # Entry text was written but its record was not: index the leftover bytes
+            records = self._scan_segment(last[0], last[1] + last[2])
+            mode = "ab"
+        else:
+            records = [r for n in numbers for r in self._scan_segment(n)]
+            mode = "wb"
+        with open(self.index_path, mode) as f:
+            f.write(b"".join(self.RECORD.pack(*r) for r in records))
+        self._log(f"Prompt archive: index repaired ({len(records)} record(s) {'added' if mode == 'ab' else 'rebuilt'})")
+
+    def _migrate(self, legacy_path: str) -> None:
+        """Move the prepend-format archive into segments, sorted oldest first (once).
+
+        The new archive is built aside and swapped in, and carries a marker, so
+        an interrupted migration is redone on the next start rather than leaving
+        half an archive. Entries appended since a failed attempt are kept after
+        the migrated ones.
+        """
+        migrated = os.path.splitext(legacy_path)[0] + " (migrated).txt"
+        try:
+            if not os.path.isfile(os.path.join(self.directory, self.MIGRATED_MARK)):
+                with open(legacy_path, "r", encoding="utf-8", errors="ignore") as f:
+                    pieces = self.HEADER_RE.split(f.read())
+                parsed = []
+                for i in range(1, len(pieces) - 1, 2):
+                    body = pieces[i + 1].rstrip()
+                    if body.endswith(self.SEPARATOR):
+                        body = body[: -len(self.SEPARATOR)].rstrip()
+                    if body:
+                        parsed.append((pieces[i], body))
+                # Mostly newest-first, but older versions appended and left stretches
+                # oldest-first: order by header timestamp; the sort is stable, so
+                # entries from the same second stay in reversed file order
+                parsed.reverse()
+                parsed.sort(key=lambda entry: entry[0][1:20])
+                if os.path.isfile(self.index_path):
+                    parsed += [(f"[{timestamp}]", body) for timestamp, body in self.entries()]
+                target = self.directory
+                staging, previous = target + ".tmp", target + ".old"
+                shutil.rmtree(staging, ignore_errors=True)
+                os.makedirs(staging)
+                self.directory, self.index_path = staging, os.path.join(staging, self.INDEX_NAME)
+                try:
+                    for header, body in parsed:
+                        self._append(header, body)
+                    open(os.path.join(staging, self.MIGRATED_MARK), "w").close()
+                finally:
+                    self.directory, self.index_path = target, os.path.join(target, self.INDEX_NAME)
+                if os.path.isdir(target):
+                    os.replace(target, previous)
+                os.replace(staging, target)
+                shutil.rmtree(previous, ignore_errors=True)
+                self._log(f"Prompt archive: migrated {len(parsed)} entries from {os.path.basename(legacy_path)}")
+            os.replace(legacy_path, migrated)
+        except Exception as e:
+            self._log(f"Prompt archive: migration failed: {e}")
+
+
+class PromptHistory:
+    """Term index over the entries of the prompt archive for picking relevant past prompts.
+
+    The archive is append-only, so only entries added since the last look are
+    indexed: ``add`` indexes each newly archived prompt, and a search picks up
+    entries appended by anything else. ``search`` blends BM25 relevance with
+    recency (exponential decay), so a matching prompt from last week beats an
+    unrelated one from a minute ago, while recent prompts win among similar matches.
+    """
+
+    TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+    RECENCY_WEIGHT = 0.3
+    RECENCY_HALF_LIFE_DAYS = 7.0
+
+    def __init__(self, archive: PromptArchive, log=None):
+        self.archive = archive
+        self._log = log or (lambda *a, **k: None)
+        self._lock = threading.Lock()
+        # id -> (timestamp text, epoch seconds, prompt text, token count); ids follow archive order (age)
+        self.entries: dict[int, tuple[str, float, str, int]] = {}
+        self._postings: dict[str, dict[int, int]] = {}
+        self._total_len = 0
+        self._next_id = 0
+        self._loaded = False
+
+    def _index(self, timestamp: str, text: str) -> None:
+        try:
+            epoch = datetime.datetime.strptime(timestamp, self.TIME_FORMAT).timestamp()
+        except ValueError:
+            epoch = 0.0
+        terms = ProjectIndex.tokenize(text)
+        entry_id = self._next_id
+        self._next_id += 1
+        self.entries[entry_id] = (timestamp, epoch, text, len(terms))
+        self._total_len += len(terms)
+        tf: dict[str, int] = {}
+        for t in terms:
+            tf[t] = tf.get(t, 0) + 1
+        for term, n in tf.items():
+            self._postings.setdefault(term, {})[entry_id] = n
+
+    def _ensure_current(self) -> None:
+        count = self.archive.count()
+        if self._loaded and count < self._next_id:
+            # Archive was replaced or truncated: start over
+            self.entries.clear()
+            self._postings.clear()
+            self._total_len = 0
+            self._next_id = 0
+        if count > self._next_id:
+            before = self._next_id
+            for timestamp, body in self.archive.entries(self._next_id, count):
+                if body:
+                    self._index(timestamp, body)
+                else:
+                    self._next_id += 1  # keep ids aligned with archive positions
+            self._log(f"Prompt history: indexed {self._next_id - before} archived prompt(s); {len(self.entries)} total")
+        self._loaded = True
+
+    def add(self, timestamp: str, text: str) -> None:
+        """Index an entry that was just appended to the archive."""
+        with self._lock:
+            if not self._loaded or self.archive.count() != self._next_id + 1:
+                return  # not loaded yet or out of step; the next search catches up from the archive
+            self._index(timestamp, text.strip())
+
+    def search(self, query: str, k: int = 8, now: float | None = None) -> list[tuple[str, str, float]]:
+        """Best ``k`` entries as (timestamp, text, score), by relevance blended with recency.
+
+        Without any matching term the newest entries are returned, for continuity.
+        """
+        with self._lock:
+            self._ensure_current()
+            n = len(self.entries)
+            if not n:
+                return []
+            now = time.time() if now is None else now
+            relevance = bm25_scores(set(ProjectIndex.tokenize(query)), self._postings,
+                                    lambda i: self.entries[i][3], n, self._total_len / n)
+            top = max(relevance.values(), default=0.0)
+            candidates = relevance.keys() if top > 0 else self.entries.keys()
+            ranked = []
+            for i in candidates:
+                timestamp, epoch, text, _ = self.entries[i]
+                age_days = max(0.0, now - epoch) / 86400 if epoch else 365.0
+                recency = 0.5 ** (age_days / self.RECENCY_HALF_LIFE_DAYS)
+                rel = relevance.get(i, 0.0) / top if top > 0 else 0.0
+                ranked.append(((1 - self.RECENCY_WEIGHT) * rel + self.RECENCY_WEIGHT * recency, i))
+            ranked.sort(key=lambda item: (-item[0], -item[1]))
+            return [(self.entries[i][0], self.entries[i][2], round(score, 3)) for score, i in ranked[:k]]
+
+
+class FileSummaryCache:
+    """Short summaries of project files, keyed by a hash of the file's content.
+
+    A summary is either a local outline (leading comment or docstring plus the
+    names the file defines, built without an API call) or a model-written one,
+    which replaces the outline once it exists. Entries survive edits to other
+    files and renames, and a changed file simply gets a new hash. The cache is
+    saved as JSON next to the config; the least recently used entries are
+    dropped beyond ``MAX_ENTRIES``.
+    """
+
+    VERSION = 1
+    MAX_ENTRIES = 2000
+    MAX_READ_BYTES = 256_000
+    OUTLINE_NAMES = 30
+    _NAME_RE = re.compile(r"[A-Za-z_$][\w$]*(?=\s*[(:<{=]|\s*$)")
+
+    def __init__(self, path: str, log=None):
+        self.path = path
+        self._log = log or (lambda *a, **k: None)
+        self._lock = threading.Lock()
+        # content sha1 -> {"kind": "outline" | "model", "text": str, "path": rel path, "used": epoch}
+        self.entries: dict[str, dict[str, Any]] = {}
+        self._dirty = False
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == self.VERSION:
+                self.entries = dict(data.get("entries") or {})
+        except (OSError, ValueError):
+            pass
+
+    @staticmethod
+    def digest(path: str) -> str:
+        h = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        return h.hexdigest()
+
+    def get(self, digest: str, rel: str, path: str) -> dict[str, Any]:
+        """The entry for ``digest``, building the local outline first if there is none."""
+        with self._lock:
+            entry = self.entries.get(digest)
+        if entry is None:
+            entry = {"kind": "outline", "text": self.outline(path), "path": rel}
+        entry["used"] = time.time()
+        with self._lock:
+            self.entries[digest] = entry
+            self._dirty = True
+        return entry
+
+    def put_model(self, digest: str, rel: str, text: str) -> None:
+        with self._lock:
+            self.entries[digest] = {"kind": "model", "text": text, "path": rel, "used": time.time()}
+            self._dirty = True
+
+    @staticmethod
+    def _lead(text: str, name: str) -> str:
+        """First line of the file's leading comment or docstring that says something (not its name)."""
+        for line in text.splitlines()[:15]:
+            stripped = line.strip()
+            if stripped.startswith("#!"):
+                continue
+            body = stripped.lstrip("#/*!<-\"' ").rstrip("*/-> \"'").strip()
+            if stripped and not stripped.startswith(("#", "//", "/*", "*", '"""', "\'\'\'", "<!--")) and body == stripped:
+                return ""  # code starts before any comment
+            if body and body.lower() != name.lower() and any(c.isalpha() for c in body):
+                return body[:160]
+        return ""
+
+    @classmethod
+    def outline(cls, path: str) -> str:
+        try:
+            with open(path, "rb") as f:
+                data = f.read(cls.MAX_READ_BYTES)
+        except OSError:
+            return ""
+        text = data.decode("utf-8", errors="ignore")
+        parts = [f"{text.count(chr(10)) + 1}{'+' if len(data) >= cls.MAX_READ_BYTES else ''} lines."]
+        lead = cls._lead(text, os.path.basename(path))
+        if lead:
+            parts.append(lead)
+        names: list[str] = []
+        markdown = path.lower().endswith((".md", ".markdown", ".rst", ".txt"))
+        for m in FileContextExtractor.SYMBOL_RE.finditer(data):
+            line = m.group(0).decode("utf-8", errors="ignore")
+            if line.startswith("#"):
+                # Headings in documents; in code these are comments
+                if markdown:
+                    names.append(line.lstrip("# ").strip()[:60])
+            elif not line[:1].isspace():
+                words = line.split()
+                found = cls._NAME_RE.search(" ".join(words[1:])) if len(words) > 1 else None
+                if found and found.group(0) not in names:
+                    names.append(found.group(0))
+            if len(names) >= cls.OUTLINE_NAMES:
+                names.append("…")
+                break
+        if names:
+            parts.append("Defines: " + ", ".join(names))
+        return " ".join(parts)
+
+    def save(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+            if len(self.entries) > self.MAX_ENTRIES:
+                keep = sorted(self.entries.items(), key=lambda kv: -kv[1].get("used", 0))[:self.MAX_ENTRIES]
+                self.entries = dict(keep)
+            data = {"version": self.VERSION, "entries": self.entries}
+            self._dirty = False
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(tmp, self.path)
+        except Exception as e:
+            self._log(f"File summaries: could not save: {e}")
+
+
+# ------------------------------------------------------------------ GIT CHANGES
+class GitChanges:
+    """Staged and unstaged changes of the project's git repository, via the ``git`` CLI.
+
+    ``collect`` probes with ``git status`` (cheap) and regenerates the diffs only
+    when the probe, the index/HEAD mtimes or the stats of the changed files differ
+    from the last call. ``fit`` trims the result to a token budget hunk by hunk:
+    every changed file first gets its header and first hunk, then later hunks are
+    added in order, and whatever is left out is named.
+    """
+
+    TIMEOUT_S = 10.0
+    MAX_DIFF_CHARS = 2_000_000
+    MAX_UNTRACKED = 50
+    _HUNK_RE = re.compile(r"(?m)^@@ ")
+
+    def __init__(self, root: str, log=None):
+        self.root = root
+        self._log = log or (lambda *a, **k: None)
+        self._lock = threading.Lock()
+        self._git_dir: str | None = None
+        self._key: tuple | None = None
+        self._text = ""
+
+    def _git(self, *args: str) -> str | None:
+        try:
+            proc = subprocess.run(["git", "-C", self.root, *args], capture_output=True, timeout=self.TIMEOUT_S)
+        except (OSError, subprocess.SubprocessError):
+            return None
+        return proc.stdout.decode("utf-8", errors="replace") if proc.returncode == 0 else None
+
+    def _stat(self, path: str) -> tuple[int, int] | None:
+        try:
+            st = os.stat(path)
+            return st.st_mtime_ns, st.st_size
+        except OSError:
+            return None
+
+    @staticmethod
+    def _parse_status(status: str) -> list[tuple[str, str]]:
+        """(XY code, path) per entry of ``git status --porcelain=v1 -z``.
+
+        A rename or copy is followed by a field of its own holding the source path
+        (no ``XY`` prefix); that source is returned with the code ``"<-"``.
+        """
+        entries: list[tuple[str, str]] = []
+        fields = iter(status.split("\0"))
+        for field in fields:
+            if len(field) < 4:
+                continue
+            code = field[:2]
+            entries.append((code, field[3:]))
+            if "R" in code or "C" in code:
+                source = next(fields, "")
+                if source:
+                    entries.append(("<-", source))
+        return entries
+
+    def collect(self) -> str:
+        """Staged diff, unstaged diff and untracked file names; "" outside a repository or when clean."""
+        with self._lock:
+            if self._git_dir is None:
+                git_dir = self._git("rev-parse", "--absolute-git-dir")
+                if git_dir is None:
+                    return ""
+                self._git_dir = git_dir.strip()
+            status = self._git("status", "--porcelain=v1", "-z", "--untracked-files=normal")
+            if status is None:
+                return ""
+            entries = self._parse_status(status)
+            paths = [p for _, p in entries]
+            key = (
+                status,
+                self._stat(os.path.join(self._git_dir, "index")),
+                self._stat(os.path.join(self._git_dir, "HEAD")),
+                tuple(self._stat(os.path.join(self.root, p)) for p in paths),
+            )
+            if key == self._key:
+                return self._text
+            parts: list[str] = []
+            for title, args in (("Staged changes", ("diff", "--cached")), ("Unstaged changes", ("diff",))):
+                diff = self._git(*args, "--no-color", "--no-ext-diff", "--find-renames")
+                if diff and diff.strip():
+                    parts.append(f"## {title}\n{diff[:self.MAX_DIFF_CHARS].rstrip()}")
+            untracked = [p for code, p in entries if code == "??"]
+            if untracked:
+                more = f" (+{len(untracked) - self.MAX_UNTRACKED} more)" if len(untracked) > self.MAX_UNTRACKED else ""
+                parts.append("## Untracked files\n" + "\n".join(untracked[:self.MAX_UNTRACKED]) + more)
+            self._key, self._text = key, "\n\n".join(parts)
+            self._log(f"Git changes: {len(paths)} path(s), {len(self._text)} chars")
+            return self._text
+
+    @classmethod
+    def fit(cls, text: str, tokens: int, estimate) -> str:
+        if estimate(text) <= tokens:
+            return text
+        # Split into (section title, [(file header, [hunks])])
+        sections: list[tuple[str, list[tuple[str, list[str]]]]] = []
+        for block in re.split(r"(?m)^(?=## )", text):
+            if not block.strip():
+                continue
+            title, _, body = block.partition("\n")
+            files: list[tuple[str, list[str]]] = []
+            for fdiff in re.split(r"(?m)^(?=diff --git )", body):
+                if not fdiff.strip():
+                    continue
+                pieces = cls._HUNK_RE.split(fdiff)
+                files.append((pieces[0].rstrip("\n"), ["@@ " + p.rstrip("\n") for p in pieces[1:]]))
+            sections.append((title, files))
+        used = sum(estimate(title) + 1 for title, _ in sections)
+        kept: dict[tuple[int, int], int] = {}  # (section, file) -> hunks kept
+        # First pass: every file's header and first hunk, in order; second: the remaining hunks
+        for first_pass in (True, False):
+            for si, (_, files) in enumerate(sections):
+                for fi, (header, hunks) in enumerate(files):
+                    n = kept.get((si, fi), 0)
+                    todo = hunks[n:n + 1] if first_pass else hunks[n:]
+                    if first_pass and n == 0:
+                        cost = estimate(header) + 1 + sum(estimate(h) + 1 for h in todo)
+                        if used + cost <= tokens:
+                            kept[(si, fi)] = len(todo)
+                            used += cost
+                        continue
+                    if (si, fi) not in kept:
+                        continue
+                    for h in todo:
+                        cost = estimate(h) + 1
+                        if used + cost > tokens:
+                            break
+                        kept[(si, fi)] += 1
+                        used += cost
+        out: list[str] = []
+        for si, (title, files) in enumerate(sections):
+            out.append(title)
+            left_out: list[str] = []
+            for fi, (header, hunks) in enumerate(files):
+                if (si, fi) not in kept:
+                    first = header.partition("\n")[0]
+                    left_out.append(first[len("diff --git "):] if first.startswith("diff --git ") else "the file list")
+                    continue
+                out.append(header)
+                out.extend(hunks[:kept[(si, fi)]])
+                if kept[(si, fi)] < len(hunks):
+                    out.append(f"[... {len(hunks) - kept[(si, fi)]} more hunk(s) of this file omitted]")
+            if left_out:
+                out.append("[... also changed, omitted to fit the context budget: " + ", ".join(left_out) + "]")
+        return "\n".join(out)
+
+
+# ------------------------------------------------------------------ CONTEXT MEMO
+class StatMemo:
+    """Values derived from files, reused while every file's mtime and size are unchanged.
+
+    ``get(key, paths, compute)`` returns the cached value for ``key`` if the stat
+    stamp of ``paths`` matches the one taken when it was computed; otherwise it
+    calls ``compute()``. The stamp is taken before computing, so a file that
+    changes mid-read is picked up next time. Least recently used entries are
+    evicted beyond ``max_entries``.
+    """
+
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._items: dict[Any, tuple[tuple, Any]] = {}
+
+    @staticmethod
+    def stamp(paths: Sequence[str]) -> tuple:
+        out = []
+        for p in paths:
+            try:
+                st = os.stat(p)
+                out.append((p, st.st_mtime_ns, st.st_size))
+            except OSError:
+                out.append((p, None, None))
+        return tuple(out)
+
+    def get(self, key: Any, paths: Sequence[str], compute) -> Any:
+        stamp = self.stamp(paths)
+        with self._lock:
+            hit = self._items.pop(key, None)
+            if hit is not None and hit[0] == stamp:
+                self._items[key] = hit
+                return hit[1]
+        value = compute()
+        with self._lock:
+            self._items[key] = (stamp, value)
+            while len(self._items) > self.max_entries:
+                self._items.pop(next(iter(self._items)))
+        return value
+
+
+# ------------------------------------------------------------------ TERMINAL CAPTURE
+class TerminalRing:
+    """Fixed-size, memory-mapped ring buffer of recent terminal output.
+
+    ``python MagicInput.py --capture`` writes into it (see ``run_capture_cli``) and
+    Visionize reads the tail. The file is a header (magic, capacity, total bytes ever
+    written, time of the last write) followed by ``capacity`` bytes of ring. Several
+    captured terminals can share it (with the same ``--size-kb``): opening it and each
+    write hold an exclusive lock on the file (``flock``, or ``msvcrt.locking`` on
+    Windows) while they check or update the header. Readers don't lock.
+    """
+
+    FILENAME = "terminal_ring.bin"
+    MAGIC = b"MIRING01"
+    HEADER = struct.Struct("<8sQQd")
+
+    def __init__(self, path: str, capacity: int = 1 << 20):
+        """Open ``path`` for writing, (re)creating it if missing or of another capacity."""
+        self.path = path
+        self.capacity = max(4096, int(capacity))
+        size = self.HEADER.size + self.capacity
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Opened without truncating: another terminal may be writing to it right now
+        self._file = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o666), "r+b")
+        locked = self._lock(True)
+        try:
+            self._file.seek(0)
+            try:
+                magic, cap, _, _ = self.HEADER.unpack(self._file.read(self.HEADER.size))
+                reuse = magic == self.MAGIC and cap == self.capacity and os.fstat(self._file.fileno()).st_size == size
+            except struct.error:
+                reuse = False
+            if not reuse:
+                self._file.truncate(size)
+            self._mm = mmap.mmap(self._file.fileno(), size)
+            if not reuse:
+                self._mm[:self.HEADER.size] = self.HEADER.pack(self.MAGIC, self.capacity, 0, 0.0)
+        finally:
+            if locked:
+                self._lock(False)
+
+    def _lock(self, exclusive: bool) -> bool:
+        """Take (or release) the writers' lock on the file's first byte. False if it can't be had."""
+        try:
+            if os.name == "nt":
+                import msvcrt
+                self._file.seek(0)
+                # LK_LOCK retries for about 10 seconds before giving up
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK if exclusive else msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_UN)
+            return True
+        except OSError:
+            return False
+
+    def write(self, data: bytes) -> None:
+        if not data:
+            return
+        # Without the lock the output is still kept; only a concurrent write could interleave
+        locked = self._lock(True)
+        try:
+            cap, base = self.capacity, self.HEADER.size
+            _, _, total, _ = self.HEADER.unpack_from(self._mm, 0)
+            skip = max(0, len(data) - cap)
+            chunk = data[skip:]
+            pos = (total + skip) % cap
+            first = min(len(chunk), cap - pos)
+            self._mm[base + pos:base + pos + first] = chunk[:first]
+            if first < len(chunk):
+                self._mm[base:base + len(chunk) - first] = chunk[first:]
+            # Not pack_into: it zero-fills the header before writing it, which a reader could catch
+            self._mm[:self.HEADER.size] = self.HEADER.pack(self.MAGIC, cap, total + len(data), time.time())
+        finally:
+            if locked:
+                self._lock(False)
+
+    def close(self) -> None:
+        try:
+            self._mm.flush()
+            self._mm.close()
+        finally:
+            self._file.close()
+
+    @classmethod
+    def read_tail(cls, path: str, max_bytes: int) -> tuple[str, float]:
+        """The last ``max_bytes`` written (starting at a line boundary) and the last write time."""
+        try:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                magic, cap, total, stamp = cls.HEADER.unpack_from(mm, 0)
+                if magic != cls.MAGIC or len(mm) < cls.HEADER.size + cap:
+                    return "", 0.0
+                n = min(max_bytes, total, cap)
+                base, start = cls.HEADER.size, (total - n) % cap
+                if start + n <= cap:
+                    data = mm[base + start:base + start + n]
+                else:
+                    data = mm[base + start:base + cap] + mm[base:base + start + n - cap]
+        except (OSError, ValueError, struct.error):
+            return "", 0.0
+        text = data.decode("utf-8", errors="ignore")
+        if n < total and "\n" in text:
+            # The oldest line was cut by the window (or overwritten while reading)
+            text = text.partition("\n")[2]
+        return text, stamp
+
+
+class MultiplexerScrollback:
+    """Scrollback of local tmux panes and screen sessions, fetched incrementally and cached per pane.
+
+    Panes are keyed ``tmux:<pane id>`` or ``screen:<session>``. For tmux the cursor is
+    the number of lines the pane has produced (history size + cursor row), so a capture
+    fetches only the lines after it. When tmux has trimmed old history that count is off;
+    then, as for screen (whose ``hardcopy`` always writes everything), new lines are
+    found by locating the last cached lines in a recent window.
+    """
+
+    MAX_LINES = 5000
+    ANCHOR_LINES = 3
+    # Lines before an anchor match compared with the cache to pick among repeated matches
+    MATCH_LINES = 200
+    TIMEOUT_S = 3.0
+
+    def __init__(self, log=None):
+        self._log = log or (lambda *a, **k: None)
+        self._lock = threading.Lock()
+        # key -> {"seen": lines produced at the last capture, "lines": cached scrollback}
+        self._panes: dict[str, dict[str, Any]] = {}
+
+    def _run(self, args: list[str]) -> str | None:
+        try:
+            proc = subprocess.run(args, capture_output=True, text=True, errors="replace", timeout=self.TIMEOUT_S)
+        except (OSError, subprocess.SubprocessError):
+            return None
+        return proc.stdout if proc.returncode == 0 else None
+
+    def list_panes(self) -> list[tuple[str, str]]:
+        """(key, label) for every local tmux pane and screen session."""
+        panes: list[tuple[str, str]] = []
+        out = self._run(["tmux", "list-panes", "-a", "-F",
+                         "#{pane_id}\t#{session_name}:#{window_index}.#{pane_index}\t#{pane_current_command}\t#{pane_title}"])
+        for line in (out or "").splitlines():
+            parts = line.split("\t")
+            if len(parts) == 4:
+                panes.append((f"tmux:{parts[0]}", f"[tmux] {parts[1]} {parts[2]} — {parts[3]}"))
+        # screen -ls exits non-zero even when it lists sessions, so read its output directly
+        try:
+            proc = subprocess.run(["screen", "-ls"], capture_output=True, text=True, errors="replace", timeout=self.TIMEOUT_S)
+            listing = proc.stdout
+        except (OSError, subprocess.SubprocessError):
+            listing = ""
+        for m in re.finditer(r"^\s+(\d+\.\S+)\s+(?:\([^)]*\)\s*)*\((Attached|Detached)\)", listing, re.M):
+            panes.append((f"screen:{m.group(1)}", f"[screen] {m.group(1)} ({m.group(2).lower()})"))
+        return panes
+
+    def capture(self, key: str) -> str | None:
+        """Cached scrollback of ``key`` brought up to date; None if the pane is gone."""
+        kind, _, target = key.partition(":")
+        with self._lock:
+            state = self._panes.setdefault(key, {"seen": -1, "lines": []})
+            ok = self._capture_tmux(target, state) if kind == "tmux" else self._capture_screen(target, state)
+            if not ok:
+                self._panes.pop(key, None)
+                return None
+            del state["lines"][:-self.MAX_LINES]
+            return "\n".join(state["lines"])
+
+    def _capture_range(self, target: str, start: int, end: int) -> list[str] | None:
+        out = self._run(["tmux", "capture-pane", "-p", "-J", "-t", target, "-S", str(start), "-E", str(end)])
+        return None if out is None else out.rstrip("\n").split("\n")
+
+    def _capture_tmux(self, target: str, state: dict[str, Any]) -> bool:
+        out = self._run(["tmux", "display-message", "-p", "-t", target,
+                         "#{history_size} #{cursor_y} #{pane_height}"])
+        try:
+            history, cursor_y, height = (int(v) for v in (out or "").split())
+        except ValueError:
+            return False
+        produced = history + cursor_y + 1
+        lines = state["lines"]
+        if lines and state["seen"] <= produced:
+            # Lines are numbered from the top of the screen (history is negative). Fetch from a
+            # few lines before the last one seen; if they no longer match, tmux dropped old
+            # history in between and the overlap search below takes over
+            start = max(-history, state["seen"] - 1 - self.ANCHOR_LINES - history)
+            fetched = self._capture_range(target, start, cursor_y)
+            if fetched is None:
+                return False
+            # Where the anchor lines (see _merge) were when they were seen
+            anchor_len = min(self.ANCHOR_LINES, len(lines) - 1) or 1
+            at = state["seen"] - anchor_len - (1 if len(lines) > 1 else 0) - (start + history)
+            if self._merge(lines, fetched, replace=False, at=at if at >= 0 else None):
+                state["seen"] = produced
+                return True
+        # First capture, or history trimmed or cleared: find the new lines by overlap
+        window = height + 200 if lines else self.MAX_LINES
+        while True:
+            fetched = self._capture_range(target, max(-history, cursor_y + 1 - window), cursor_y)
+            if fetched is None:
+                return False
+            final = window >= min(self.MAX_LINES, history + height)
+            if self._merge(lines, fetched, replace=final) or final:
+                break
+            window *= 4
+        state["seen"] = produced
+        return True
+
+    def _capture_screen(self, session: str, state: dict[str, Any]) -> bool:
+        fd, path = tempfile.mkstemp(prefix="magicinput-screen-", suffix=".txt")
+        os.close(fd)
+        os.remove(path)
+        try:
+            if self._run(["screen", "-S", session, "-X", "hardcopy", "-h", path]) is None:
+                return False
+            # The screen server writes the file asynchronously
+            deadline = time.monotonic() + self.TIMEOUT_S
+            while not os.path.exists(path) and time.monotonic() < deadline:
+                time.sleep(0.05)
+            time.sleep(0.05)
+            with open(path, "r", encoding="utf-8", errors="replace") as f:
+                fetched = f.read().rstrip().split("\n")
+        except OSError as e:
+            self._log(f"screen hardcopy failed for {session}: {e}")
+            return False
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._merge(state["lines"], [l.rstrip() for l in fetched])
+        return True
+
+    def _merge(self, lines: list[str], fetched: list[str], replace: bool = True, at: int | None = None) -> bool:
+        """Append what ``fetched`` has after the cached tail. Returns False if they don't overlap,
+        in which case the cache is replaced by ``fetched`` if ``replace``.
+
+        ``at`` is where the anchor should start in ``fetched`` when the caller fetched from a
+        known position; otherwise (or if it isn't there) the anchor is searched for.
+        """
+        if not lines:
+            lines[:] = fetched
+            return True
+        # The last cached line may have changed since; anchor on the ones before it
+        anchor = lines[-1 - self.ANCHOR_LINES:-1] or lines[-1:]
+        n = len(anchor)
+        if at is None or fetched[at:at + n] != anchor:
+            at = self._find_anchor(lines, fetched, anchor)
+        if at is None:
+            if replace:
+                lines[:] = fetched
+            return False
+        if len(lines) > 1:
+            lines[-1:] = fetched[at + n:]
+        else:
+            lines.extend(fetched[at + n:])
+        return True
+
+    def _find_anchor(self, lines: list[str], fetched: list[str], anchor: list[str]) -> int | None:
+        """Position of ``anchor`` in ``fetched`` whose preceding lines best agree with the cache.
+
+        Repeated or blank lines make the anchor match in several places. Each match is
+        checked backwards (up to ``MATCH_LINES``): one that runs into a different line is
+        worse than one that runs out of fetched or cached lines first, then more agreeing
+        lines win, and among equals the earliest does, so output is repeated, never lost.
+        """
+        n = len(anchor)
+        before = len(lines) - n - (1 if len(lines) > 1 else 0)
+        best, best_score = None, (False, -1)
+        for i in range(len(fetched) - n + 1):
+            if fetched[i:i + n] != anchor:
+                continue
+            k = 0
+            while k < self.MATCH_LINES and k < i and k < before and fetched[i - 1 - k] == lines[before - 1 - k]:
+                k += 1
+            score = (k == self.MATCH_LINES or k == i or k == before, k)
+            if score > best_score:
+                best, best_score = i, score
+                if k == self.MATCH_LINES:
+                    break
+        return best
+
+
+class LogCompactor:
+    """Shrinks terminal output before it is sent, in linear time.
+
+    ``compact`` runs these passes over the lines:
+    - strip ANSI escapes, and keep only the final state of carriage-return redraws;
+    - collapse runs of similar lines (same text once digits are ignored, e.g. progress
+      bars) to the first and last line plus a count;
+    - collapse blocks of up to ``MAX_PERIOD`` lines repeated back to back (loops,
+      recursive stack frames) to one copy plus a count, or to the first and last copy
+      when the block contains an error;
+    - keep the first and last occurrence of each repeated error line or traceback and
+      drop the ones in between.
+    ``fit`` then trims the result to a token budget, keeping the latest output and the
+    lines around errors ahead of the rest.
+    """
+
+    ANSI_RE = re.compile(r"\x1b\[[0-?]*[ -/]*[@-~]|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)|\x1b[@-Z\\-_]")
+    CTRL_RE = re.compile(r"[\x00-\x08\x0b-\x1f\x7f]")
+    KEY_RE = re.compile(r"\d+|(\W)\1+|\s+")
+    ERROR_RE = re.compile(r"\b(?:error|exception|traceback|fatal|failed|failure|panic|segmentation fault|"
+                          r"assertion|denied|not found|cannot|undefined)\b|\bE\d{3,}\b|[a-z](?:Error|Exception)\b", re.I)
+    MAX_PERIOD = 8
+    # Lines kept before/after an error line when trimming to a budget
+    CONTEXT_BEFORE = 3
+    CONTEXT_AFTER = 8
+
+    @classmethod
+    def _key(cls, line: str) -> str:
+        return cls.KEY_RE.sub(lambda m: m.group(1) or ("#" if m.group(0)[0].isdigit() else " "), line).strip()
+
+    @classmethod
+    def clean(cls, text: str) -> list[str]:
+        out: list[str] = []
+        for line in text.split("\n"):
+            if "\x1b" in line:
+                line = cls.ANSI_RE.sub("", line)
+            if "\r" in line:
+                # A redrawn line (progress bar, spinner) ends up showing its last non-empty state
+                parts = [p for p in line.split("\r") if p.strip()]
+                line = parts[-1] if parts else ""
+            out.append(cls.CTRL_RE.sub("", line).rstrip())
+        return out
+
+    @classmethod
+    def _similar_runs(cls, lines: list[str]) -> list[str]:
+        out: list[str] = []
+        i, n = 0, len(lines)
+        while i < n:
+            key = cls._key(lines[i])
+            j = i + 1
+            while j < n and cls._key(lines[j]) == key:
+                j += 1
+            run = j - i
+            if not key:
+                out.append("")
+            elif run <= 2:
+                out.extend(lines[i:j])
+            else:
+                out.extend((lines[i], f"[... {run - 2} similar lines]", lines[j - 1]))
+            i = j
+        return out
+
+    @classmethod
+    def _repeated_blocks(cls, lines: list[str]) -> list[str]:
+        keys = [cls._key(l) for l in lines]
+        out: list[str] = []
+        i, n = 0, len(lines)
+        while i < n:
+            for p in range(2, cls.MAX_PERIOD + 1):
+                if i + 2 * p > n or keys[i:i + p] != keys[i + p:i + 2 * p] or not any(keys[i:i + p]):
+                    continue
+                reps = 2
+                while keys[i + reps * p:i + (reps + 1) * p] == keys[i:i + p]:
+                    reps += 1
+                out.extend(lines[i:i + p])
+                if any(cls.ERROR_RE.search(l) for l in lines[i:i + p]):
+                    # An error repeated in a loop: keep its last copy too, the numbers may differ
+                    if reps > 2:
+                        out.append(f"[... previous {p} lines repeated {reps - 2} more time{'s' if reps > 3 else ''}; "
+                                   f"the last repetition follows]")
+                    out.extend(lines[i + (reps - 1) * p:i + reps * p])
+                else:
+                    out.append(f"[... previous {p} lines repeated {reps - 1} more time{'s' if reps > 2 else ''}]")
+                i += reps * p
+                break
+            else:
+                out.append(lines[i])
+                i += 1
+        return out
+
+    @classmethod
+    def _error_units(cls, lines: list[str]) -> list[tuple[int, int]]:
+        """(start, end) of each Python traceback and each other error line."""
+        units: list[tuple[int, int]] = []
+        i, n = 0, len(lines)
+        while i < n:
+            if lines[i].startswith("Traceback (most recent call last)"):
+                j = i + 1
+                while j < n and (lines[j][:1].isspace() or lines[j].startswith("[...")):
+                    j += 1
+                units.append((i, min(j + 1, n)))
+                i = min(j + 1, n)
+                continue
+            if cls.ERROR_RE.search(lines[i]):
+                units.append((i, i + 1))
+            i += 1
+        return units
+
+    @classmethod
+    def _first_and_last_errors(cls, lines: list[str]) -> list[str]:
+        units = cls._error_units(lines)
+        keys = ["\n".join(cls._key(l) for l in lines[s:e]) for s, e in units]
+        total: dict[str, int] = {}
+        for k in keys:
+            total[k] = total.get(k, 0) + 1
+        seen: dict[str, int] = {}
+        drop: dict[int, int] = {}  # unit start -> unit end, for the middle occurrences
+        note: dict[int, int] = {}  # start of a last occurrence -> occurrences dropped before it
+        for (s, e), k in zip(units, keys):
+            seen[k] = seen.get(k, 0) + 1
+            if 1 < seen[k] < total[k]:
+                drop[s] = e
+            elif seen[k] == total[k] > 2:
+                note[s] = total[k] - 2
+        if not drop:
+            return lines
+        out: list[str] = []
+        i = 0
+        while i < len(lines):
+            if i in drop:
+                i = drop[i]
+                continue
+            if i in note:
+                out.append(f"[... {note[i]} earlier occurrence{'s' if note[i] > 1 else ''} of the following omitted]")
+            out.append(lines[i])
+            i += 1
+        return out
+
+    @classmethod
+    def compact(cls, text: str) -> str:
+        lines = cls.clean(text)
+        lines = cls._similar_runs(lines)
+        lines = cls._repeated_blocks(lines)
+        lines = cls._first_and_last_errors(lines)
+        return "\n".join(lines).strip("\n")
+
+    @classmethod
+    def fit(cls, text: str, tokens: int, estimate) -> str:
+        """Lines of ``text`` within ``tokens``: the latest output first, then the first and last
+        error with their surroundings, then other errors, then older output."""
+        lines = text.split("\n")
+        costs = [estimate(l) + 1 for l in lines]
+        if sum(costs) <= tokens:
+            return text
+        n = len(lines)
+        keep = [False] * n
+        used = estimate("[... N lines omitted]") * 4
+
+        def take(start: int, end: int, step: int = 1) -> bool:
+            nonlocal used
+            for i in range(start, end, step):
+                if keep[i]:
+                    continue
+                if used + costs[i] > tokens:
+                    return False
+                keep[i] = True
+                used += costs[i]
+            return True
+
+        # The latest lines (up to 40% of the budget)
+        tail_budget = tokens * 2 // 5
+        i = n - 1
+        while i >= 0 and used + costs[i] <= tail_budget:
+            keep[i] = True
+            used += costs[i]
+            i -= 1
+        errors = [i for i, l in enumerate(lines) if cls.ERROR_RE.search(l)]
+        order = errors[:1] + errors[-1:] + errors[-2:0:-1]
+        for e in order:
+            if not take(max(0, e - cls.CONTEXT_BEFORE), min(n, e + cls.CONTEXT_AFTER + 1)):
+                break
+        take(n - 1, -1, -1)
+        out: list[str] = []
+        gap = 0
+        for i in range(n):
+            if keep[i]:
+                if gap:
+                    out.append(f"[... {gap} lines omitted]")
+                    gap = 0
+                out.append(lines[i])
+            else:
+                gap += 1
+        if gap:
+            out.append(f"[... {gap} lines omitted]")
+        return "\n".join(out)
+
+
+# ------------------------------------------------------------------ ASYNC ENGINE
+# Cancellation token of the engine job running the current code. Context variables are
+# copied into asyncio.to_thread workers, so blocking helpers can check it too.
+_job_cancel_event: contextvars.ContextVar[threading.Event | None] = contextvars.ContextVar(
+    "magicinput_job_cancel", default=None)
+
+
+def cancel_requested() -> bool:
+    """True if the engine job this code runs for has been cancelled (safe in worker threads)."""
+    event = _job_cancel_event.get()
+    return event is not None and event.is_set()
+
+
+class EngineJob:
+    """Handle for work submitted to GeminiEngine; ``cancel`` is safe from any thread.
+
+    Cancelling sets ``cancel_event`` (seen by blocking helpers via ``cancel_requested``)
+    and cancels the coroutine, which closes its open streams and frees its API slots.
+    """
+
+    def __init__(self, future: concurrent.futures.Future, name: str = "", cancel_event: threading.Event | None = None):
+        self.future = future
+        self.name = name
+        self.cancel_event = cancel_event or threading.Event()
+
+    def cancel(self) -> None:
+        self.cancel_event.set()
+        self.future.cancel()
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def cancelled(self) -> bool:
+        return self.future.cancelled()
+
+    def result(self, timeout: float | None = None) -> Any:
+        return self.future.result(timeout)
+
+
+class GeminiEngine:
+    """One asyncio event loop on a dedicated thread that runs every Gemini call.
+
+    Calls use the async client (``client.aio``) from a per-key pool, so a key
+    switch never replaces a client that another request is still using. Each
+    call asks the ``GeminiKeyScheduler`` for the key with the most headroom and
+    waits (up to ``max_queue_wait_s``) when every key is exhausted.
+    ``max_concurrency`` bounds the number of API calls in flight; whole jobs are
+    cheap coroutines and may fan out into several calls. Results are handed
+    back through ``dispatch`` (``InputPopup.call_tk`` in the GUI).
+    """
+
+    HEDGE_MIN_SAMPLES = 5
+    HEDGE_DEFAULT_DELAY_S = 4.0
+    HEDGE_MIN_DELAY_S = 0.5
+    # Longest per-operation deadline the Settings allow
+    RETIRED_CLIENT_GRACE_S = 900.0
+
+    def __init__(self, client_factory, keys_provider, scheduler: GeminiKeyScheduler | None = None,
+                 on_rate_limited=None, max_concurrency: int = 4, max_queue_wait_s: float = 20.0, log=None,
+                 retry_policy: GeminiRetryPolicy | None = None):
+        self._client_factory = client_factory
+        self._keys_provider = keys_provider
+        self.scheduler = scheduler or GeminiKeyScheduler(log=log)
+        self.retry_policy = retry_policy or GeminiRetryPolicy()
+        # Hedged streams: start a backup call on another key when the first token is later
+        # than this percentile of recent time-to-first-token samples
+        self.hedge_enabled = False
+        self.hedge_percentile = 0.9
+        self._ttft_samples: list[float] = []
+        self._on_rate_limited = on_rate_limited or (lambda key: None)
+        self.max_queue_wait_s = max_queue_wait_s
+        self._log = log or (lambda *a, **k: None)
+        self._clients: dict[str, Any] = {}
+        self._clients_lock = threading.Lock()
+        self._max_concurrency = max(1, int(max_concurrency))
+        self._sem: asyncio.Semaphore | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
+        self._ready = threading.Event()
+
+    # ---------- lifecycle ----------
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run_loop, name="gemini-engine", daemon=True)
+        self._thread.start()
+        self._ready.wait(5)
+
+    def _run_loop(self) -> None:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._loop = loop
+        self._sem = asyncio.Semaphore(self._max_concurrency)
+        self._ready.set()
+        try:
+            loop.run_forever()
+        finally:
+            try:
+                pending = asyncio.all_tasks(loop)
+                for task in pending:
+                    task.cancel()
+                if pending:
+                    loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            except Exception:
+                pass
+            loop.close()
+
+    def stop(self) -> None:
+        loop = self._loop
+        if loop is not None and loop.is_running():
+            loop.call_soon_threadsafe(loop.stop)
+
+    # ---------- clients ----------
+    def client_for(self, api_key: str):
+        with self._clients_lock:
+            client = self._clients.get(api_key)
+            if client is None:
+                client = self._client_factory(api_key)
+                self._clients[api_key] = client
+            return client
+
+    def reset_clients(self, keep: Sequence[str] | None = None) -> None:
+        """Drop pooled clients except those for ``keep`` (all, e.g. after the endpoint changed).
+
+        In-flight calls keep theirs; the dropped clients are closed once calls that may
+        still hold them are past any deadline (``RETIRED_CLIENT_GRACE_S``).
+        """
+        with self._clients_lock:
+            drop = [k for k in self._clients if keep is None or k not in keep]
+            retired = [self._clients.pop(k) for k in drop]
+        loop = self._loop
+        if retired and loop is not None and loop.is_running():
+            asyncio.run_coroutine_threadsafe(self._close_clients(retired, self.RETIRED_CLIENT_GRACE_S), loop)
+
+    @staticmethod
+    async def _close_clients(clients: list[Any], delay: float) -> None:
+        await asyncio.sleep(delay)
+        for client in clients:
+            aio = getattr(client, "aio", None)
+            try:
+                if aio is not None and hasattr(aio, "aclose"):
+                    await aio.aclose()
+                if hasattr(client, "close"):
+                    client.close()
+            except Exception:
+                pass
+
+    # ---------- submission ----------
+    def submit(self, coro_fn, *, name: str = "", timeout: float | None = None, dispatch=None,
+               on_result=None, on_error=None, on_cancel=None, on_done=None) -> EngineJob:
+        """Run ``coro_fn()`` on the engine loop; callbacks are delivered through ``dispatch``."""
+        if self._loop is None:
+            self.start()
+        deliver = dispatch or (lambda func, delay=0: func())
+        cancel_event = threading.Event()
+
+        async def _runner():
+            _job_cancel_event.set(cancel_event)
+            try:
+                if timeout:
+                    result = await asyncio.wait_for(coro_fn(), timeout)
+                else:
+                    result = await coro_fn()
+            except asyncio.CancelledError:
+                cancel_event.set()
+                if on_cancel is not None:
+                    deliver(on_cancel)
+                raise
+            except asyncio.TimeoutError:
+                # The deadline cancelled the work; let blocking helpers notice too
+                cancel_event.set()
+                err = TimeoutError(f"{name or 'request'} timed out after {timeout:.0f}s")
+                self._log(str(err))
+                if on_error is not None:
+                    deliver(lambda: on_error(err))
+                return None
+            except Exception as e:
+                self._log(f"Engine job '{name}' failed: {e}", e)
+                if on_error is not None:
+                    # Bind now: ``e`` is unbound once this except block ends, before deliver runs it
+                    deliver(lambda e=e: on_error(e))
+                return None
+            else:
+                if on_result is not None:
+                    deliver(lambda: on_result(result))
+                return result
+            finally:
+                if on_done is not None:
+                    deliver(on_done)
+
+        future = asyncio.run_coroutine_threadsafe(_runner(), self._loop)  # type: ignore[arg-type]
+        return EngineJob(future, name, cancel_event)
+
+    def run_sync(self, coro_fn, timeout: float | None = None) -> Any:
+        """Block the calling (non-engine) thread until ``coro_fn()`` finishes and return its result."""
+        if self._loop is None:
+            self.start()
+
+        async def _runner():
+            if timeout:
+                return await asyncio.wait_for(coro_fn(), timeout)
+            return await coro_fn()
+
+        return asyncio.run_coroutine_threadsafe(_runner(), self._loop).result()  # type: ignore[arg-type]
+
+    # ---------- calls (run on the engine loop) ----------
+    async def _acquire_key(self, tokens: int) -> str:
+        """Pick the key with the most headroom, waiting for one to free up if needed."""
+        while True:
+            keys = list(self._keys_provider())
+            if not keys:
+                raise RuntimeError("Gemini client not configured. Please set API key.")
+            key, wait = self.scheduler.acquire(keys, tokens)
+            if key is not None:
+                return key
+            if wait > self.max_queue_wait_s:
+                raise RuntimeError(f"All Gemini API keys are rate limited; the next one frees up in {wait:.0f}s")
+            self._log(f"All keys at their limit; waiting {wait:.1f}s")
+            await asyncio.sleep(wait)
+
+    def _rate_limited(self, key: str, err: Exception) -> bool:
+        """Record a 429 against ``key``; returns False if ``err`` is not a rate limit."""
+        info = GeminiKeyScheduler.rate_limit_info(err)
+        if info is None:
+            return False
+        self.scheduler.record_rate_limit(key, info)
+        self._on_rate_limited(key)
+        return True
+
+    def _hedge_delay(self) -> float:
+        """Seconds to wait for a first token before hedging (the configured TTFT percentile)."""
+        samples = sorted(self._ttft_samples)
+        if len(samples) < self.HEDGE_MIN_SAMPLES:
+            return self.HEDGE_DEFAULT_DELAY_S
+        idx = min(len(samples) - 1, int(self.hedge_percentile * len(samples)))
+        return max(self.HEDGE_MIN_DELAY_S, samples[idx])
+
+    def _record_ttft(self, seconds: float) -> None:
+        self._ttft_samples.append(seconds)
+        del self._ttft_samples[:-50]
+
+    async def _open_to_first_text(self, open_stream, key: str):
+        """Take a concurrency slot, open a stream on ``key`` and read up to its first text.
+
+        Returns ``(chunks, first_chunk_or_None)`` with the slot still held; the caller
+        must close ``chunks`` and release the slot. On error or cancellation both are
+        cleaned up here.
+        """
+        await self._sem.acquire()  # type: ignore[union-attr]
+        chunks = None
+        try:
+            chunks = await open_stream(self.client_for(key), key)
+            async for chunk in chunks:
+                if getattr(chunk, "text", None):
+                    return chunks, chunk
+            return chunks, None
+        except BaseException:
+            if chunks is not None:
+                await self._close_stream(chunks)
+            self._sem.release()  # type: ignore[union-attr]
+            raise
+
+    @staticmethod
+    async def _close_stream(chunks) -> None:
+        aclose = getattr(chunks, "aclose", None)
+        if aclose is not None:
+            try:
+                await aclose()
+            except Exception:
+                pass
+
+    async def _first_text_hedged(self, open_stream, key: str, tokens: int):
+        """Like _open_to_first_text, but race a second key if the first is slow to answer.
+
+        Returns ``(key, chunks, first_chunk)`` for whichever call produced text first;
+        the other is cancelled. If both fail, the first call's error is raised.
+        """
+        primary = asyncio.ensure_future(self._open_to_first_text(open_stream, key))
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=self._hedge_delay())
+            backup_key = None
+            if not done:
+                backup_key, _wait = self.scheduler.acquire(list(self._keys_provider()), tokens, exclude=(key,))
+            if backup_key is None:
+                chunks, first = await primary
+                return key, chunks, first
+        except asyncio.CancelledError:
+            primary.cancel()
+            raise
+
+        self._log(f"No first token after {self._hedge_delay():.1f}s; hedging on a second key")
+        backup = asyncio.ensure_future(self._open_to_first_text(open_stream, backup_key))
+        owners = {primary: key, backup: backup_key}
+        pending = set(owners)
+        winner = None
+        try:
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None and winner is None:
+                        winner = task
+                    elif task.exception() is None:
+                        # Both answered in the same tick: drop the slower one
+                        chunks, _ = task.result()
+                        await self._close_stream(chunks)
+                        self._sem.release()  # type: ignore[union-attr]
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        if winner is None:
+            backup_err = backup.exception()
+            if backup_err is not None:
+                self._rate_limited(backup_key, backup_err)
+            raise primary.exception()  # type: ignore[misc]
+        self._log(f"Hedged call won by {'backup' if winner is backup else 'primary'} key")
+        chunks, first = winner.result()
+        return owners[winner], chunks, first
+
+    async def stream(self, open_stream, on_chunk, tokens: int = 0, hedge: bool = False) -> bool:
+        """Stream text from ``await open_stream(client, key)``. Returns True if any text was received.
+
+        Until the first chunk arrives, rate limits move the call to another key and
+        transient errors are retried with jittered backoff; after that nothing is
+        retried, so output is never duplicated. ``tokens`` is the estimated request
+        size used for TPM accounting. ``hedge`` (interactive calls, when enabled)
+        races a second key if the first token is unusually late.
+        """
+        reschedules = max(1, len(list(self._keys_provider())))
+        retries = 0
+        while True:
+            key = await self._acquire_key(tokens)
+            started = time.monotonic()
+            try:
+                if hedge and self.hedge_enabled:
+                    key, chunks, first = await self._first_text_hedged(open_stream, key, tokens)
+                else:
+                    chunks, first = await self._open_to_first_text(open_stream, key)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if reschedules > 0 and self._rate_limited(key, e):
+                    reschedules -= 1
+                    self._log(f"Rate limited; rescheduling on another key: {e}")
+                    continue
+                if retries < self.retry_policy.max_retries and self.retry_policy.is_retryable(e):
+                    delay = self.retry_policy.backoff(retries)
+                    retries += 1
+                    self._log(f"Transient error; retry {retries}/{self.retry_policy.max_retries} in {delay:.1f}s: {e}")
+                    await asyncio.sleep(delay)
+                    continue
+                raise
+            if first is not None:
+                self._record_ttft(time.monotonic() - started)
+            usage = None
+            received = False
+            try:
+                if first is not None:
+                    usage = getattr(first, "usage_metadata", None)
+                    received = True
+                    on_chunk(first.text)
+                    async for chunk in chunks:
+                        usage = getattr(chunk, "usage_metadata", None) or usage
+                        txt = getattr(chunk, "text", None)
+                        if txt:
+                            on_chunk(txt)
+            finally:
+                await self._close_stream(chunks)
+                self._sem.release()  # type: ignore[union-attr]
+            self.scheduler.record_success(key, tokens, getattr(usage, "total_token_count", None))
+            return received
+
+    async def generate(self, make_call, tokens: int = 0) -> Any:
+        """Run ``await make_call(client, key)`` with the same key scheduling and retries as ``stream``."""
+        reschedules = max(1, len(list(self._keys_provider())))
+        retries = 0
+        while True:
+            key = await self._acquire_key(tokens)
+            client = self.client_for(key)
+            try:
+                async with self._sem:  # type: ignore[union-attr]
+                    result = await make_call(client, key)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if reschedules > 0 and self._rate_limited(key, e):
+                    reschedules -= 1
+                    self._log(f"Rate limited; rescheduling on another key: {e}")
+                    continue
+                if retries < self.retry_policy.max_retries and self.retry_policy.is_retryable(e):
+                    delay = self.retry_policy.backoff(retries)
+                    retries += 1
+                    self._log(f"Transient error; retry {retries}/{self.retry_policy.max_retries} in {delay:.1f}s: {e}")
+                    await asyncio.sleep(delay)
+                    continue
+                raise
+            usage = getattr(result, "usage_metadata", None)
+            self.scheduler.record_success(key, tokens, getattr(usage, "total_token_count", None))
+            return result
+
+
+# ------------------------------------------------------------------ CONFIG FILE
+def write_config_file(path: str, data: dict[str, Any]) -> None:
+    """Write ``config.json`` through a temp file so a reader (or a second writer) never sees it half-written."""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
 class InputPopup:
     """A small, centred popup window that lets the user attach images and enter text/code."""
 
     CANVAS_HEIGHT = 160
+    # Upper bound on what is read before the token budgeter trims it (attached files: FileContextExtractor)
+    MAX_BRIEF_CHARS = 400_000
+    # Share of the context budget the project brief may take when ranked excerpts are sent too
+    BRIEF_BUDGET_SHARE = 0.25
+    # Ranked project chunks / past prompts considered for the PROJECT OVERVIEW / PREVIOUS INTERACTIONS sections
+    PROJECT_TOP_K = 12
+    PAST_PROMPTS_TOP_K = 8
+    # PROJECT OVERVIEW leads with this many raw excerpts, then summaries of up to
+    # PROJECT_SUMMARY_FILES other relevant files, then the remaining excerpts
+    PROJECT_RAW_LEAD = 4
+    PROJECT_SUMMARY_FILES = 20
+    # Files summarized by the model per background job, and how much of each is sent
+    SUMMARY_BATCH = 5
+    SUMMARY_INPUT_CHARS = 24_000
+    # Captured terminal output older than this is not sent
+    TERMINAL_CAPTURE_MAX_AGE_S = 6 * 3600
 
     def __init__(self, root: tk.Tk):
         self.root = root
@@ -159,7 +3129,10 @@ class InputPopup:
         self.legacy_log_path = os.path.join(self.attachments_dir, "magicinput.log")
         # Prompt log paths
         self.prompt_log_path = os.path.join(self.attachments_dir, "MagicInput Prompt.txt")
-        self.archive_path = os.path.join(self.attachments_dir, "Prompts Archive.txt")
+        # Append-only prompt archive (segments + offset index); migrates the old single-file archive once
+        self.prompt_archive = PromptArchive(os.path.join(self.attachments_dir, "Prompts Archive"),
+                                            legacy_path=os.path.join(self.attachments_dir, "Prompts Archive.txt"),
+                                            log=self._log_debug)
         # Waiting placeholder text (keep wording as requested)
         self.waiting_placeholder = "sill waiting form user's prompt so run the command \"timeout 30\"."
         # Config file path for API keys
@@ -172,6 +3145,65 @@ class InputPopup:
         self.model_name: str = "gemini-2.5-flash"
         # Whether to automatically refine the prompt before sending
         self.auto_refine: bool = False
+        # Upload images once through the Files API and reference them by URI
+        self.use_files_api: bool = True
+        # Cache the stable project brief block with Gemini context caching
+        self.use_context_cache: bool = True
+        # Optional API endpoint override (e.g. a local stand-in server for testing)
+        # (MAGICINPUT_GEMINI_BASE_URL in the environment takes precedence)
+        self.gemini_base_url: str = ""
+        # Per-operation deadlines (seconds) after which an AI call is abandoned
+        self.ai_deadlines_s: dict[str, float] = {"visionize": 180.0, "refine": 90.0}
+        # Max API calls in flight
+        self.ai_max_concurrency: int = 4
+        # Speculative Visionize: analyze in the background after an idle period (opt-in)
+        self.speculative_visionize: bool = False
+        self.speculative_idle_s: float = 4.0
+        self.speculative_tokens_per_hour: int = 100_000
+        self._speculation: SpeculativeRun | None = None
+        self._speculative_spend: list[tuple[float, int]] = []
+        # Model-written file summaries: token budget per hour (0 = local outlines only)
+        self.summary_tokens_per_hour: int = 50_000
+        self._summary_spend: list[tuple[float, int]] = []
+        self._summary_lock = threading.Lock()
+        self._speculative_lock = threading.Lock()
+        # Combine mode: generate Describe and Plan concurrently instead of in one call
+        self.parallel_combine: bool = True
+        # Token budget for the context sent with Visionize/Refine, optionally checked with count_tokens
+        self.context_budget_tokens: int = 32_000
+        self.verify_token_counts: bool = False
+        self.budgeter = ContextBudgeter(self.context_budget_tokens)
+        # Bounded reads of attached files: the snippet's lines plus this many on each side
+        self.file_extractor = FileContextExtractor(margin_lines=60)
+        # Output of terminals run under ``--capture``; Visionize takes the last N KB of it
+        self.terminal_ring_path = os.path.join(self.attachments_dir, TerminalRing.FILENAME)
+        self.terminal_capture_kb: int = 32
+        # tmux pane / screen session picked in the terminal dialog, re-captured at each Visionize
+        self.terminal_scrollback = MultiplexerScrollback(log=self._log_debug)
+        self.terminal_pane: str | None = None
+        # BM25 index of the project's files for the PROJECT OVERVIEW context (built on first use)
+        self.project_index: ProjectIndex | None = None
+        # Term index of archived prompts for PREVIOUS INTERACTIONS (parsed on first use)
+        self.prompt_history: PromptHistory | None = None
+        # Content-hash keyed summaries of project files (outlines, upgraded by the model in the background)
+        self.file_summaries: FileSummaryCache | None = None
+        # Staged/unstaged diff of the project repository for GIT CHANGES (cached until something changes)
+        self.git_changes = GitChanges(self.app_dir, log=self._log_debug)
+        self._summary_job: EngineJob | None = None
+        # Context pieces memoized on file mtimes, gathered concurrently off the Tk thread
+        self.context_memo = StatMemo()
+        self._context_pool: concurrent.futures.ThreadPoolExecutor | None = None
+        # Latency profile per action: "auto" (by input size), "fast", "balanced" or "thorough"
+        self.latency_profiles = LatencyProfiles()
+        self.ai_profiles: dict[str, str] = {"visionize": "balanced", "refine": "balanced"}
+        # Running AI jobs by operation name; the Cancel button / Escape cancels them
+        self._ai_jobs: dict[str, EngineJob] = {}
+        # Retries for transient (5xx/timeout) failures, and optional hedging of slow interactive calls
+        self.ai_max_retries: int = 2
+        self.hedge_requests: bool = False
+        self.hedge_percentile: float = 0.9
+        # Learned per-key quota limits and cooldowns (see GeminiKeyScheduler)
+        self.key_scheduler = GeminiKeyScheduler(log=self._log_debug)
 
         # Ensure logs show up at startup
         try:
@@ -194,6 +3226,23 @@ class InputPopup:
                         else None)
 
         # Configure Gemini client
+        self.upload_manager = GeminiUploadManager(log=self._log_debug)
+        self.upload_manager.enabled = self.use_files_api
+        self.context_cache = GeminiContextCache(log=self._log_debug)
+        self.context_cache.enabled = self.use_context_cache
+        # All Gemini calls run on one asyncio loop; the Tk thread only receives results
+        self.engine = GeminiEngine(
+            self._make_gemini_client,
+            self._ordered_api_keys,
+            scheduler=self.key_scheduler,
+            on_rate_limited=lambda key: self.call_tk(lambda: self._advance_past_key(key)),
+            max_concurrency=self.ai_max_concurrency,
+            log=self._log_debug,
+            retry_policy=GeminiRetryPolicy(max_retries=self.ai_max_retries),
+        )
+        self.engine.hedge_enabled = self.hedge_requests
+        self.engine.hedge_percentile = self.hedge_percentile
+        self.engine.start()
         self._configure_gemini_client()
         self.file_paths: list[str] = []
         self.file_meta: dict[str, tuple[int,int,int]] = {}
@@ -219,19 +3268,8 @@ class InputPopup:
                 with open(self.prompt_log_path, "r", encoding="utf-8", errors="ignore") as f:
                     prev = f.read().strip()
                 if prev and prev != self.waiting_placeholder:
-                    sep = "\n" + ("-" * 50) + "\n"
                     timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    new_entry = f"[{timestamp}] (from previous session)\n{prev}{sep}"
-                    # Read existing archive content and prepend new entry at the top
-                    existing_content = ""
-                    try:
-                        if os.path.isfile(self.archive_path):
-                            with open(self.archive_path, "r", encoding="utf-8", errors="ignore") as f2:
-                                existing_content = f2.read()
-                    except Exception:
-                        existing_content = ""
-                    with open(self.archive_path, "w", encoding="utf-8") as arch:
-                        arch.write(new_entry + existing_content)
+                    self.prompt_archive.append(f"[{timestamp}] (from previous session)", prev)
         except Exception:
             pass # Ignore errors during this pre-flight check
 
@@ -614,6 +3652,12 @@ class InputPopup:
                                bg=self.current_theme["accent_orange"], 
                                fg=self.current_theme["text_primary"], 
                                relief="flat", command=self._refine_prompt)
+        # Shown only while an AI operation is running
+        self.cancel_ai_btn = tk.Button(self.btn_frame, text="Cancel",
+                               font=self.button_font,
+                               bg=self.current_theme["button_danger"],
+                               fg=self.current_theme["text_primary"],
+                               relief="flat", command=self._cancel_ai_operations)
         # Dedicated Describe controls section (below image toolbar)
         self.describe_controls_frame = tk.Frame(self.root, bg=self.current_theme["bg_primary"])
 
@@ -716,6 +3760,20 @@ class InputPopup:
             command=self._on_prefs_changed
         )
 
+        # Off unless chosen: uncommitted diffs may hold things not meant for the API
+        self.include_git_var = tk.BooleanVar(value=False)
+        self.include_git_chk = tk.Checkbutton(
+            self.ctx_frame,
+            text="Git changes",
+            variable=self.include_git_var,
+            bg=self.current_theme["bg_primary"],
+            fg=self.current_theme["text_primary"],
+            selectcolor=self.current_theme["bg_primary"],
+            activebackground=self.current_theme["bg_primary"],
+            activeforeground=self.current_theme["text_primary"],
+            command=self._on_prefs_changed
+        )
+
         self.include_terminal_var = tk.BooleanVar(value=True)
         self.include_terminal_chk = tk.Checkbutton(
             self.ctx_frame,
@@ -811,6 +3869,7 @@ class InputPopup:
         self.include_context_chk.pack(side=tk.LEFT, padx=(0,8))
         self.include_project_chk.pack(side=tk.LEFT, padx=(0,8))
         self.include_archive_chk.pack(side=tk.LEFT, padx=(0,8))
+        self.include_git_chk.pack(side=tk.LEFT, padx=(0,8))
         self.include_terminal_chk.pack(side=tk.LEFT, padx=(0,8))
         self.include_footer_chk.pack(side=tk.LEFT, padx=(0,8))
 
@@ -842,6 +3901,8 @@ class InputPopup:
         # ------------------------------------------------------------------ KEYBOARD SHORTCUTS
         # Ctrl+Enter -> Send
         self.root.bind_all('<Control-Return>', lambda e: self._send_and_close())
+        # Escape -> cancel running Visionize/Refine
+        self.root.bind('<Escape>', lambda e: self._cancel_ai_operations())
         # Ctrl+V -> Paste image from clipboard
         self.root.bind_all('<Control-v>', lambda e: self._paste_clipboard_image())
 
@@ -849,7 +3910,7 @@ class InputPopup:
         """Enable/disable per-context toggles based on Include context."""
         try:
             state = tk.NORMAL if self.include_context_var.get() else tk.DISABLED
-            for chk in (self.include_project_chk, self.include_archive_chk, self.include_terminal_chk):
+            for chk in (self.include_project_chk, self.include_archive_chk, self.include_git_chk, self.include_terminal_chk):
                 chk.config(state=state)
             term_btn_state = tk.NORMAL if (self.include_context_var.get() and self.include_terminal_var.get()) else tk.DISABLED
             self.terminal_ctx_btn.config(state=term_btn_state)
@@ -909,6 +3970,8 @@ class InputPopup:
         # Show generic image labels without any file paths
         parts.extend(f"🖼 Image {i+1}" for i in range(len(self.images)))
         self.attach_summary_var.set("  |  ".join(parts))
+        # Attachments changed: restart the idle timer for speculative Visionize
+        self._schedule_speculation()
 
     def _add_image(self) -> None:
         paths = filedialog.askopenfilenames(title="Select image(s)", filetypes=[("Images", "*.png *.jpg *.jpeg *.gif *.bmp")])
@@ -1223,56 +4286,19 @@ class InputPopup:
             self.root.after(0, lambda: messagebox.showwarning("Visionize & Send","Please add an image, attach files, or enter a prompt to analyze."))
             return
 
-        # Create a modified callback that will send and close after describe completes
-        def visionize_complete_callback():
-            # Small delay to ensure the describe result is fully processed
-            self.root.after(500, self._send_and_close)
-
-        # Start visionize in background thread, then trigger send & close when done
-        threading.Thread(target=self._visionize_and_send_thread, args=(visionize_complete_callback,)).start()
-
-    def _visionize_and_send_thread(self, callback) -> None:
-        """Execute visionize in background thread and call callback when done"""
-        try:
-            # Get the current settings similar to _describe_image
-            try:
-                include_ctx = self.include_context_var.get()
-            except Exception:
-                include_ctx = True
-
-            enhanced_context = {}
-            if include_ctx:
-                if getattr(self, 'include_project_var', None) and self.include_project_var.get():
-                    enhanced_context['project'] = True
-                if getattr(self, 'include_archive_var', None) and self.include_archive_var.get():
-                    enhanced_context['archive'] = True
-                if getattr(self, 'include_terminal_var', None) and self.include_terminal_var.get():
-                    enhanced_context['terminal'] = True
-
-            try:
-                user_prompt = self.text_input.get("1.0", tk.END).strip()
-            except Exception:
-                user_prompt = ""
-
-            try:
-                mode = self.mode_var.get()
-            except Exception:
-                mode = "plan"
-
-            # Execute the describe image functionality
-            self._describe_image_thread(mode, user_prompt, include_ctx, enhanced_context)
-            
-            # Call the completion callback on main thread
-            self.root.after(0, callback)
-
-        except Exception as e:
-            self._log_debug(f"Error in visionize_and_send_thread: {e}", e)
-            # Still call callback even if there was an error
-            self.root.after(0, callback)
+        # Send and close once the streamed description has landed in the prompt;
+        # the small delay lets the final flush settle
+        self._describe_image(on_complete=lambda: self.root.after(500, self._send_and_close))
 
     # ------------------------------------------------------------------ CLEANUP
     def cleanup(self) -> None:
         shutil.rmtree(self.temp_dir, ignore_errors=True)
+        try:
+            self.engine.stop()
+        except Exception:
+            pass
+        if self._context_pool is not None:
+            self._context_pool.shutdown(wait=False, cancel_futures=True)
         # Stop tray icon if running
         if hasattr(self, "tray_icon") and self.tray_icon is not None:
             try:
@@ -1698,7 +4724,7 @@ class InputPopup:
         self.mode_frame.configure(bg=theme["bg_primary"])
 
         # Checkboxes
-        for chk in (self.include_context_chk, self.include_project_chk, self.include_archive_chk, self.include_terminal_chk, self.include_footer_chk):
+        for chk in (self.include_context_chk, self.include_project_chk, self.include_archive_chk, self.include_git_chk, self.include_terminal_chk, self.include_footer_chk):
             chk.configure(
                 bg=theme["bg_primary"],
                 fg=theme["text_primary"],
@@ -1723,6 +4749,7 @@ class InputPopup:
         self.visionize_btn.configure(bg=theme["accent_purple"], fg=theme["text_primary"])
         self.clear_btn.configure(bg=theme["bg_secondary"], fg=theme["text_primary"])
         self.refine_btn.configure(bg=theme["accent_orange"], fg=theme["text_primary"])
+        self.cancel_ai_btn.configure(bg=theme["button_danger"], fg=theme["text_primary"])
         self.send_btn.configure(bg=theme["accent_green"], fg=theme["text_primary"])
         self.send_close_btn.configure(bg=theme["accent_blue"], fg=theme["text_primary"])
 
@@ -1803,6 +4830,7 @@ class InputPopup:
             self.include_context_chk.configure(bg=self.current_theme["bg_primary"], fg=self.current_theme["text_primary"], selectcolor=self.current_theme["bg_primary"])
             self.include_project_chk.configure(bg=self.current_theme["bg_primary"], fg=self.current_theme["text_primary"], selectcolor=self.current_theme["bg_primary"])
             self.include_archive_chk.configure(bg=self.current_theme["bg_primary"], fg=self.current_theme["text_primary"], selectcolor=self.current_theme["bg_primary"])
+            self.include_git_chk.configure(bg=self.current_theme["bg_primary"], fg=self.current_theme["text_primary"], selectcolor=self.current_theme["bg_primary"])
             self.include_terminal_chk.configure(bg=self.current_theme["bg_primary"], fg=self.current_theme["text_primary"], selectcolor=self.current_theme["bg_primary"])
             self.terminal_ctx_btn.configure(bg=self.current_theme["bg_secondary"], fg=self.current_theme["text_primary"])
         except Exception:
@@ -1813,11 +4841,52 @@ class InputPopup:
         try:
             self.include_project_chk.config(state=state)
             self.include_archive_chk.config(state=state)
+            self.include_git_chk.config(state=state)
             self.include_terminal_chk.config(state=state)
             self.terminal_ctx_btn.config(state=state)
         except Exception:
             pass
 
+    def _captured_terminal_text(self) -> str:
+        """Tail of the ``--capture`` ring buffer, or "" if capture is off, unused or stale."""
+        if self.terminal_capture_kb <= 0 or not os.path.exists(self.terminal_ring_path):
+            return ""
+        text, stamp = TerminalRing.read_tail(self.terminal_ring_path, self.terminal_capture_kb * 1024)
+        if time.time() - stamp > self.TERMINAL_CAPTURE_MAX_AGE_S:
+            return ""
+        self._log_debug(f"Terminal context from capture: {len(text)} chars")
+        return text.strip()
+
+    def _refresh_terminal_pane(self, pane: str) -> str | None:
+        """Latest output of the followed tmux/screen pane (new lines only are fetched; worker thread).
+
+        The Tk side keeps reading ``terminal_context_buffer``; it is updated from here
+        once the capture is done. Returns None if the pane is gone.
+        """
+        text = self.terminal_scrollback.capture(pane)
+        if text is None:
+            self._log_debug(f"Terminal pane {pane} is gone")
+
+            def _forget():
+                if self.terminal_pane == pane:
+                    self.terminal_pane = None
+            self.call_tk(_forget)
+            return None
+        limit = self.terminal_capture_kb * 1024 if self.terminal_capture_kb > 0 else len(text)
+        text = text[-limit:].strip()
+
+        def _store():
+            if self.terminal_pane == pane:
+                self.terminal_context_buffer = text
+        self.call_tk(_store)
+        return text
+
+    def _terminal_context(self, raw: str, pane: str | None) -> str:
+        """Compacted terminal output; a followed pane is captured first and replaces ``raw`` (worker thread)."""
+        if pane:
+            raw = self._refresh_terminal_pane(pane) or raw
+        return self._compact_terminal(raw) if raw else ""
+
     def _open_terminal_context_dialog(self) -> None:
         try:
             txt = self._ask_terminal_context() or ""
@@ -1925,7 +4994,7 @@ class InputPopup:
         self._ac_popup.bind("<FocusIn>", lambda e: self.text_input.focus_set())
         self._ac_listbox.bind("<FocusIn>", lambda e: self.text_input.focus_set())
         # Handle navigation keys at text widget level too
-        self.text_input.bind("<Escape>", lambda e: (self._close_ac_popup(), "break"))
+        self.text_input.bind("<Escape>", lambda e: (self._close_ac_popup() if self._ac_popup else self._cancel_ai_operations(), "break"))
         self.text_input.bind("<Down>", lambda e: (self._move_ac_selection(1), "break") if self._ac_popup else None)
         self.text_input.bind("<Up>", lambda e: (self._move_ac_selection(-1), "break") if self._ac_popup else None)
         self.text_input.bind("<Return>", lambda e: (self._insert_ac_selection(), "break") if self._ac_popup else None)
@@ -2060,6 +5129,7 @@ class InputPopup:
 
             # Live extraction of @file mentions to update summary
             self._extract_mentioned_files()
+            self._schedule_speculation()
         except Exception:
             pass
 
@@ -2226,6 +5296,29 @@ class InputPopup:
         rel_path = os.path.relpath(file_path, self.app_dir)
         self.text_input.insert(tk.INSERT, f"[@{rel_path}]\n")
 
+    # ---------- AI operation tracking / cancellation ----------
+    def _track_ai_job(self, op: str, job: EngineJob) -> None:
+        """Register a running AI job so Cancel/Escape can stop it (Tk thread)."""
+        self._ai_jobs[op] = job
+        if not self.cancel_ai_btn.winfo_ismapped():
+            self.cancel_ai_btn.pack(side=tk.LEFT, padx=(5,0), pady=6, ipady=3, ipadx=8, after=self.refine_btn)
+
+    def _ai_job_finished(self, op: str, job: EngineJob) -> None:
+        if self._ai_jobs.get(op) is job:
+            del self._ai_jobs[op]
+        if not self._ai_jobs:
+            self.cancel_ai_btn.pack_forget()
+
+    def _cancel_ai_operations(self) -> None:
+        """Cancel every running AI job; their streams close and the prompt text is left untouched."""
+        jobs = [job for job in self._ai_jobs.values() if not job.done()]
+        if not jobs:
+            return
+        for job in jobs:
+            self._log_debug(f"Cancelling {job.name}")
+            job.cancel()
+        self.root.config(cursor="")
+
     def _refine_prompt(self) -> None:
         """Use Gemini AI to rewrite/refine the current prompt text."""
         if not self.api_key:
@@ -2239,93 +5332,226 @@ class InputPopup:
         self.root.config(cursor="wait")
         self.root.update()
 
-        # Run the refinement in a separate thread
-        threading.Thread(target=self._refine_prompt_thread, args=(original,)).start()
+        # The refined prompt streams into a preview pane; the editor is only touched on Accept
+        preview = self._open_refine_preview(original)
+        job = self.engine.submit(
+            lambda: self._refine_prompt_job(original, preview),
+            name="Refine",
+            timeout=self.ai_deadlines_s["refine"],
+            dispatch=self.call_tk,
+            on_error=lambda e: messagebox.showerror("Gemini Error", f"Failed to refine prompt: {e}"),
+            # Cancel from the main window (button/Escape) closes the preview like Reject
+            on_cancel=lambda: self._refine_preview_close(preview, accept=False),
+            on_done=lambda: self._ai_job_finished("refine", job),
+        )
+        preview["job"] = job
+        self._track_ai_job("refine", job)
+
+    def _latency_profile(self, action: str, requested: dict[str, int], images: int = 0) -> dict[str, Any]:
+        """Resolved latency profile for ``action``.
+
+        ``auto`` picks a tier from what the budget would grant of ``requested`` at the
+        Settings model and budget, not from the untrimmed input.
+        """
+        name = self.ai_profiles.get(action, "balanced")
+        if name == LatencyProfiles.AUTO:
+            budget = self.budgeter.budget_for(self.model_name, self.context_budget_tokens)
+            granted = sum(self.budgeter.allocate(requested, budget).values())
+            name = self.latency_profiles.choose(action, granted, images)
+        return self.latency_profiles.resolve(name, self.model_name, self.context_budget_tokens)
 
-    def _refine_prompt_thread(self, original_prompt: str) -> None:
+    def _refine_context_block(self, original_prompt: str) -> tuple[str, str, dict[str, Any]]:
+        """Attachment context for Refine, packed into the token budget.
+
+        Returns (block, budget summary, latency profile).
+        """
         context_parts: list[str] = []
         for idx, _ in enumerate(self.images):
             context_parts.append(f"Image {idx+1} attached")
-        for p in self.file_paths:
-            try:
-                with open(p, "r", encoding="utf-8", errors="ignore") as f:
-                    content = f.read()
-                context_parts.append(f"File: {os.path.basename(p)}\n---\n{content}\n---")
-            except Exception:
-                continue
-        context_block = "\n\n".join(context_parts) if context_parts else ""
-
-        try:
-            prompt_text = (
-                "You are a prompt engineer. Rewrite the USER_PROMPT into a crisp, executable prompt that explicitly captures the user's goal and context. "
-                "Use ONLY the information supplied (USER_PROMPT and ATTACHMENT_CONTEXT). Do NOT assume or hallucinate missing details. "
-                "If critical information is missing, include short TODO placeholders. Output ONLY the refined prompt, with no extra commentary.\n\n"
-                "Required structure for the refined prompt:\n"
-                "- Primary Goal: <one-sentence goal in user's terms>\n"
-                "- Desired Outcome: <concrete deliverable(s)>\n"
-                "- Success Criteria: <bulleted, measurable checks>\n"
-                "- Constraints & Preferences: <tools, style, platform, scope, timing>\n"
-                "- Non-Goals: <items out of scope if implied>\n"
-                "- Context (attachments): <brief, cite sources e.g., [File: name.ext (lines a-b)]>\n"
-                "- Unknowns / TODO: <bulleted open questions>\n"
-                "- Instruction: <clear instruction to the assistant on what to produce next>\n\n"
-                f"USER_PROMPT:\n{original_prompt}\n\n" + (f"ATTACHMENT_CONTEXT:\n{context_block}" if context_block else "")
-            )
-
-            refined = None
-            if not self.client:
-                self.root.after(0, lambda: messagebox.showerror("Gemini Error", "Gemini client not configured. Please set API key."))
-                return
-            
-            contents = cast(Any, [
-                types.Content(role="user", parts=[types.Part.from_text(text=prompt_text)])
-            ])
-            cfg = types.GenerateContentConfig(response_mime_type="text/plain")
-            # Attempt streaming with failover on rate limit
-            def _stream_call():
-                return self.client.models.generate_content_stream(model=self.model_name, contents=contents, config=cfg)  # type: ignore[arg-type]
-
-            refined_parts: list[str] = []
-            attempt = 0
-            max_attempts = max(1, len(self.api_keys))
-            while attempt < max_attempts:
-                try:
-                    chunks = _stream_call()
-                    for ch in chunks:
-                        txt = getattr(ch, "text", None)
-                        if txt:
-                            refined_parts.append(txt)
-                    break
-                except Exception as e:
-                    if self._is_rate_limit_error(e) and self._rotate_api_key():
-                        attempt += 1
-                        continue
-                    raise
-            refined = "".join(refined_parts)
+        files = self._read_attached_files()
+        budgeter = self.budgeter
+        requested = {
+            # Refine instructions are ~300 tokens on top of the prompt itself
+            "prompt": budgeter.estimate(original_prompt) + 300,
+            "files": sum(budgeter.file_tokens(f) for f in files),
+        }
+        profile = self._latency_profile("refine", requested)
+        budget = budgeter.budget_for(profile["model"], profile["context_budget_tokens"])
+        granted = budgeter.allocate(requested, budget)
+        if files and granted["files"]:
+            # Lines already quoted in the prompt (or in an earlier file) become back-references
+            dedup = ContextDeduper()
+            dedup.seed("the user prompt", original_prompt)
+            context_parts.extend(dedup.dedupe(f"attached file {f.name}", b)
+                                 for f, b in zip(files, budgeter.pack_files(files, granted["files"])))
+        block = "\n\n".join(context_parts) if context_parts else ""
+        self._log_debug(f"Refine profile={profile['name']} model={profile['model']}")
+        return block, f"{profile['name']} ({profile['model']}) · " + budgeter.summary(requested, granted, budget), profile
+
+    async def _refine_prompt_job(self, original_prompt: str, preview: dict[str, Any]) -> str:
+        """Refine on the engine loop, streaming into the preview pane. Reject cancels the job."""
+        context_block, budget_summary, profile = await asyncio.to_thread(self._refine_context_block, original_prompt)
+        prompt_text = (
+            "You are a prompt engineer. Rewrite the USER_PROMPT into a crisp, executable prompt that explicitly captures the user's goal and context. "
+            "Use ONLY the information supplied (USER_PROMPT and ATTACHMENT_CONTEXT). Do NOT assume or hallucinate missing details. "
+            "If critical information is missing, include short TODO placeholders. Output ONLY the refined prompt, with no extra commentary.\n\n"
+            "Required structure for the refined prompt:\n"
+            "- Primary Goal: <one-sentence goal in user's terms>\n"
+            "- Desired Outcome: <concrete deliverable(s)>\n"
+            "- Success Criteria: <bulleted, measurable checks>\n"
+            "- Constraints & Preferences: <tools, style, platform, scope, timing>\n"
+            "- Non-Goals: <items out of scope if implied>\n"
+            "- Context (attachments): <brief, cite sources e.g., [File: name.ext (lines a-b)]>\n"
+            "- Unknowns / TODO: <bulleted open questions>\n"
+            "- Instruction: <clear instruction to the assistant on what to produce next>\n\n"
+            f"USER_PROMPT:\n{original_prompt}\n\n" + (f"ATTACHMENT_CONTEXT:\n{context_block}" if context_block else "")
+        )
+        contents = cast(Any, [
+            types.Content(role="user", parts=[types.Part.from_text(text=prompt_text)])
+        ])
+        cfg = LatencyProfiles.generation_config(profile, response_mime_type="text/plain")
+
+        def _open(client, key):
+            return open_generation(client, profile, contents, cfg)
+
+        # Render chunks live in the preview pane
+        stream = TkTextStream(self.call_tk, lambda chunk: self._refine_preview_append(preview, chunk))
+        self.call_tk(lambda: self._start_ai_status("Refine", stream, budget_summary))
+        stream_ok = False
+        cancelled = False
+        try:
+            await self.engine.stream(_open, stream.feed, tokens=self.budgeter.estimate(prompt_text), hedge=True)
+            stream_ok = True
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            stream.close()
+            self.call_tk(lambda: self._finish_ai_status("Refine", stream, stream_ok, cancelled))
+            self.call_tk(lambda: self._refine_preview_finish(preview, stream_ok))
+            self.call_tk(lambda: self.root.config(cursor=""))
+        return stream.text
+
+    # ---------- Refine preview pane ----------
+    def _open_refine_preview(self, original: str) -> dict[str, Any]:
+        """Side-by-side Original / Refined window; the refined side fills live as chunks arrive."""
+        theme = self.current_theme
+        popup = tk.Toplevel(self.root)
+        popup.title("Refine preview")
+        popup.configure(bg=theme["bg_primary"])
+        popup.transient(self.root)
+        popup.geometry(f"900x480+{self.root.winfo_rootx() + 40}+{self.root.winfo_rooty() + 60}")
+
+        panes = tk.Frame(popup, bg=theme["bg_primary"])
+        panes.pack(fill=tk.BOTH, expand=True, padx=10, pady=(10, 6))
+        panes.columnconfigure(0, weight=1, uniform="refine")
+        panes.columnconfigure(1, weight=1, uniform="refine")
+        panes.rowconfigure(1, weight=1)
+
+        tk.Label(panes, text="Original", bg=theme["bg_primary"], fg=theme["text_secondary"], anchor="w").grid(row=0, column=0, sticky="w")
+        tk.Label(panes, text="Refined (live)", bg=theme["bg_primary"], fg=theme["text_secondary"], anchor="w").grid(row=0, column=1, sticky="w", padx=(8, 0))
+        orig_txt = scrolledtext.ScrolledText(panes, wrap=tk.WORD, font=self.text_font,
+                                             bg=theme["bg_secondary"], fg=theme["text_secondary"])
+        orig_txt.insert("1.0", original)
+        orig_txt.config(state=tk.DISABLED)
+        orig_txt.grid(row=1, column=0, sticky="nsew")
+        refined_txt = scrolledtext.ScrolledText(panes, wrap=tk.WORD, font=self.text_font,
+                                                bg=theme["bg_tertiary"], fg=theme["text_primary"],
+                                                insertbackground=theme["accent_blue"])
+        # Read-only while streaming; becomes editable once the answer is complete
+        refined_txt.config(state=tk.DISABLED)
+        refined_txt.grid(row=1, column=1, sticky="nsew", padx=(8, 0))
+
+        bar = tk.Frame(popup, bg=theme["bg_primary"])
+        bar.pack(fill=tk.X, padx=10, pady=(0, 10))
+        status_var = tk.StringVar(value="⏳ Waiting for first token…")
+        tk.Label(bar, textvariable=status_var, bg=theme["bg_primary"], fg=theme["text_secondary"], anchor="w").pack(side=tk.LEFT)
+
+        state: dict[str, Any] = {
+            "popup": popup,
+            "text": refined_txt,
+            "status_var": status_var,
+            "job": None,
+            "started": False,
+            "done": False,
+            "closed": False,
+        }
+        accept_btn = tk.Button(bar, text="Accept", state=tk.DISABLED, bg=theme["accent_green"], fg=theme["text_primary"],
+                               relief="flat", width=10, command=lambda: self._refine_preview_close(state, accept=True))
+        reject_btn = tk.Button(bar, text="Reject", bg=theme["button_danger"], fg=theme["text_primary"],
+                               relief="flat", width=10, command=lambda: self._refine_preview_close(state, accept=False))
+        accept_btn.pack(side=tk.RIGHT)
+        reject_btn.pack(side=tk.RIGHT, padx=(0, 6))
+        state["accept_btn"] = accept_btn
+
+        popup.protocol("WM_DELETE_WINDOW", lambda: self._refine_preview_close(state, accept=False))
+        popup.bind("<Escape>", lambda e: self._refine_preview_close(state, accept=False))
+        popup.lift()
+        popup.focus_force()
+        return state
 
-            if not refined:
-                refined = original_prompt
-            
-            # Update UI on the main thread
-            self.root.after(0, lambda: self._update_refined_prompt_ui(refined))
+    def _refine_preview_append(self, state: dict[str, Any], chunk: str) -> None:
+        if state["closed"]:
+            return
+        txt = state["text"]
+        if not state["started"]:
+            state["started"] = True
+            chunk = chunk.lstrip()
+            state["status_var"].set("⚡ Streaming… you can Reject at any time")
+            self.root.config(cursor="")
+        txt.config(state=tk.NORMAL)
+        txt.insert(tk.END, chunk)
+        txt.config(state=tk.DISABLED)
+        txt.see(tk.END)
+
+    def _refine_preview_finish(self, state: dict[str, Any], ok: bool) -> None:
+        state["done"] = True
+        if state["closed"]:
+            return
+        txt = state["text"]
+        txt.config(state=tk.NORMAL)
+        if txt.get("1.0", tk.END).strip() and ok:
+            state["accept_btn"].config(state=tk.NORMAL)
+            state["status_var"].set("✅ Done — review, edit if needed, then Accept or Reject")
+        elif txt.get("1.0", tk.END).strip():
+            # Cut off by an error or the deadline: the partial text is only applied on purpose
+            state["accept_btn"].config(state=tk.NORMAL, text="Keep partial", bg=self.current_theme["accent_orange"])
+            state["status_var"].set("⚠ Incomplete — the refinement stopped early; Keep partial or Reject")
+        else:
+            state["status_var"].set("ℹ No refinement generated" if ok else "❌ Refinement failed")
 
-        except Exception as e:
-            try:
-                self.root.after(0, lambda err=e: messagebox.showerror("Gemini Error", f"Failed to refine prompt: {err}"))
-            except:
-                pass
-        finally:
-            try:
-                self.root.after(0, lambda: self.refine_btn.config(state=tk.NORMAL))
-                self.root.after(0, lambda: self.root.config(cursor=""))
-            except:
-                pass
+    def _refine_preview_close(self, state: dict[str, Any], accept: bool) -> None:
+        if state["closed"]:
+            return
+        if accept:
+            refined = state["text"].get("1.0", tk.END).strip()
+            if refined:
+                self._update_refined_prompt_ui(refined)
+        state["closed"] = True
+        # Cancels the request (and closes its stream) if it is still running
+        if state.get("job") is not None:
+            state["job"].cancel()
+        try:
+            state["popup"].destroy()
+        except Exception:
+            pass
+        self.refine_btn.config(state=tk.NORMAL)
+        self.root.config(cursor="")
 
     def _update_refined_prompt_ui(self, refined_text: str) -> None:
-        self.text_input.delete("1.0", tk.END)
-        self.text_input.insert("1.0", refined_text)
+        """Replace the prompt as a single undoable edit (Ctrl+Z restores the original)."""
+        ti = self.text_input
+        ti.configure(autoseparators=False)
+        try:
+            ti.edit_separator()
+            ti.delete("1.0", tk.END)
+            ti.insert("1.0", refined_text)
+            ti.edit_separator()
+        finally:
+            ti.configure(autoseparators=True)
 
-    def _describe_image(self) -> None:
+    def _describe_image(self, on_complete=None) -> None:
+        """Start a Visionize job; ``on_complete`` runs on the Tk thread once it has finished."""
         if not self.api_key:
             self.root.after(0, lambda: messagebox.showwarning("Gemini API","Gemini AI not configured. Please set the API key via Settings (⚙) or GEMINI_API_KEY env var."))
             return
@@ -2334,6 +5560,48 @@ class InputPopup:
             self.root.after(0, lambda: messagebox.showwarning("Visionize","Please add an image, attach files, or enter a prompt to analyze."))
             return
 
+        mode, user_prompt, include_ctx, enhanced_context = self._gather_visionize_inputs()  # type: ignore[misc]
+
+        self.visionize_btn.config(state=tk.DISABLED)
+        self.root.config(cursor="wait")
+        self.root.update()
+
+        # A background run over these inputs is used if the context it gathered is still current
+        run = self._take_speculation(self._visionize_input_key(mode, user_prompt, include_ctx, enhanced_context))
+        if run is not None:
+            self._adopt_speculation_if_current(run, on_complete, mode, user_prompt, include_ctx, enhanced_context)
+            return
+        self._start_visionize(mode, user_prompt, include_ctx, enhanced_context, on_complete)
+
+    def _start_visionize(self, mode: str, user_prompt: str, include_ctx: bool, enhanced_context: dict, on_complete=None) -> None:
+        """Submit a Visionize job for the gathered inputs (Tk thread)."""
+        cancelled = {"flag": False}
+
+        def _done():
+            self._ai_job_finished("visionize", job)
+            self.visionize_btn.config(state=tk.NORMAL)
+            self.root.config(cursor="")
+            # A cancelled Visionize & Send must not go on to send
+            if on_complete is not None and not cancelled["flag"]:
+                on_complete()
+
+        job = self.engine.submit(
+            lambda: self._describe_image_job(mode, user_prompt, include_ctx, enhanced_context),
+            name="Visionize",
+            timeout=self.ai_deadlines_s["visionize"],
+            dispatch=self.call_tk,
+            on_error=lambda e: messagebox.showerror("Gemini Error", f"Failed to describe image: {e}"),
+            on_cancel=lambda: cancelled.update(flag=True),
+            on_done=_done,
+        )
+        self._track_ai_job("visionize", job)
+
+    def _gather_visionize_inputs(self, interactive: bool = True) -> tuple[str, str, bool, dict] | None:
+        """Read the prompt, mode and enabled context sources for Visionize (Tk thread).
+
+        With ``interactive`` False nothing is asked of the user: if terminal context is
+        enabled but not captured yet, None is returned instead of opening the picker.
+        """
         user_prompt = self.text_input.get("1.0", tk.END).strip()
         if not user_prompt:
             user_prompt = "Describe this image in detail."
@@ -2343,20 +5611,28 @@ class InputPopup:
         include_ctx = bool(self.include_context_var.get())
         if include_ctx:
             try:
-                # 1. Collect project brief files automatically (if enabled)
+                # 1. Project context (if enabled); ranked against the prompt on the worker thread
                 if not hasattr(self, 'include_project_var') or bool(self.include_project_var.get()):
-                    enhanced_context['project_brief'] = self._collect_project_brief_context(max_chars=15000)
+                    enhanced_context['include_project'] = True
 
-                # 2. Collect prompts archive for continuity (if enabled)
+                # 2. Past prompts for continuity (if enabled); retrieved on the worker thread
                 if not hasattr(self, 'include_archive_var') or bool(self.include_archive_var.get()):
-                    enhanced_context['prompts_archive'] = self._read_prompts_archive(max_chars=10000)
+                    enhanced_context['include_archive'] = True
+
+                # 3. Staged/unstaged git changes (if enabled); diffed on the worker thread
+                if hasattr(self, 'include_git_var') and bool(self.include_git_var.get()):
+                    enhanced_context['include_git'] = True
 
-                # 3. Terminal context (if enabled)
+                # 4. Terminal context (if enabled)
                 terminal_text = ""
                 if not hasattr(self, 'include_terminal_var') or bool(self.include_terminal_var.get()):
-                    # Prefer preloaded buffer, otherwise ask
-                    terminal_text = getattr(self, 'terminal_context_buffer', "").strip()
-                    if not terminal_text:
+                    # Prefer the picked pane (re-captured on the worker) or preloaded buffer, then captured output, otherwise ask
+                    if self.terminal_pane:
+                        enhanced_context['terminal_pane'] = self.terminal_pane
+                    terminal_text = getattr(self, 'terminal_context_buffer', "").strip() or self._captured_terminal_text()
+                    if not terminal_text and not self.terminal_pane:
+                        if not interactive:
+                            return None
                         terminal_text = self._ask_terminal_context() or ""
                         self.terminal_context_buffer = terminal_text
                 enhanced_context['terminal_context'] = terminal_text
@@ -2365,200 +5641,580 @@ class InputPopup:
                 # If enhanced context collection fails, continue with basic functionality
                 enhanced_context = {'terminal_context': ''}
 
-        self.visionize_btn.config(state=tk.DISABLED)
-        self.root.config(cursor="wait")
-        self.root.update()
-
         try:
             mode = self.mode_var.get()
         except Exception:
-            mode = "plan"
-        threading.Thread(target=self._describe_image_thread, args=(mode, user_prompt, include_ctx, enhanced_context)).start()
-
-    def _describe_image_thread(self, mode: str, user_prompt: str, include_context: bool, enhanced_context: dict) -> None:
-        try:
-            if not self.client:
-                self._log_debug("Gemini client not configured. API key missing or client init failed.")
-                self.root.after(0, lambda: messagebox.showerror("Gemini Error", "Gemini client not configured. Please set API key."))
-                return
-            
-            image_parts = []
-            image_sizes: list[int] = []
-            errors: list[str] = []
-            self._log_debug(f"Starting image processing for {len(self.images)} image(s). include_context={include_context}; mode={mode}")
-            for item in list(self.images):
-                try:
-                    data = item.get("bytes", b"")
-                    if not data:
-                        errors.append("Empty image bytes encountered")
-                        continue
-                    image_sizes.append(len(data))
-                    image_parts.append(types.Part.from_bytes(data=data, mime_type='image/png'))
-                except Exception as e:
-                    name = item.get("name", "<image>")
-                    err_msg = f"Failed processing '{name}': {e}"
-                    errors.append(err_msg)
-                    self._log_debug(err_msg, e)
-                    continue
-            self._log_debug(f"Prepared {len(image_parts)} image part(s). total_bytes={sum(image_sizes)} sizes={image_sizes}")
-            
-            # If no images but we have files or prompt, continue with text-only analysis
-            has_content_to_analyze = bool(image_parts or self.file_paths or user_prompt.strip())
-            
-            if not has_content_to_analyze:
-                self.root.after(0, lambda: messagebox.showwarning("Visionize", "No content to analyze. Please add images, attach files, or enter a prompt."))
-                return
-            
-            # If image processing failed but we have other content, log and continue
-            if not image_parts and errors and self.images:
-                summary = "\n".join(f"- {e}" for e in errors[:3])
-                self._log_debug(f"Image processing errors (continuing with text analysis): {summary}")
-                # Don't return - continue with file/text analysis
-
-            # Build comprehensive context
-            context_parts = []
-            
-            if include_context:
-                # Add project brief context
-                if enhanced_context.get('project_brief'):
-                    context_parts.append(f"=== PROJECT OVERVIEW ===\n{enhanced_context['project_brief']}")
-                
-                # Add prompts archive for continuity
-                if enhanced_context.get('prompts_archive'):
-                    context_parts.append(f"=== PREVIOUS INTERACTIONS ===\n{enhanced_context['prompts_archive']}")
-                
-                # Add terminal context if provided
-                if enhanced_context.get('terminal_context'):
-                    context_parts.append(f"=== TERMINAL OUTPUT ===\n{enhanced_context['terminal_context']}")
-            
-            # Debug: log context inclusion and sizes
-            proj_len = len(enhanced_context.get('project_brief') or '')
-            arch_len = len(enhanced_context.get('prompts_archive') or '')
-            term_len = len(enhanced_context.get('terminal_context') or '')
-            self._log_debug(
-                f"Context flags: include_context={include_context}; "
-                f"project_brief={'yes' if bool(enhanced_context.get('project_brief')) else 'no'}({proj_len} chars); "
-                f"prompts_archive={'yes' if bool(enhanced_context.get('prompts_archive')) else 'no'}({arch_len} chars); "
-                f"terminal={'yes' if bool(enhanced_context.get('terminal_context')) else 'no'}({term_len} chars)"
-            )
-
-            # Add attached file context
-            if self.file_paths:
-                self._log_debug(f"Attached files detected: count={len(self.file_paths)}; names={[os.path.basename(p) for p in self.file_paths]}")
-                file_contexts = []
-                files_meta: list[tuple[str, int]] = []
-                for p in self.file_paths:
-                    try:
-                        with open(p, "r", encoding="utf-8", errors="ignore") as f:
-                            content = f.read()
-                        # Include file metadata if available
-                        meta = self.file_meta.get(p)
-                        if meta:
-                            s_line, e_line, total = meta
-                            snippet = content[:2000]
-                            file_contexts.append(f"File: {os.path.basename(p)} (lines {s_line}-{e_line}/{total})\n---\n{snippet}\n---")
-                            files_meta.append((os.path.basename(p), len(snippet)))
-                        else:
-                            snippet = content[:2000]
-                            file_contexts.append(f"File: {os.path.basename(p)}\n---\n{snippet}\n---")
-                            files_meta.append((os.path.basename(p), len(snippet)))
-                    except Exception:
-                        continue
-                if file_contexts:
-                    context_parts.append(f"=== ATTACHED FILES ===\n\n{chr(10).join(file_contexts)}")
-                    self._log_debug(f"Attached file snippet sizes (chars): {files_meta}")
-
-            context_block = "\n\n".join(context_parts) if context_parts else ""
-            self._log_debug(f"Context block total size={len(context_block)} chars; user_prompt size={len(user_prompt)} chars")
-            
-            # Choose prompt template based on mode (plan | describe | combine)
-            sel_mode = (mode or "").lower()
-            if sel_mode not in ("plan", "describe", "combine"):
-                sel_mode = "plan"
-
-            # Build required headings based on selection
-            def _headings_for(m: str) -> list[str]:
-                if m == "plan":
-                    return ["Overview:", "Plan:"]
-                if m == "describe":
-                    return ["Overview:", "Describe Image:"]
-                return ["Overview:", "Describe Image:", "Plan:"]
-
-            headings = _headings_for(sel_mode)
-
-            # Guidance per section (used in instructions; do not echo verbatim)
-            overview_req = (
-                "Write 2–4 sentences summarizing what the image(s) show and the intended purpose inferred from USER REQUEST. "
-                "Keep it factual and task‑oriented; avoid fluff or speculation beyond the given CONTEXT."
-            )
-            describe_req = (
-                "Provide a highly detailed, context‑aware description tailored to the USER REQUEST. If the task is UI/UX, cover layout, hierarchy, states, components, labels, icons, colors, typography, spacing, and affordances. "
-                "If the task is debugging/implementation/backend, focus on visible workflows, data/values, architectural hints, logs/console outputs, and any code/UI cues relevant to functionality. "
-                "Start with the user’s target area, then cover other relevant areas. Explicitly note uncertainties."
-            )
-            plan_req = (
-                "Provide a concise, actionable plan connected to the description (5–10 bullets). Each bullet should state what to do, why it matters, and the expected impact. "
-                "Scope the actions to this project/app and align them with the USER REQUEST (may include UI changes, debugging steps, code changes, tests, or backend tasks)."
-            )
-
-            headings_block = "\n\n".join(headings)
-
-            analysis_prompt = f"""
-You are a senior software engineer and product‑minded builder analyzing the provided image(s) for the USER REQUEST using the given CONTEXT. Do not hallucinate.
-
-Analyze ALL available inputs:
-1) The image(s) provided.
-2) The INCLUDED CONTEXT below which may contain: a project brief with listed files and snippets, the prompts archive, and terminal logs or outputs.
-Always incorporate relevant evidence from these sources; do not ignore them.
+            mode = "plan"
+        return mode, user_prompt, include_ctx, enhanced_context
+
+    def _visionize_input_key(self, mode: str, user_prompt: str, include_context: bool, enhanced_context: dict) -> str:
+        """Hash of everything that determines a Visionize request, for matching speculative runs."""
+        h = hashlib.sha256()
+        for part in (mode, user_prompt, str(include_context), self.model_name, str(self.parallel_combine),
+                     str(self.context_budget_tokens), str(self.ai_profiles), str(self.latency_profiles.overrides)):
+            h.update(part.encode("utf-8", errors="ignore") + b"\0")
+        for name in sorted(enhanced_context):
+            h.update(name.encode() + b"=" + str(enhanced_context[name] or "").encode("utf-8", errors="ignore") + b"\0")
+        for item in self.images:
+            h.update(hashlib.sha256(item.get("bytes", b"")).digest())
+        for p in self.file_paths:
+            try:
+                st = os.stat(p)
+                stamp = f"{st.st_mtime_ns}:{st.st_size}"
+            except OSError:
+                stamp = "missing"
+            h.update(f"{p}|{stamp}|{self.file_meta.get(p)}".encode("utf-8", errors="ignore") + b"\0")
+        return h.hexdigest()
+
+    # ---------- Speculative Visionize ----------
+    def _schedule_speculation(self) -> None:
+        """(Re)start the idle timer after the inputs changed (Tk thread)."""
+        if not getattr(self, "speculative_visionize", False):
+            return
+        after_id = getattr(self, "_speculation_after_id", None)
+        if after_id:
+            try:
+                self.root.after_cancel(after_id)
+            except Exception:
+                pass
+        self._speculation_after_id = self.root.after(int(self.speculative_idle_s * 1000), self._maybe_start_speculation)
 
-=== USER REQUEST ===
-{user_prompt}
+    def _maybe_start_speculation(self) -> None:
+        """After an idle period with images attached, analyze the current inputs in the background."""
+        self._speculation_after_id = None
+        if (not self.speculative_visionize or not self.images or not self.api_key
+                or "visionize" in self._ai_jobs):
+            return
+        inputs = self._gather_visionize_inputs(interactive=False)
+        if inputs is None:
+            return
+        key = self._visionize_input_key(*inputs)
+        current = self._speculation
+        if current is not None:
+            if current.key == key:
+                return
+            self._discard_speculation()
+        if not self._speculative_budget_left(0):
+            self._log_debug("Speculative Visionize skipped: hourly budget used up")
+            return
+        run = SpeculativeRun(key)
+        run.job = self.engine.submit(
+            lambda: self._speculative_visionize_job(run, *inputs),
+            name="Speculative Visionize",
+            timeout=self.ai_deadlines_s["visionize"],
+        )
+        self._speculation = run
+        self._log_debug(f"Speculative Visionize started for inputs {key[:12]}")
+
+    def _discard_speculation(self) -> None:
+        run = self._speculation
+        self._speculation = None
+        if run is not None and run.job is not None and not run.done:
+            self._log_debug(f"Speculative Visionize {run.key[:12]} discarded (inputs changed)")
+            run.job.cancel()
+
+    def _take_speculation(self, key: str) -> SpeculativeRun | None:
+        """Return the background run for ``key`` (cancelling any run for other inputs)."""
+        run = self._speculation
+        if run is None:
+            return None
+        if run.key != key or (run.done and not run.ok):
+            self._discard_speculation()
+            return None
+        self._speculation = None
+        return run
+
+    def _visionize_context_digest(self, mode: str, user_prompt: str, include_context: bool, enhanced_context: dict) -> str | None:
+        """Hash of the context a Visionize over these inputs would send now (worker thread; memoized sources)."""
+        request = self._prepare_visionize_request(mode, user_prompt, include_context, enhanced_context)
+        if request is None:
+            return None
+        return hashlib.sha256(request["context_block"].encode("utf-8", errors="ignore")).hexdigest()
+
+    def _adopt_speculation_if_current(self, run: SpeculativeRun, on_complete, *inputs) -> None:
+        """Adopt ``run`` unless the context it was built on has changed since (Tk thread).
+
+        The input key only covers the prompt, images and attached files. The project,
+        git, archive and terminal sources are re-gathered on the context pool and
+        compared with what the run used; on a mismatch a fresh Visionize is started.
+        """
+        def _check():
+            try:
+                digest = self._visionize_context_digest(*inputs)
+            except Exception as e:
+                self._log_debug("Speculative Visionize context check failed", e)
+                digest = None
+            self.call_tk(lambda: _decide(digest))
+
+        def _decide(digest):
+            if run.context_digest is not None and run.context_digest != digest:
+                self._log_debug(f"Speculative Visionize {run.key[:12]} discarded (context changed)")
+                if run.job is not None and not run.done:
+                    run.job.cancel()
+            elif self._adopt_speculation(run, on_complete):
+                return
+            self._start_visionize(*inputs, on_complete=on_complete)
+
+        self._context_executor().submit(_check)
+
+    def _adopt_speculation(self, run: SpeculativeRun, on_complete) -> bool:
+        """Show a speculative run's answer in the prompt. Returns False if it cannot be used."""
+        mark = f"analysis_stream_{id(run)}"
+        stream = TkTextStream(self.call_tk, lambda chunk: self._append_streamed_analysis(mark, chunk))
+
+        def _finished(ok: bool, cancelled: bool, error: Exception | None) -> None:
+            # Engine thread: finish exactly like a regular Visionize
+            stream.close()
+            self.call_tk(lambda: _finalize(ok, cancelled, error))
+
+        def _finalize(ok: bool, cancelled: bool, error: Exception | None) -> None:
+            self._end_streamed_analysis(mark, discard=cancelled)
+            self._finish_ai_status("Visionize", stream, ok, cancelled)
+            self._ai_job_finished("visionize", run.job)
+            self.visionize_btn.config(state=tk.NORMAL)
+            self.root.config(cursor="")
+            if error is not None:
+                messagebox.showerror("Gemini Error", f"Failed to describe image: {error}")
+            elif ok and not stream.text.strip():
+                messagebox.showwarning("Image Description", "No description generated.")
+            if on_complete is not None and not cancelled:
+                on_complete()
+
+        if run.done:
+            text = run.text
+            if not run.ok or not text.strip():
+                return False
+            self._append_streamed_analysis(mark, text)
+            self._end_streamed_analysis(mark)
+            self.status_var.set("⚡ Visionize: background analysis was ready")
+            self.visionize_btn.config(state=tk.NORMAL)
+            self.root.config(cursor="")
+            self._log_debug(f"Adopted finished speculative Visionize {run.key[:12]}")
+            if on_complete is not None:
+                on_complete()
+            return True
+        self._start_ai_status("Visionize", stream, "continuing background analysis")
+        if not run.adopt(stream.feed, _finished):
+            # Finished in the meantime; use the completed result instead
+            self._finish_ai_status("Visionize", stream, True)
+            return self._adopt_speculation(run, on_complete)
+        self._track_ai_job("visionize", run.job)
+        self._log_debug(f"Adopted running speculative Visionize {run.key[:12]}")
+        return True
+
+    def _speculative_budget_left(self, tokens: int) -> bool:
+        """True if ``tokens`` more speculative tokens fit in the last hour's budget."""
+        cutoff = time.time() - 3600
+        with self._speculative_lock:
+            self._speculative_spend = [(t, n) for t, n in self._speculative_spend if t > cutoff]
+            return sum(n for _, n in self._speculative_spend) + tokens <= self.speculative_tokens_per_hour
+
+    async def _speculative_visionize_job(self, run: SpeculativeRun, mode: str, user_prompt: str,
+                                         include_context: bool, enhanced_context: dict) -> None:
+        """Visionize into ``run`` instead of the prompt; no hedging, bounded by the hourly budget."""
+        ok = False
+        cancelled = False
+        error: Exception | None = None
+        try:
+            request = await asyncio.to_thread(self._prepare_visionize_request, mode, user_prompt, include_context, enhanced_context)
+            if request is None:
+                return
+            run.context_digest = hashlib.sha256(request["context_block"].encode("utf-8", errors="ignore")).hexdigest()
+            calls = 2 if (request["mode"] == "combine" and self.parallel_combine) else 1
+            tokens = request["requested_tokens"] * calls
+            if not self._speculative_budget_left(tokens):
+                self._log_debug("Speculative Visionize dropped: would exceed the hourly budget")
+                return
+            with self._speculative_lock:
+                self._speculative_spend.append((time.time(), tokens))
+            if calls == 2:
+                await self._stream_combine_parallel(request, run.feed, hedge=False)
+            else:
+                await self._stream_visionize(request, run.feed, hedge=False)
+            ok = True
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        except Exception as e:
+            error = e
+            self._log_debug(f"Speculative Visionize failed: {e}")
+        finally:
+            run.finish(ok, cancelled, error)
+
+    def _prepare_image_blobs(self) -> tuple[list[tuple[bytes, str]], list[int], list[str]]:
+        """Attached images as (bytes, name) with their estimated token cost, plus any errors."""
+        image_blobs: list[tuple[bytes, str]] = []
+        image_tokens: list[int] = []
+        errors: list[str] = []
+        for item in list(self.images):
+            try:
+                data = item.get("bytes", b"")
+                if not data:
+                    errors.append("Empty image bytes encountered")
+                    continue
+                digest = hashlib.sha1(data).hexdigest()
+                image_tokens.append(self.context_memo.get(("image_tokens", digest), (), lambda: self.budgeter.image_tokens(data)))
+                image_blobs.append((data, item.get("name", "image.png")))
+            except Exception as e:
+                name = item.get("name", "<image>")
+                err_msg = f"Failed processing '{name}': {e}"
+                errors.append(err_msg)
+                self._log_debug(err_msg, e)
+                continue
+        return image_blobs, image_tokens, errors
+
+    def _read_attached_files(self) -> list[FileExcerpt]:
+        """Bounded excerpts of the attached files, reused while their mtime/size are unchanged."""
+        files: list[FileExcerpt] = []
+        extractor = self.file_extractor
+        for p in list(self.file_paths):
+            if cancel_requested():
+                break
+            meta = self.file_meta.get(p)
+            try:
+                excerpt = self.context_memo.get(("file", p, meta, extractor.margin_lines), (p,),
+                                                lambda p=p, meta=meta: extractor.extract(p, meta))
+            except Exception as e:
+                self._log_debug(f"Could not read attached file {p}: {e}")
+                continue
+            files.append(excerpt)
+        return files
+
+    def _project_context(self, query: str) -> tuple[list[str], str]:
+        """(ranked project chunks, project brief). The brief files are the same for every request,
+        so they make up the part of the context that can be cached; the chunks follow the query."""
+        chunks = self._project_overview_chunks(query)
+        paths = [path for _, path in self._project_brief_sources()]
+        return chunks, self.context_memo.get(("brief",), [self.app_dir, os.path.join(self.app_dir, "docs")] + paths,
+                                         lambda: self._collect_project_brief_context(max_chars=self.MAX_BRIEF_CHARS))
+
+    def _compact_terminal(self, text: str) -> str:
+        """Terminal output with redraws, repeats and duplicate errors collapsed (see LogCompactor)."""
+        def _compact() -> str:
+            compacted = LogCompactor.compact(text)
+            self._log_debug(f"Terminal output compacted: {len(text)} -> {len(compacted)} chars")
+            return compacted
+        return self.context_memo.get(("terminal", hashlib.sha1(text.encode("utf-8", errors="ignore")).hexdigest()), (), _compact)
+
+    def _git_changes(self) -> str:
+        try:
+            return self.git_changes.collect()
+        except Exception as e:
+            self._log_debug("Git changes failed", e)
+            return ""
 
-{context_block}
+    def _context_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        if self._context_pool is None:
+            self._context_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="context")
+        return self._context_pool
 
-Write the answer in Markdown with EXACTLY the following section headings (and nothing else), in this order:
+    def _prepare_visionize_request(self, mode: str, user_prompt: str, include_context: bool, enhanced_context: dict) -> dict[str, Any] | None:
+        """Gather images and context for a Visionize call (worker thread). Returns None if there is nothing to analyze.
 
-{headings_block}
+        Images, attached files, project context and past prompts are gathered concurrently,
+        each memoized on the mtimes of the files it reads.
+        """
+        self._log_debug(f"Starting image processing for {len(self.images)} image(s). include_context={include_context}; mode={mode}")
+        pool = self._context_executor()
+
+        def _submit(fn, *args):
+            # Each task gets its own copy of the context so cancel_requested() works there too
+            return pool.submit(contextvars.copy_context().run, fn, *args)
+
+        query = " ".join([user_prompt] + [os.path.basename(p) for p in self.file_paths])
+        images_f = _submit(self._prepare_image_blobs)
+        files_f = _submit(self._read_attached_files)
+        project_f = _submit(self._project_context, query) if include_context and enhanced_context.get('include_project') else None
+        archive_f = _submit(self._past_prompt_blocks, query) if include_context and enhanced_context.get('include_archive') else None
+        git_f = _submit(self._git_changes) if include_context and enhanced_context.get('include_git') else None
+        raw_terminal = (enhanced_context.get('terminal_context') or '') if include_context else ''
+        pane = enhanced_context.get('terminal_pane') if include_context else None
+        terminal_f = _submit(self._terminal_context, raw_terminal, pane) if raw_terminal or pane else None
+        started = time.monotonic()
+        image_blobs, image_tokens, errors = images_f.result()
+        files = files_f.result()
+        project_chunks, brief = project_f.result() if project_f else ([], "")
+        past_prompts: list[str] = archive_f.result() if archive_f else []
+        terminal: str = terminal_f.result() if terminal_f else ''
+        git_changes: str = git_f.result() if git_f else ''
+        self._log_debug(f"Context gathered in {time.monotonic() - started:.3f}s; images={len(image_blobs)} files={len(files)}")
+        if cancel_requested():
+            return None
+
+        # If no images but we have files or prompt, continue with text-only analysis
+        has_content_to_analyze = bool(image_blobs or self.file_paths or user_prompt.strip())
+
+        if not has_content_to_analyze:
+            self.call_tk(lambda: messagebox.showwarning("Visionize", "No content to analyze. Please add images, attach files, or enter a prompt."))
+            return None
+
+        # If image processing failed but we have other content, log and continue
+        if not image_blobs and errors and self.images:
+            summary = "\n".join(f"- {e}" for e in errors[:3])
+            self._log_debug(f"Image processing errors (continuing with text analysis): {summary}")
+            # Don't return - continue with file/text analysis
+
+        # Debug: log context inclusion and sizes
+        self._log_debug(
+            f"Context flags: include_context={include_context}; "
+            f"project_chunks={len(project_chunks)}; "
+            f"project_brief={'yes' if brief else 'no'}({len(brief)} chars); "
+            f"past_prompts={len(past_prompts)}; "
+            f"git={len(git_changes)} chars; "
+            f"terminal={'yes' if terminal else 'no'}({len(terminal)} chars)"
+        )
 
-Content requirements (adapt based on the nature of the USER REQUEST—UI/UX, debugging, backend functionality, feature implementation, or anything else what asking the user):
-- Overview: {overview_req}
-- Describe Image: {describe_req if 'Describe Image:' in headings else 'Skip this section entirely.'}
-- Plan: {plan_req if 'Plan:' in headings else 'Skip this section entirely.'}
+        # Plan the token budget across sections, then trim each section to its grant
+        budgeter = self.budgeter
+        requested = {
+            "prompt": budgeter.estimate(build_analysis_prompt(mode, user_prompt, "")),
+            "images": sum(image_tokens),
+            "files": sum(budgeter.file_tokens(f) for f in files),
+            "git": budgeter.estimate(git_changes),
+            "terminal": budgeter.estimate(terminal),
+            "brief": budgeter.estimate(brief) + sum(budgeter.estimate(c) for c in project_chunks),
+            "archive": sum(budgeter.estimate(b) for b in past_prompts),
+        }
+        # The latency profile (auto: by input size) sets the model, budget and image size cap
+        profile = self._latency_profile("visionize", requested, len(image_blobs))
+        side = profile["max_image_side"]
+        if side:
+            image_blobs = [(self.context_memo.get(("image_cap", hashlib.sha1(d).hexdigest(), side), (),
+                                                  lambda d=d: LatencyProfiles.cap_image(d, side)), n)
+                           for d, n in image_blobs]
+            requested["images"] = sum(budgeter.image_tokens(d) for d, _ in image_blobs)
+        budget = budgeter.budget_for(profile["model"], profile["context_budget_tokens"])
+        granted = budgeter.allocate(requested, budget)
+        budget_summary = f"{profile['name']} ({profile['model']}) · " + budgeter.summary(requested, granted, budget)
+        self._log_debug(f"Context budget ({profile['name']}, {profile['model']}): requested={requested} granted={granted}")
+
+        # Build comprehensive context. The project brief is the stable part that can be served
+        # from a context cache; everything else (including the project chunks and past prompts
+        # picked for this request) changes from call to call. Spans already present earlier
+        # (in the prompt or a previous section) are replaced by back-references.
+        stable_parts = []
+        context_parts = []
+        dedup = ContextDeduper()
+        dedup.seed("the user request", user_prompt)
+        excerpt_tokens = granted["brief"]
+        if brief and granted["brief"]:
+            # Next to ranked excerpts the brief is capped by a share of the whole budget rather
+            # than by what is left for this request, so it stays identical from call to call
+            cap = int(budget * self.BRIEF_BUDGET_SHARE) if project_chunks else granted["brief"]
+            trimmed = budgeter.trim_head(brief, min(granted["brief"], cap))
+            dedup.seed("PROJECT BRIEF", trimmed)
+            stable_parts.append(f"=== PROJECT BRIEF ===\n{trimmed}")
+            excerpt_tokens -= budgeter.estimate(stable_parts[-1])
+        if project_chunks and excerpt_tokens > 0:
+            ranked = budgeter.pack_ranked(project_chunks, excerpt_tokens)
+            ranked = [dedup.dedupe(f"PROJECT OVERVIEW {c.partition(chr(10))[0]}", c) for c in ranked]
+            context_parts.append("=== PROJECT OVERVIEW ===\n(Excerpts most relevant to the request, cited as [path:lines]; "
+                                 "[path (summary)] entries summarize other relevant files)\n\n"
+                                 + "\n\n".join(ranked))
+            self._log_debug(f"Project overview: {len(ranked)}/{len(project_chunks)} ranked chunk(s) within {excerpt_tokens} tokens")
+        if past_prompts and granted["archive"]:
+            picked = budgeter.pack_ranked(past_prompts, granted["archive"])
+            picked = [dedup.dedupe("PREVIOUS INTERACTIONS", b) for b in picked]
+            context_parts.append("=== PREVIOUS INTERACTIONS ===\n(Past prompts most relevant to the request, newest first among equals)\n\n"
+                                 + "\n\n".join(picked))
+        if terminal and granted["terminal"]:
+            fitted = dedup.dedupe("TERMINAL OUTPUT", LogCompactor.fit(terminal, granted["terminal"], budgeter.estimate))
+            context_parts.append(f"=== TERMINAL OUTPUT ===\n{fitted}")
+        if git_changes and granted["git"]:
+            fitted = dedup.dedupe("GIT CHANGES", GitChanges.fit(git_changes, granted["git"], budgeter.estimate))
+            context_parts.append(f"=== GIT CHANGES ===\n(Uncommitted changes in the project repository)\n{fitted}")
+        file_contexts = budgeter.pack_files(files, granted["files"]) if granted["files"] else []
+        file_contexts = [dedup.dedupe(f"attached file {f.name}", b) for f, b in zip(files, file_contexts)]
+        if file_contexts:
+            context_parts.append(f"=== ATTACHED FILES ===\n\n{chr(10).join(file_contexts)}")
+            self._log_debug(f"Attached file block sizes (chars): {[(f.name, len(b)) for f, b in zip(files, file_contexts)]}")
+        if dedup.saved_chars:
+            self._log_debug(f"Context dedup removed {dedup.saved_chars} repeated chars")
+
+        stable_block = "\n\n".join(stable_parts)
+        volatile_block = "\n\n".join(context_parts)
+        context_block = "\n\n".join(stable_parts + context_parts)
+        self._log_debug(f"Context block total size={len(context_block)} chars (stable={len(stable_block)}); user_prompt size={len(user_prompt)} chars")
+        return {
+            "mode": mode,
+            "user_prompt": user_prompt,
+            "image_blobs": image_blobs,
+            "stable_block": stable_block,
+            "volatile_block": volatile_block,
+            "context_block": context_block,
+            "budget_summary": budget_summary,
+            "requested_tokens": sum(granted.values()),
+            "profile": profile,
+        }
 
-Constraints:
-- Base everything strictly on the provided image(s) and CONTEXT. If something is unknown, state it briefly in the relevant section.
-- If multiple images are provided, use “Image N:” prefixes where helpful and keep the final output within the same sections above.
-"""
+    async def _open_visionize_stream(self, request: dict[str, Any], client, api_key: str, plain: bool = False,
+                                     sections: Sequence[str] | None = None):
+        """Start one Visionize call on ``client`` (streamed, or one response if the profile says so).
 
-            # Create the API request with images and text
-            parts = image_parts + [types.Part.from_text(text=analysis_prompt)]
-            self._log_debug(f"Calling Gemini with {len(image_parts)} image part(s). Model={self.model_name}")
-            def _call():
-                return self.client.models.generate_content(
-                    model=self.model_name,
-                    contents=[types.Content(parts=parts)]
-                )
-            response = self._with_key_failover(_call)
-            self._log_debug("Gemini response received successfully")
+        Image parts and the context cache are resolved per attempt: both belong to the key
+        that created them, and failover may switch keys. ``plain`` sends everything inline.
+        ``sections`` limits the answer to those headings.
+        """
+        profile = request["profile"]
+        model = profile["model"]
+        image_blobs = request["image_blobs"]
+        if plain:
+            parts = [types.Part.from_bytes(data=d, mime_type="image/png") for d, _ in image_blobs]
+            cache_name = None
+        else:
+            parts = await asyncio.to_thread(self._image_parts_for_request, image_blobs, client, api_key)
+            cache_name = None
+            if request["stable_block"]:
+                cache_name = await asyncio.to_thread(
+                    self.context_cache.handle_for, client, api_key, model, request["stable_block"])
+        if cache_name:
+            prompt_text = build_analysis_prompt(request["mode"], request["user_prompt"], request["volatile_block"], cached=True,
+                                                sections=sections)
+        else:
+            prompt_text = build_analysis_prompt(request["mode"], request["user_prompt"], request["context_block"],
+                                                sections=sections)
+        cfg = LatencyProfiles.generation_config(profile, cached_content=cache_name)
+        parts.append(types.Part.from_text(text=prompt_text))
+        return await open_generation(client, profile, [types.Content(role="user", parts=parts)], cfg)
+
+    async def _verify_token_count(self, request: dict[str, Any]) -> str:
+        """Check the local estimate with count_tokens and calibrate the budgeter; returns a status suffix."""
+        keys = self._ordered_api_keys()
+        if not keys:
+            return ""
+        text = build_analysis_prompt(request["mode"], request["user_prompt"], request["context_block"])
+        estimated = self.budgeter.estimate(text)
+        try:
+            client = self.engine.client_for(keys[0])
+            resp = await client.aio.models.count_tokens(model=request["profile"]["model"], contents=text)
+            counted = int(getattr(resp, "total_tokens", 0) or 0)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._log_debug(f"count_tokens failed; keeping local estimate: {e}")
+            return ""
+        self.budgeter.calibrate(estimated, counted)
+        self._log_debug(f"count_tokens: text estimated={estimated} counted={counted}; calibration={self.budgeter.calibration}")
+        return f" (counted {counted / 1000:.1f}k text)"
+
+    async def _stream_visionize(self, request: dict[str, Any], on_chunk, sections: Sequence[str] | None = None,
+                                hedge: bool = True) -> None:
+        """Stream one Visionize call; a rejected file/cache reference is retried once fully inline."""
+        received = False
+
+        def _feed(chunk: str) -> None:
+            nonlocal received
+            received = True
+            on_chunk(chunk)
+
+        tokens = request["requested_tokens"]
+        try:
+            await self.engine.stream(
+                lambda client, key: self._open_visionize_stream(request, client, key, sections=sections), _feed,
+                tokens=tokens, hedge=hedge)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # A stale or foreign file/cache reference: forget handles and retry fully inline once
+            if received or not self._is_stale_reference_error(e):
+                raise
+            self._log_debug(f"File or cache reference rejected; retrying fully inline: {e}")
+            self.upload_manager.invalidate()
+            self.context_cache.invalidate()
+            await self.engine.stream(
+                lambda client, key: self._open_visionize_stream(request, client, key, plain=True, sections=sections), _feed,
+                tokens=tokens, hedge=hedge)
+
+    async def _stream_combine_parallel(self, request: dict[str, Any], on_chunk, hedge: bool = True) -> None:
+        """Combine mode as two concurrent calls: Overview + Describe Image, and Plan.
+
+        The key scheduler spreads them over the available keys, and both reuse the same
+        uploaded images and cached context. The describe answer streams live; the plan
+        is buffered until it finishes and then appended, so the result has the same
+        Overview: / Describe Image: / Plan: structure as a single Combine call.
+        """
+        plan_buffer: list[str] = []
+        state = {"describe_done": False, "plan_started": False, "pending": ""}
 
-            description = response.text.strip() if response.text else ""
-            if description:
-                self.root.after(0, lambda: self._insert_description_into_text(description))
+        def _emit_plan(text: str, final: bool = False) -> None:
+            if state["plan_started"]:
+                if text:
+                    on_chunk(text)
+                return
+            # Hold back until the heading is recognisable
+            state["pending"] += text
+            head = state["pending"].lstrip()
+            if not head or (len(head) < len("Plan:") and not final):
+                return
+            state["plan_started"] = True
+            if not head.startswith("Plan:"):
+                head = "Plan:\n" + head
+            on_chunk("\n\n" + head)
+
+        def _feed_plan(chunk: str) -> None:
+            if state["describe_done"]:
+                _emit_plan(chunk)
             else:
-                self.root.after(0, lambda: messagebox.showwarning("Image Description", "No description generated."))
+                plan_buffer.append(chunk)
 
-        except Exception as e:
-            self._log_debug("Describe image thread encountered an error.", e)
-            try:
-                self.root.after(0, lambda err=e: messagebox.showerror("Gemini Error", f"Failed to describe image: {err}"))
-            except:
-                pass
+        describe = asyncio.ensure_future(
+            self._stream_visionize(request, on_chunk, sections=analysis_headings("describe"), hedge=hedge))
+        plan = asyncio.ensure_future(self._stream_visionize(request, _feed_plan, sections=["Plan:"], hedge=hedge))
+        try:
+            await describe
+            state["describe_done"] = True
+            _emit_plan("".join(plan_buffer))
+            plan_buffer.clear()
+            await plan
+            _emit_plan("", final=True)
         finally:
-            try:
-                self.root.after(0, lambda: self.visionize_btn.config(state=tk.NORMAL))
-                self.root.after(0, lambda: self.root.config(cursor=""))
-            except:
-                pass
+            for task in (describe, plan):
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(describe, plan, return_exceptions=True)
+
+    async def _describe_image_job(self, mode: str, user_prompt: str, include_context: bool, enhanced_context: dict) -> str:
+        """Visionize on the engine loop: prepare off-loop, then stream the answer into the prompt."""
+        request = await asyncio.to_thread(self._prepare_visionize_request, mode, user_prompt, include_context, enhanced_context)
+        if request is None:
+            return ""
+
+        profile = request["profile"]
+        self._log_debug(
+            f"Calling Gemini ({'streaming' if profile['stream'] else 'single response'}) with "
+            f"{len(request['image_blobs'])} image part(s). Profile={profile['name']} Model={profile['model']}")
+        # Chunks are appended under the Analysis: heading as they arrive
+        mark = f"analysis_stream_{id(request)}"
+        stream = TkTextStream(self.call_tk, lambda chunk: self._append_streamed_analysis(mark, chunk))
+        if self.verify_token_counts:
+            request["budget_summary"] += await self._verify_token_count(request)
+        # Show how the context budget was spent while waiting for the answer
+        self.call_tk(lambda: self._start_ai_status("Visionize", stream, request["budget_summary"]))
+        stream_ok = False
+        cancelled = False
+        try:
+            if request["mode"] == "combine" and self.parallel_combine:
+                await self._stream_combine_parallel(request, stream.feed)
+            else:
+                await self._stream_visionize(request, stream.feed)
+            stream_ok = True
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            stream.close()
+            # Cancelled (or past its deadline): remove the partial analysis, leaving the prompt as it was
+            self.call_tk(lambda: self._end_streamed_analysis(mark, discard=cancelled))
+            self.call_tk(lambda: self._finish_ai_status("Visionize", stream, stream_ok, cancelled))
+            ttft = stream.time_to_first_chunk()
+            self._log_debug(
+                f"Gemini stream finished; chars={len(stream.text)}; "
+                f"ttft={'%.2fs' % ttft if ttft is not None else 'n/a'}; total={time.monotonic() - stream.started_at:.2f}s"
+            )
+
+        if not stream.text.strip():
+            self.call_tk(lambda: messagebox.showwarning("Image Description", "No description generated."))
+        return stream.text
 
     # -------------------------- Prompt persistence & countdown helpers --------------------------
     def _init_waiting_prompt(self, seconds: int = 30) -> None:
@@ -2577,13 +6233,59 @@ Constraints:
         """Start an infinite count-up timer that updates every second until cancelled."""
         def _tick():
             elapsed = getattr(self, "_countup_elapsed", 0)
-            self.status_var.set(f"⏳ Waiting for prompt: {elapsed}s")
+            # While an AI call owns the status line, keep counting but don't overwrite it
+            if not getattr(self, "_ai_status_active", False):
+                self.status_var.set(f"⏳ Waiting for prompt: {elapsed}s")
             self._countup_elapsed = elapsed + 1
             self._countdown_after_id = self.root.after(1000, _tick)
         self._countdown_after_id = self.root.after(0, _tick)
 
+    def _start_ai_status(self, label: str, stream: TkTextStream, detail: str = "") -> None:
+        """Show a live time-to-first-token indicator for a streaming AI call (Tk thread).
+
+        ``detail`` (e.g. the context budget allocation) is shown after the timing.
+        """
+        self._ai_status_active = True
+        self._ai_status_stream = stream
+        suffix = f"  |  {detail}" if detail else ""
+
+        def _tick():
+            if getattr(self, "_ai_status_stream", None) is not stream:
+                return
+            ttft = stream.time_to_first_chunk()
+            if ttft is None:
+                waited = time.monotonic() - stream.started_at
+                self.status_var.set(f"⏳ {label}… waiting for first token ({waited:.1f}s){suffix}")
+            else:
+                self.status_var.set(f"⚡ {label}: first token in {ttft:.1f}s — streaming…{suffix}")
+            self._ai_status_after_id = self.root.after(200, _tick)
+
+        _tick()
+
+    def _finish_ai_status(self, label: str, stream: TkTextStream, ok: bool = True, cancelled: bool = False) -> None:
+        """Stop the indicator started by _start_ai_status and leave a summary (Tk thread)."""
+        if getattr(self, "_ai_status_stream", None) is stream:
+            try:
+                if getattr(self, "_ai_status_after_id", None):
+                    self.root.after_cancel(self._ai_status_after_id)
+            except Exception:
+                pass
+            self._ai_status_after_id = None
+            self._ai_status_stream = None
+            self._ai_status_active = False
+        total = time.monotonic() - stream.started_at
+        ttft = stream.time_to_first_chunk()
+        if cancelled:
+            self.status_var.set(f"⏹ {label} cancelled after {total:.1f}s")
+        elif ok and ttft is not None:
+            self.status_var.set(f"✅ {label} done (first token {ttft:.1f}s, total {total:.1f}s)")
+        elif ok:
+            self.status_var.set(f"ℹ {label}: no output ({total:.1f}s)")
+        else:
+            self.status_var.set(f"❌ {label} failed after {total:.1f}s")
+
     def _persist_prompt(self, new_text: str) -> None:
-        """Keep only the last prompt in MagicInput Prompt.txt and move previous to Prompts Archive.txt."""
+        """Keep only the last prompt in MagicInput Prompt.txt and append the previous one to the prompt archive."""
         prev = ""
         try:
             if os.path.isfile(self.prompt_log_path):
@@ -2592,25 +6294,13 @@ Constraints:
         except Exception:
             prev = ""
 
-        # Prepend previous prompt to archive (top instead of bottom) if it isn't the waiting placeholder and not empty
+        # Append previous prompt to the archive if it isn't the waiting placeholder and not empty
         if prev and prev != self.waiting_placeholder:
             try:
-                sep = "\n" + ("-" * 50) + "\n"
                 timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                new_entry = f"[{timestamp}]\n{prev}{sep}"
-                
-                # Read existing archive content
-                existing_content = ""
-                try:
-                    if os.path.isfile(self.archive_path):
-                        with open(self.archive_path, "r", encoding="utf-8", errors="ignore") as f:
-                            existing_content = f.read()
-                except Exception:
-                    existing_content = ""
-                
-                # Write new entry at top, then existing content
-                with open(self.archive_path, "w", encoding="utf-8") as arch:
-                    arch.write(new_entry + existing_content)
+                self.prompt_archive.append(f"[{timestamp}]", prev)
+                if self.prompt_history is not None:
+                    self.prompt_history.add(timestamp, prev)
             except Exception:
                 pass
 
@@ -2619,8 +6309,130 @@ Constraints:
             f.write(new_text)
 
     # -------------------------- Context collection helpers --------------------------
-    def _collect_project_brief_context(self, max_chars: int = 20000) -> str:
-        """Collects content from common brief/overview files in the project root and docs/."""
+    def _project_overview_chunks(self, query: str) -> list[str]:
+        """Project context ranked by BM25 for ``query`` (worker thread).
+
+        The best excerpts come first, each headed by a [path:first-last] citation; then
+        one-paragraph summaries of other relevant files, so many files are covered for
+        the tokens of a few; then the remaining excerpts.
+        """
+        try:
+            if self.project_index is None:
+                self.project_index = ProjectIndex(self.app_dir, os.path.join(self.attachments_dir, "project_index.json"),
+                                                  log=self._log_debug)
+            index = self.project_index
+            index.update()
+            hits = index.search(query, k=self.PROJECT_TOP_K * 5)
+        except Exception as e:
+            self._log_debug("Project index search failed", e)
+            return []
+        # Overlapping chunks of the same file are merged into one excerpt
+        ranges: list[list[Any]] = []
+        for rel, first, last, _ in hits[:self.PROJECT_TOP_K]:
+            for r in ranges:
+                if r[0] == rel and first <= r[2] + 1 and last >= r[1] - 1:
+                    r[1], r[2] = min(r[1], first), max(r[2], last)
+                    break
+            else:
+                ranges.append([rel, first, last])
+        blocks = []
+        for rel, first, last in ranges:
+            text = index.read_lines(rel, first, last)
+            if text.strip():
+                blocks.append(f"[{rel}:{first}-{last}]\n{text}")
+        lead = blocks[:self.PROJECT_RAW_LEAD]
+        quoted = {b[1:].partition(":")[0] for b in lead}
+        files: list[str] = []
+        for rel, _, _, _ in hits:
+            if rel not in quoted and rel not in files:
+                files.append(rel)
+        summaries = self._file_summary_blocks(files[:self.PROJECT_SUMMARY_FILES])
+        return lead + summaries + blocks[self.PROJECT_RAW_LEAD:]
+
+    def _file_summary_blocks(self, rels: list[str]) -> list[str]:
+        """``[path (summary)]`` blocks for project files; queues model summaries for those lacking one."""
+        if not rels:
+            return []
+        try:
+            if self.file_summaries is None:
+                self.file_summaries = FileSummaryCache(os.path.join(self.attachments_dir, "file_summaries.json"),
+                                                       log=self._log_debug)
+            cache = self.file_summaries
+            blocks: list[str] = []
+            pending: list[tuple[str, str, str]] = []
+            for rel in rels:
+                path = os.path.join(self.app_dir, rel)
+                digest = self.context_memo.get(("sha1", path), (path,), lambda path=path: FileSummaryCache.digest(path))
+                entry = cache.get(digest, rel, path)
+                if entry["text"]:
+                    blocks.append(f"[{rel} (summary)]\n{entry['text']}")
+                if entry["kind"] != "model":
+                    pending.append((rel, path, digest))
+            cache.save()
+        except Exception as e:
+            self._log_debug("File summaries failed", e)
+            return []
+        if pending:
+            self._queue_file_summaries(pending)
+        return blocks
+
+    def _reserve_summary_tokens(self, tokens: int) -> bool:
+        """Record ``tokens`` of summary spend if they fit in the last hour's budget."""
+        cutoff = time.time() - 3600
+        with self._summary_lock:
+            self._summary_spend = [(t, n) for t, n in self._summary_spend if t > cutoff]
+            if sum(n for _, n in self._summary_spend) + tokens > self.summary_tokens_per_hour:
+                return False
+            self._summary_spend.append((time.time(), tokens))
+            return True
+
+    def _queue_file_summaries(self, pending: list[tuple[str, str, str]]) -> None:
+        """Have the model summarize a few files in the background (one job at a time, within the hourly budget)."""
+        if self.summary_tokens_per_hour <= 0 or not self.api_keys:
+            return
+        if self._summary_job is not None and not self._summary_job.done():
+            return
+        batch = pending[:self.SUMMARY_BATCH]
+        self._summary_job = self.engine.submit(lambda: self._summarize_files_job(batch), name="File summaries",
+                                               timeout=self.ai_deadlines_s["refine"] * len(batch))
+
+    async def _summarize_files_job(self, batch: list[tuple[str, str, str]]) -> None:
+        cache = self.file_summaries
+        if cache is None:
+            return
+        profile = self.latency_profiles.resolve("fast", self.model_name, self.context_budget_tokens)
+        config = LatencyProfiles.generation_config(profile, max_output_tokens=300)
+        done = 0
+        try:
+            for rel, path, digest in batch:
+                def _read(path: str = path) -> str:
+                    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+                        return f.read(self.SUMMARY_INPUT_CHARS)
+                content = await asyncio.to_thread(_read)
+                tokens = self.budgeter.estimate(content) + 400
+                if not self._reserve_summary_tokens(tokens):
+                    self._log_debug("File summaries paused: hourly budget used up")
+                    break
+                prompt = (
+                    "Summarize this project file for a developer in at most 4 short sentences: what it is for, "
+                    "its main classes/functions/sections, and what it depends on. Output only the summary.\n\n"
+                    f"FILE: {rel}\n{content}"
+                )
+                response = await self.engine.generate(
+                    lambda client, key: client.aio.models.generate_content(model=profile["model"], contents=prompt, config=config),
+                    tokens=tokens,
+                )
+                summary = " ".join((getattr(response, "text", "") or "").split())
+                if summary:
+                    cache.put_model(digest, rel, summary[:800])
+                    done += 1
+        finally:
+            if done:
+                await asyncio.to_thread(cache.save)
+                self._log_debug(f"File summaries: {done} written by the model")
+
+    def _project_brief_sources(self) -> list[tuple[str, str]]:
+        """(label, path) of common brief/overview files in the project root and docs/."""
         candidates = {
             "readme.md", "readme.txt",
             "plan.md", "plan.txt",
@@ -2632,45 +6444,52 @@ Constraints:
             "requirements.md", "requirements.txt",
             "contributing.md", "changelog.md", "changelog.txt",
         }
-        blocks: list[str] = []
+        sources: list[tuple[str, str]] = []
         # Root files
-        for name in os.listdir(self.app_dir):
-            path = os.path.join(self.app_dir, name)
-            if os.path.isfile(path) and name.lower() in candidates:
-                try:
-                    with open(path, "r", encoding="utf-8", errors="ignore") as f:
-                        content = f.read()
-                    blocks.append(f"# {name}\n{content}\n")
-                except Exception:
-                    continue
+        try:
+            for name in os.listdir(self.app_dir):
+                path = os.path.join(self.app_dir, name)
+                if os.path.isfile(path) and name.lower() in candidates:
+                    sources.append((name, path))
+        except OSError:
+            pass
         # docs/ directory (shallow)
         docs_dir = os.path.join(self.app_dir, "docs")
         if os.path.isdir(docs_dir):
             try:
                 for name in os.listdir(docs_dir):
-                    if not name.lower().endswith((".md", ".txt")):
-                        continue
                     path = os.path.join(docs_dir, name)
-                    if os.path.isfile(path):
-                        with open(path, "r", encoding="utf-8", errors="ignore") as f:
-                            content = f.read()
-                        blocks.append(f"# docs/{name}\n{content}\n")
-            except Exception:
+                    if name.lower().endswith((".md", ".txt")) and os.path.isfile(path):
+                        sources.append((f"docs/{name}", path))
+            except OSError:
                 pass
+        return sources
+
+    def _collect_project_brief_context(self, max_chars: int = 20000) -> str:
+        """Collects content from common brief/overview files in the project root and docs/."""
+        blocks: list[str] = []
+        for label, path in self._project_brief_sources():
+            try:
+                with open(path, "r", encoding="utf-8", errors="ignore") as f:
+                    content = f.read()
+                blocks.append(f"# {label}\n{content}\n")
+            except Exception:
+                continue
         joined = "\n\n".join(blocks)
         return joined[:max_chars]
 
-    def _read_prompts_archive(self, max_chars: int = 20000) -> str:
+    def _past_prompt_blocks(self, query: str) -> list[str]:
+        """Archived prompts most relevant to ``query`` (blended with recency), best first (worker thread)."""
         try:
-            if os.path.isfile(self.archive_path):
-                with open(self.archive_path, "r", encoding="utf-8", errors="ignore") as f:
-                    content = f.read()
-                # Keep the first segment (newest-first file) if too large
-                if len(content) > max_chars:
-                    return content[:max_chars]
-        except Exception:
-            pass
-        return ""
+            if self.prompt_history is None:
+                self.prompt_history = PromptHistory(self.prompt_archive, log=self._log_debug)
+            hits = self.prompt_history.search(query, k=self.PAST_PROMPTS_TOP_K)
+        except Exception as e:
+            self._log_debug("Prompt history search failed; using the newest prompts", e)
+            newest = self.prompt_archive.iter_newest()
+            hits = [(timestamp, text, 0.0) for timestamp, text in itertools.islice(newest, self.PAST_PROMPTS_TOP_K)]
+            newest.close()
+        return [f"[{timestamp}]\n{text}" for timestamp, text, _ in hits]
 
     def _list_open_terminals_windows(self) -> list[tuple[int, str, str]]:
         """Enumerate open terminal-like windows on Windows.
@@ -2755,23 +6574,44 @@ Constraints:
         # Left: terminal list (Windows only)
         left = tk.Frame(outer, bg=self.current_theme["bg_primary"])
         left.pack(side=tk.LEFT, fill=tk.Y, padx=(10, 6), pady=10)
-        tk.Label(left, text="Open terminals (Windows):", bg=self.current_theme["bg_primary"], fg=self.current_theme["text_primary"]).pack(anchor="w")
+        is_windows = platform.system() == 'Windows'
+        tk.Label(left, text="Open terminals (Windows):" if is_windows else "tmux panes / screen sessions:", bg=self.current_theme["bg_primary"], fg=self.current_theme["text_primary"]).pack(anchor="w")
         term_list = tk.Listbox(left, height=14, width=36, activestyle="dotbox")
         term_list.pack(fill=tk.Y, expand=False, pady=(4, 6))
 
         actions = tk.Frame(left, bg=self.current_theme["bg_primary"])
         actions.pack(fill=tk.X)
+        panes: list[tuple[str, str]] = []
+        picked: list[str] = []
         def _refresh():
             term_list.delete(0, tk.END)
-            items = self._list_open_terminals_windows() if platform.system() == 'Windows' else []
+            panes[:] = [] if is_windows else self.terminal_scrollback.list_panes()
+            for _, label in panes:
+                term_list.insert(tk.END, label)
+            items = self._list_open_terminals_windows() if is_windows else []
             for hwnd, title, cls in items:
                 term_list.insert(tk.END, f"[{cls}] {title}  (hwnd={hwnd})")
-            if not items:
+            if not items and not panes:
                 term_list.insert(tk.END, "No terminals detected. You can still paste or add from files.")
         def _activate():
             sel = term_list.curselection()
             if not sel:
                 return
+            if not is_windows:
+                # Capture the pane's scrollback; it is re-captured (new lines only) at each Visionize
+                if sel[0] >= len(panes):
+                    return
+                key = panes[sel[0]][0]
+                text = self.terminal_scrollback.capture(key)
+                if text is None:
+                    _refresh()
+                    return
+                limit = self.terminal_capture_kb * 1024 if self.terminal_capture_kb > 0 else len(text)
+                txt.delete("1.0", tk.END)
+                txt.insert(tk.END, text[-limit:].strip())
+                _highlight_keywords()
+                picked[:] = [key]
+                return
             line = term_list.get(sel[0])
             try:
                 hwnd = int(line.rsplit("=",1)[-1].rstrip(")"))
@@ -2779,10 +6619,11 @@ Constraints:
             except Exception:
                 pass
         tk.Button(actions, text="Refresh", command=_refresh, bg=self.current_theme["bg_secondary"], fg=self.current_theme["text_primary"], relief="flat").pack(side=tk.LEFT)
-        tk.Button(actions, text="Activate", command=_activate, bg=self.current_theme["bg_secondary"], fg=self.current_theme["text_primary"], relief="flat").pack(side=tk.LEFT, padx=(6,0))
+        tk.Button(actions, text="Activate" if is_windows else "Capture", command=_activate, bg=self.current_theme["bg_secondary"], fg=self.current_theme["text_primary"], relief="flat").pack(side=tk.LEFT, padx=(6,0))
 
         help_lbl = tk.Label(left,
-            text="Tip: Activate a terminal, press Ctrl+A then Ctrl+C (or Ctrl+Shift+C),\nthen use 'Paste Clipboard' to insert here.",
+            text=("Tip: Activate a terminal, press Ctrl+A then Ctrl+C (or Ctrl+Shift+C),\nthen use 'Paste Clipboard' to insert here." if is_windows else
+                  "Tip: Capture a pane to insert its scrollback. Later Visionize\nruns fetch its new output automatically."),
             justify="left",
             bg=self.current_theme["bg_primary"], fg=self.current_theme["text_secondary"])
         help_lbl.pack(anchor="w", pady=(6,0))
@@ -2864,6 +6705,8 @@ Constraints:
         chosen: list[str] = []
         def _ok():
             chosen.append(txt.get("1.0", tk.END).strip())
+            # Keep following the captured pane; any other choice replaces it
+            self.terminal_pane = picked[0] if picked else None
             popup.destroy()
         def _cancel():
             popup.destroy()
@@ -2898,6 +6741,43 @@ Constraints:
         
         self.text_input.see(tk.END)  # Scroll to end
 
+    def _append_streamed_analysis(self, mark: str, chunk: str) -> None:
+        """Append a streamed chunk under the Analysis: heading, creating the heading on first use."""
+        ti = self.text_input
+        if mark not in ti.mark_names():
+            # Remember where the inserted block starts so a cancel can remove it
+            ti.mark_set(f"{mark}_start", "end-1c")
+            ti.mark_gravity(f"{mark}_start", tk.LEFT)
+            current_text = ti.get("1.0", tk.END).strip()
+            if current_text:
+                ti.insert(tk.END, "\n\nAnalysis:\n")
+            else:
+                # If no text exists, add a basic prompt first
+                ti.insert(tk.END, "Analyze the attached image.\n\nAnalysis:\n")
+            ti.mark_set(mark, "end-1c")
+            # Right gravity keeps the mark after each inserted chunk
+            ti.mark_gravity(mark, tk.RIGHT)
+            chunk = chunk.lstrip()
+            # Output is flowing; the wait cursor is no longer accurate
+            self.root.config(cursor="")
+        ti.insert(mark, chunk)
+        ti.see(mark)
+
+    def _end_streamed_analysis(self, mark: str, discard: bool = False) -> None:
+        """Terminate a streamed analysis with a newline (or remove it if ``discard``) and drop its marks."""
+        ti = self.text_input
+        if mark not in ti.mark_names():
+            return
+        start = f"{mark}_start"
+        try:
+            if discard:
+                ti.delete(start, mark)
+            elif ti.get(f"{mark} -1c", mark) != "\n":
+                ti.insert(mark, "\n")
+            ti.see(mark)
+        finally:
+            ti.mark_unset(mark, start)
+
     # Add config load/save and settings dialog methods near other helpers
     def _load_config(self):
         try:
@@ -2920,6 +6800,56 @@ Constraints:
                 # Model name
                 self.model_name = data.get("model", self.model_name)
                 self.auto_refine = data.get("auto_refine", False)
+                self.use_files_api = bool(data.get("use_files_api", self.use_files_api))
+                self.use_context_cache = bool(data.get("use_context_cache", self.use_context_cache))
+                self.gemini_base_url = str(data.get("gemini_base_url") or "")
+                try:
+                    self.key_scheduler.set_defaults(int(data.get("key_default_rpm", self.key_scheduler.default_rpm)),
+                                                    int(data.get("key_default_tpm", self.key_scheduler.default_tpm)))
+                except (TypeError, ValueError):
+                    pass
+                self.key_scheduler.import_state(data.get("key_quota"), data.get("key_quota_version", 1))
+                self.hedge_requests = bool(data.get("hedge_requests", self.hedge_requests))
+                self.verify_token_counts = bool(data.get("verify_token_counts", self.verify_token_counts))
+                self.parallel_combine = bool(data.get("parallel_combine", self.parallel_combine))
+                self.speculative_visionize = bool(data.get("speculative_visionize", self.speculative_visionize))
+                try:
+                    self.speculative_idle_s = max(1.0, float(data.get("speculative_idle_s", self.speculative_idle_s)))
+                    self.speculative_tokens_per_hour = max(0, int(data.get("speculative_tokens_per_hour", self.speculative_tokens_per_hour)))
+                    self.summary_tokens_per_hour = max(0, int(data.get("summary_tokens_per_hour", self.summary_tokens_per_hour)))
+                except (TypeError, ValueError):
+                    pass
+                try:
+                    self.file_extractor.margin_lines = max(0, int(data.get("file_context_margin_lines", self.file_extractor.margin_lines)))
+                    self.terminal_capture_kb = max(0, int(data.get("terminal_capture_kb", self.terminal_capture_kb)))
+                except (TypeError, ValueError):
+                    pass
+                self.latency_profiles.import_overrides(data.get("latency_profiles"))
+                profiles = data.get("ai_profiles")
+                if isinstance(profiles, dict):
+                    for op, name in profiles.items():
+                        if op in self.ai_profiles and name in (LatencyProfiles.AUTO,) + LatencyProfiles.NAMES:
+                            # Files from before ai_profiles_version 2 saved "auto" as the default, not as a choice
+                            if name == LatencyProfiles.AUTO and data.get("ai_profiles_version", 1) < 2:
+                                continue
+                            self.ai_profiles[op] = name
+                try:
+                    self.context_budget_tokens = max(1000, int(data.get("context_budget_tokens", self.context_budget_tokens)))
+                    self.budgeter.budget_tokens = self.context_budget_tokens
+                    self.budgeter.calibration = float(data.get("token_calibration", self.budgeter.calibration))
+                except (TypeError, ValueError):
+                    pass
+                try:
+                    deadlines = data.get("ai_deadlines_s")
+                    if isinstance(deadlines, dict):
+                        for op, secs in deadlines.items():
+                            if op in self.ai_deadlines_s:
+                                self.ai_deadlines_s[op] = max(5.0, float(secs))
+                    self.ai_max_concurrency = max(1, int(data.get("ai_max_concurrency", self.ai_max_concurrency)))
+                    self.ai_max_retries = max(0, int(data.get("ai_max_retries", self.ai_max_retries)))
+                    self.hedge_percentile = min(0.99, max(0.5, float(data.get("hedge_percentile", self.hedge_percentile))))
+                except Exception:
+                    pass
                 # Load UI preferences if present
                 try:
                     prefs = data.get("ui_prefs", {})
@@ -2954,6 +6884,10 @@ Constraints:
                         self.include_archive_var.set(bool(prefs.get("include_archive", True)))
                     except Exception:
                         pass
+                    try:
+                        self.include_git_var.set(bool(prefs.get("include_git", False)))
+                    except Exception:
+                        pass
                     try:
                         self.include_terminal_var.set(bool(prefs.get("include_terminal", True)))
                     except Exception:
@@ -2976,7 +6910,37 @@ Constraints:
             "active_key_index": self.active_key_index,
             "model": self.model_name,
             "auto_refine": self.auto_refine,
+            "use_files_api": self.use_files_api,
+            "use_context_cache": self.use_context_cache,
+            "gemini_base_url": self.gemini_base_url,
+            "ai_deadlines_s": self.ai_deadlines_s,
+            "ai_max_concurrency": self.ai_max_concurrency,
+            "ai_max_retries": self.ai_max_retries,
+            "hedge_requests": self.hedge_requests,
+            "hedge_percentile": self.hedge_percentile,
+            "context_budget_tokens": self.context_budget_tokens,
+            "ai_profiles": self.ai_profiles,
+            "ai_profiles_version": 2,
+            "latency_profiles": self.latency_profiles.overrides,
+            "verify_token_counts": self.verify_token_counts,
+            "parallel_combine": self.parallel_combine,
+            "speculative_visionize": self.speculative_visionize,
+            "speculative_idle_s": self.speculative_idle_s,
+            "speculative_tokens_per_hour": self.speculative_tokens_per_hour,
+            "summary_tokens_per_hour": self.summary_tokens_per_hour,
+            "file_context_margin_lines": self.file_extractor.margin_lines,
+            "terminal_capture_kb": self.terminal_capture_kb,
         }
+        budgeter = getattr(self, "budgeter", None)
+        if budgeter is not None:
+            data["token_calibration"] = budgeter.calibration
+        scheduler = getattr(self, "key_scheduler", None)
+        if scheduler is not None:
+            data["key_default_rpm"] = scheduler.default_rpm
+            data["key_default_tpm"] = scheduler.default_tpm
+            # Learned limits/cooldowns, keyed by key fingerprint
+            data["key_quota"] = scheduler.export_state()
+            data["key_quota_version"] = GeminiKeyScheduler.STATE_VERSION
         # Persist UI prefs
         try:
             ui_prefs = {
@@ -2985,14 +6949,14 @@ Constraints:
                 "include_context": bool(getattr(self, "include_context_var", tk.BooleanVar(value=True)).get()),
                 "include_project": bool(getattr(self, "include_project_var", tk.BooleanVar(value=True)).get()),
                 "include_archive": bool(getattr(self, "include_archive_var", tk.BooleanVar(value=True)).get()),
+                "include_git": bool(getattr(self, "include_git_var", tk.BooleanVar(value=False)).get()),
                 "include_terminal": bool(getattr(self, "include_terminal_var", tk.BooleanVar(value=True)).get()),
             }
             data["ui_prefs"] = ui_prefs
         except Exception:
             pass
         try:
-            with open(self.config_path, "w", encoding="utf-8") as f:
-                json.dump(data, f)
+            write_config_file(self.config_path, data)
         except Exception as e:
             messagebox.showerror("Config Error", f"Unable to save config: {e}")
 
@@ -3045,6 +7009,7 @@ Constraints:
             listbox.delete(0, tk.END)
             for i, k in enumerate(self.api_keys or []):
                 suffix = "  (active)" if i == self.active_key_index else ""
+                suffix += f"  — {self.key_scheduler.describe(k)}"
                 listbox.insert(tk.END, f"{_mask(k)}{suffix}")
 
         btns = tk.Frame(keys_frame, bg=self.current_theme["bg_primary"]) 
@@ -3132,6 +7097,128 @@ Constraints:
         )
         chk.pack(anchor="w", pady=(6, 6))
 
+        # Files API uploads
+        files_api_var = tk.BooleanVar(value=self.use_files_api)
+        tk.Checkbutton(
+            wrap,
+            text="Upload images once and reuse them (Files API)",
+            variable=files_api_var,
+            bg=self.current_theme["bg_primary"],
+            fg=self.current_theme["text_primary"],
+            selectcolor=self.current_theme["bg_primary"],
+            activebackground=self.current_theme["bg_primary"],
+            activeforeground=self.current_theme["text_primary"],
+        ).pack(anchor="w", pady=(0, 6))
+
+        # Context caching
+        ctx_cache_var = tk.BooleanVar(value=self.use_context_cache)
+        tk.Checkbutton(
+            wrap,
+            text="Cache the project brief between calls (context caching)",
+            variable=ctx_cache_var,
+            bg=self.current_theme["bg_primary"],
+            fg=self.current_theme["text_primary"],
+            selectcolor=self.current_theme["bg_primary"],
+            activebackground=self.current_theme["bg_primary"],
+            activeforeground=self.current_theme["text_primary"],
+        ).pack(anchor="w", pady=(0, 6))
+
+        # ----- Per-operation deadlines -----
+        deadlines_frame = tk.Frame(wrap, bg=self.current_theme["bg_primary"])
+        deadlines_frame.pack(fill=tk.X, pady=(0, 6))
+        tk.Label(deadlines_frame, text="Deadline (s): Visionize", bg=self.current_theme["bg_primary"], fg=self.current_theme["text_primary"]).pack(side=tk.LEFT)
+        visionize_deadline_var = tk.StringVar(value=str(int(self.ai_deadlines_s["visionize"])))
+        tk.Spinbox(deadlines_frame, from_=5, to=900, increment=5, width=5, textvariable=visionize_deadline_var).pack(side=tk.LEFT, padx=(4, 12))
+        tk.Label(deadlines_frame, text="Refine", bg=self.current_theme["bg_primary"], fg=self.current_theme["text_primary"]).pack(side=tk.LEFT)
+        refine_deadline_var = tk.StringVar(value=str(int(self.ai_deadlines_s["refine"])))
+        tk.Spinbox(deadlines_frame, from_=5, to=900, increment=5, width=5, textvariable=refine_deadline_var).pack(side=tk.LEFT, padx=(4, 0))
+
+        # ----- Context budget -----
+        budget_frame = tk.Frame(wrap, bg=self.current_theme["bg_primary"])
+        budget_frame.pack(fill=tk.X, pady=(0, 6))
+        tk.Label(budget_frame, text="Context budget (tokens)", bg=self.current_theme["bg_primary"], fg=self.current_theme["text_primary"]).pack(side=tk.LEFT)
+        budget_var = tk.StringVar(value=str(self.context_budget_tokens))
+        tk.Spinbox(budget_frame, from_=4000, to=1_000_000, increment=4000, width=8, textvariable=budget_var).pack(side=tk.LEFT, padx=(4, 12))
+        verify_tokens_var = tk.BooleanVar(value=self.verify_token_counts)
+        tk.Checkbutton(
+            budget_frame,
+            text="Verify with count_tokens",
+            variable=verify_tokens_var,
+            bg=self.current_theme["bg_primary"],
+            fg=self.current_theme["text_primary"],
+            selectcolor=self.current_theme["bg_primary"],
+            activebackground=self.current_theme["bg_primary"],
+            activeforeground=self.current_theme["text_primary"],
+        ).pack(side=tk.LEFT)
+        tk.Label(budget_frame, text="Snippet margin (lines)", bg=self.current_theme["bg_primary"], fg=self.current_theme["text_primary"]).pack(side=tk.LEFT, padx=(12, 0))
+        margin_var = tk.StringVar(value=str(self.file_extractor.margin_lines))
+        tk.Spinbox(budget_frame, from_=0, to=2000, increment=10, width=5, textvariable=margin_var).pack(side=tk.LEFT, padx=(4, 0))
+
+        # ----- Latency profiles -----
+        profile_frame = tk.Frame(wrap, bg=self.current_theme["bg_primary"])
+        profile_frame.pack(fill=tk.X, pady=(0, 6))
+        profile_choices = (LatencyProfiles.AUTO,) + LatencyProfiles.NAMES
+        tk.Label(profile_frame, text="Latency profile: Visionize", bg=self.current_theme["bg_primary"], fg=self.current_theme["text_primary"]).pack(side=tk.LEFT)
+        visionize_profile_var = tk.StringVar(value=self.ai_profiles["visionize"])
+        ttk.Combobox(profile_frame, textvariable=visionize_profile_var, values=profile_choices, state="readonly", width=9).pack(side=tk.LEFT, padx=(4, 12))
+        tk.Label(profile_frame, text="Refine", bg=self.current_theme["bg_primary"], fg=self.current_theme["text_primary"]).pack(side=tk.LEFT)
+        refine_profile_var = tk.StringVar(value=self.ai_profiles["refine"])
+        ttk.Combobox(profile_frame, textvariable=refine_profile_var, values=profile_choices, state="readonly", width=9).pack(side=tk.LEFT, padx=(4, 0))
+
+        parallel_combine_var = tk.BooleanVar(value=self.parallel_combine)
+        tk.Checkbutton(
+            wrap,
+            text="Combine mode: generate Describe and Plan in parallel",
+            variable=parallel_combine_var,
+            bg=self.current_theme["bg_primary"],
+            fg=self.current_theme["text_primary"],
+            selectcolor=self.current_theme["bg_primary"],
+            activebackground=self.current_theme["bg_primary"],
+            activeforeground=self.current_theme["text_primary"],
+        ).pack(anchor="w", pady=(0, 6))
+
+        # ----- Speculative Visionize -----
+        spec_frame = tk.Frame(wrap, bg=self.current_theme["bg_primary"])
+        spec_frame.pack(fill=tk.X, pady=(0, 6))
+        spec_var = tk.BooleanVar(value=self.speculative_visionize)
+        tk.Checkbutton(
+            spec_frame,
+            text="Start Visionize in the background after",
+            variable=spec_var,
+            bg=self.current_theme["bg_primary"],
+            fg=self.current_theme["text_primary"],
+            selectcolor=self.current_theme["bg_primary"],
+            activebackground=self.current_theme["bg_primary"],
+            activeforeground=self.current_theme["text_primary"],
+        ).pack(side=tk.LEFT)
+        spec_idle_var = tk.StringVar(value=str(int(self.speculative_idle_s)))
+        tk.Spinbox(spec_frame, from_=1, to=120, width=4, textvariable=spec_idle_var).pack(side=tk.LEFT, padx=(2, 4))
+        tk.Label(spec_frame, text="s idle; max tokens/hour", bg=self.current_theme["bg_primary"], fg=self.current_theme["text_primary"]).pack(side=tk.LEFT)
+        spec_cap_var = tk.StringVar(value=str(self.speculative_tokens_per_hour))
+        tk.Spinbox(spec_frame, from_=0, to=10_000_000, increment=10_000, width=9, textvariable=spec_cap_var).pack(side=tk.LEFT, padx=(4, 0))
+
+        # ----- Per-key limits (until the server reports lower ones) -----
+        limits_frame = tk.Frame(wrap, bg=self.current_theme["bg_primary"])
+        limits_frame.pack(fill=tk.X, pady=(0, 6))
+        tk.Label(limits_frame, text="Per-key limits: requests/min", bg=self.current_theme["bg_primary"], fg=self.current_theme["text_primary"]).pack(side=tk.LEFT)
+        key_rpm_var = tk.StringVar(value=str(self.key_scheduler.default_rpm))
+        tk.Spinbox(limits_frame, from_=1, to=100_000, increment=5, width=6, textvariable=key_rpm_var).pack(side=tk.LEFT, padx=(4, 12))
+        tk.Label(limits_frame, text="tokens/min", bg=self.current_theme["bg_primary"], fg=self.current_theme["text_primary"]).pack(side=tk.LEFT)
+        key_tpm_var = tk.StringVar(value=str(self.key_scheduler.default_tpm))
+        tk.Spinbox(limits_frame, from_=1000, to=100_000_000, increment=50_000, width=10, textvariable=key_tpm_var).pack(side=tk.LEFT, padx=(4, 0))
+
+        hedge_var = tk.BooleanVar(value=self.hedge_requests)
+        tk.Checkbutton(
+            wrap,
+            text="Hedge slow Visionize/Refine calls on a second API key",
+            variable=hedge_var,
+            bg=self.current_theme["bg_primary"],
+            fg=self.current_theme["text_primary"],
+            selectcolor=self.current_theme["bg_primary"],
+            activebackground=self.current_theme["bg_primary"],
+            activeforeground=self.current_theme["text_primary"],
+        ).pack(anchor="w", pady=(0, 6))
+
         # Footer buttons
         footer = tk.Frame(wrap, bg=self.current_theme["bg_primary"]) 
         footer.pack(fill=tk.X)
@@ -3147,6 +7234,42 @@ Constraints:
             # Keep legacy field synced and reconfigure client
             self.api_key = (self.api_keys[self.active_key_index] if self.api_keys else None)
             self.auto_refine = auto_var.get()
+            self.use_files_api = files_api_var.get()
+            self.upload_manager.enabled = self.use_files_api
+            self.use_context_cache = ctx_cache_var.get()
+            self.context_cache.enabled = self.use_context_cache
+            self.hedge_requests = hedge_var.get()
+            self.verify_token_counts = verify_tokens_var.get()
+            self.parallel_combine = parallel_combine_var.get()
+            self.speculative_visionize = spec_var.get()
+            try:
+                self.speculative_idle_s = max(1.0, float(spec_idle_var.get()))
+                self.speculative_tokens_per_hour = max(0, int(spec_cap_var.get()))
+            except ValueError:
+                pass
+            if not self.speculative_visionize:
+                self._discard_speculation()
+            try:
+                self.context_budget_tokens = max(1000, int(budget_var.get()))
+                self.budgeter.budget_tokens = self.context_budget_tokens
+            except ValueError:
+                pass
+            try:
+                self.file_extractor.margin_lines = max(0, int(margin_var.get()))
+            except ValueError:
+                pass
+            try:
+                self.key_scheduler.set_defaults(int(key_rpm_var.get()), int(key_tpm_var.get()))
+            except ValueError:
+                pass
+            for op, var in (("visionize", visionize_profile_var), ("refine", refine_profile_var)):
+                self.ai_profiles[op] = var.get() or "balanced"
+            for op, var in (("visionize", visionize_deadline_var), ("refine", refine_deadline_var)):
+                try:
+                    self.ai_deadlines_s[op] = max(5.0, float(var.get()))
+                except ValueError:
+                    pass
+            self.engine.hedge_enabled = self.hedge_requests
             self._save_config()
             self._configure_gemini_client()
             dialog.destroy()
@@ -3158,21 +7281,49 @@ Constraints:
 
     # ---------- Gemini client/config helpers ----------
     def _configure_gemini_client(self) -> None:
-        if self.api_keys and 0 <= self.active_key_index < len(self.api_keys):
-            key = self.api_keys[self.active_key_index]
-        else:
-            key = self.api_key
-        if key:
-            try:
-                self.client = genai.Client(api_key=key)
-            except Exception:
-                self.client = None
-        else:
-            self.client = None
+        """Drop the engine's pooled clients for removed keys, or all of them if the endpoint changed.
 
-    def _is_rate_limit_error(self, err: Exception) -> bool:
-        msg = str(err).lower()
-        return ("429" in msg) or ("rate limit" in msg) or ("quota" in msg) or ("resource" in msg and "exhaust" in msg)
+        Clients are rebuilt lazily per key, so nothing else needs to happen on a key switch.
+        """
+        endpoint = os.environ.get("MAGICINPUT_GEMINI_BASE_URL") or self.gemini_base_url
+        engine = getattr(self, "engine", None)
+        if engine is not None:
+            same_endpoint = endpoint == getattr(self, "_client_endpoint", None)
+            engine.reset_clients(keep=self._ordered_api_keys() if same_endpoint else None)
+        self._client_endpoint = endpoint
+
+    def _make_gemini_client(self, key: str):
+        base_url = os.environ.get("MAGICINPUT_GEMINI_BASE_URL") or self.gemini_base_url
+        if base_url:
+            return genai.Client(api_key=key, http_options=types.HttpOptions(base_url=base_url))
+        return genai.Client(api_key=key)
+
+    def _ordered_api_keys(self) -> list[str]:
+        """Keys in failover order, starting with the active one."""
+        keys = list(self.api_keys) or ([self.api_key] if self.api_key else [])
+        if not keys:
+            return []
+        start = self.active_key_index if 0 <= self.active_key_index < len(keys) else 0
+        return keys[start:] + keys[:start]
+
+    def _advance_past_key(self, key: str) -> None:
+        """After a 429: stop preferring that key and persist the new order with the learned quota state (Tk thread)."""
+        if self.api_key != key or not self._rotate_api_key():
+            return
+        try:
+            self._save_config()
+        except Exception:
+            pass
+
+    def _image_parts_for_request(self, image_blobs: list[tuple[bytes, str]], client, api_key: str) -> list[Any]:
+        """Image parts for ``client``: Files API references when possible, inline bytes otherwise."""
+        return [
+            self.upload_manager.part_for(client, api_key, data, "image/png", display_name=name)
+            for data, name in image_blobs
+        ]
+
+    def _is_stale_reference_error(self, err: Exception) -> bool:
+        return GeminiUploadManager.is_stale_reference_error(err)
 
     def _rotate_api_key(self) -> bool:
         if not self.api_keys:
@@ -3180,27 +7331,389 @@ Constraints:
         start = self.active_key_index
         self.active_key_index = (self.active_key_index + 1) % len(self.api_keys)
         self.api_key = self.api_keys[self.active_key_index]
-        self._configure_gemini_client()
+        # Clients are pooled per key, so only the preference order changes
         return self.active_key_index != start
 
-    def _with_key_failover(self, func):
-        tries = max(1, len(self.api_keys))
-        last_err = None
-        for _ in range(tries):
+
+# ---------------------------------------------------------------------- batch visionize
+class BatchVisionizer:
+    """Headless Visionize over a folder of images (``python MagicInput.py --batch DIR``).
+
+    Uses the same prompt (``build_analysis_prompt``), latency profiles, key scheduler
+    and retry policy as the popup, with the keys, model and limits from
+    ``MagicInput/config.json``. Images are analyzed concurrently across all keys.
+    Each result is written to ``<out>/<image>.md`` and appended to
+    ``<out>/visionize.jsonl``; that JSONL file is also the checkpoint, so a rerun
+    skips images (by name and content hash) that already have a successful result
+    for the same mode and prompt.
+    """
+
+    IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".bmp", ".webp")
+    RESULTS_NAME = "visionize.jsonl"
+
+    def __init__(self, folder: str, out_dir: str | None = None, mode: str = "describe", prompt: str = "",
+                 concurrency: int | None = None, profile: str | None = None, recursive: bool = False,
+                 verbose: bool = False):
+        self.folder = os.path.abspath(folder)
+        self.out_dir = os.path.abspath(out_dir or os.path.join(self.folder, "visionize"))
+        self.mode = mode
+        self.user_prompt = prompt.strip() or "Describe this image in detail."
+        self.recursive = recursive
+        self.verbose = verbose
+        self.app_dir = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), "MagicInput")
+        self.config_path = os.path.join(self.app_dir, "config.json")
+        self.results_path = os.path.join(self.out_dir, self.RESULTS_NAME)
+        self._results_lock = threading.Lock()
+        self.unreadable = 0
+
+        data: dict[str, Any] = {}
+        try:
+            with open(self.config_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception:
+            pass
+        keys = data.get("gemini_api_keys") or ([data["gemini_api_key"]] if data.get("gemini_api_key") else [])
+        self.api_keys = [k for k in keys if isinstance(k, str) and k.strip()]
+        if not self.api_keys and os.environ.get("GEMINI_API_KEY"):
+            self.api_keys = [os.environ["GEMINI_API_KEY"]]
+        self.model_name = str(data.get("model") or "gemini-2.5-flash")
+        self.base_url = os.environ.get("MAGICINPUT_GEMINI_BASE_URL") or str(data.get("gemini_base_url") or "")
+        try:
+            self.deadline_s = max(5.0, float((data.get("ai_deadlines_s") or {}).get("visionize", 180.0)))
+            max_retries = max(0, int(data.get("ai_max_retries", 2)))
+            default_concurrency = max(1, int(data.get("ai_max_concurrency", 4)))
+            self.context_budget_tokens = max(1000, int(data.get("context_budget_tokens", 32_000)))
+        except (TypeError, ValueError):
+            self.deadline_s, max_retries, default_concurrency, self.context_budget_tokens = 180.0, 2, 4, 32_000
+        self.concurrency = max(1, int(concurrency or default_concurrency))
+        self.profiles = LatencyProfiles()
+        self.profiles.import_overrides(data.get("latency_profiles"))
+        self.profile = profile or (data.get("ai_profiles") or {}).get("visionize") or "balanced"
+        if not profile and self.profile == LatencyProfiles.AUTO and data.get("ai_profiles_version", 1) < 2:
+            self.profile = "balanced"  # the old default, not a choice
+        self.budgeter = ContextBudgeter(self.context_budget_tokens)
+
+        try:
+            self.scheduler = GeminiKeyScheduler(log=self._log, default_rpm=int(data.get("key_default_rpm") or 0),
+                                                default_tpm=int(data.get("key_default_tpm") or 0))
+        except (TypeError, ValueError):
+            self.scheduler = GeminiKeyScheduler(log=self._log)
+        self.scheduler.import_state(data.get("key_quota"), data.get("key_quota_version", 1))
+        # A batch would rather wait out a quota window than fail the image
+        self.engine = GeminiEngine(
+            self._make_client, lambda: list(self.api_keys), scheduler=self.scheduler,
+            max_concurrency=self.concurrency, max_queue_wait_s=300.0, log=self._log,
+            retry_policy=GeminiRetryPolicy(max_retries=max_retries),
+        )
+
+    def _log(self, msg: str, exc: Exception | None = None) -> None:
+        if self.verbose:
+            print(f"  [debug] {msg}" + (f": {exc}" if exc else ""), file=sys.stderr)
+
+    def _make_client(self, key: str):
+        if self.base_url:
+            return genai.Client(api_key=key, http_options=types.HttpOptions(base_url=self.base_url))
+        return genai.Client(api_key=key)
+
+    # ---------- inputs / checkpoint ----------
+    def list_images(self) -> list[str]:
+        found: list[str] = []
+        if self.recursive:
+            for root, dirs, files in os.walk(self.folder):
+                dirs[:] = [d for d in dirs if os.path.join(root, d) != self.out_dir]
+                found.extend(os.path.join(root, f) for f in files)
+        else:
+            found = [os.path.join(self.folder, f) for f in os.listdir(self.folder)]
+        return sorted(p for p in found if os.path.isfile(p) and p.lower().endswith(self.IMAGE_EXTENSIONS))
+
+    def load_checkpoint(self) -> set[tuple[str, str]]:
+        """(relative path, sha256) of images that already have a successful result for this mode and prompt."""
+        done: set[tuple[str, str]] = set()
+        try:
+            with open(self.results_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short by an interrupted run
+                    if rec.get("ok") and rec.get("mode") == self.mode and rec.get("prompt") == self.user_prompt:
+                        done.add((rec.get("image", ""), rec.get("sha256", "")))
+        except OSError:
+            pass
+        return done
+
+    def _record(self, rec: dict[str, Any], text: str) -> None:
+        with self._results_lock:
+            if rec["ok"]:
+                md_path = os.path.join(self.out_dir, os.path.splitext(rec["image"])[0] + ".md")
+                os.makedirs(os.path.dirname(md_path), exist_ok=True)
+                with open(md_path, "w", encoding="utf-8") as f:
+                    f.write(f"# {rec['image']}\n\n## Analysis\n{text.strip()}\n")
+            with open(self.results_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(dict(rec, text=text), ensure_ascii=False) + "\n")
+                f.flush()
+
+    # ---------- analysis ----------
+    @staticmethod
+    def _png_bytes(path: str) -> bytes:
+        """The image as PNG, as the popup sends attachments."""
+        with Image.open(path) as img:
+            if img.mode not in ("RGB", "RGBA", "L"):
+                img = img.convert("RGBA")
+            out = BytesIO()
+            img.save(out, format="PNG")
+            return out.getvalue()
+
+    async def _analyze(self, path: str, rel: str, digest: str, data: bytes) -> dict[str, Any]:
+        budgeter = self.budgeter
+        prompt_text = build_analysis_prompt(self.mode, self.user_prompt, "")
+        requested = budgeter.estimate(prompt_text) + budgeter.image_tokens(data)
+        name = self.profile
+        if name == LatencyProfiles.AUTO:
+            name = self.profiles.choose("visionize", requested, 1)
+        profile = self.profiles.resolve(name, self.model_name, self.context_budget_tokens)
+        if profile["max_image_side"]:
+            data = await asyncio.to_thread(LatencyProfiles.cap_image, data, profile["max_image_side"])
+        tokens = budgeter.estimate(prompt_text) + budgeter.image_tokens(data)
+        contents = [types.Content(role="user", parts=[
+            types.Part.from_bytes(data=data, mime_type="image/png"),
+            types.Part.from_text(text=prompt_text),
+        ])]
+        cfg = LatencyProfiles.generation_config(profile)
+        chunks: list[str] = []
+        first: list[float] = []
+        started = time.monotonic()
+
+        def _on_chunk(text: str) -> None:
+            if not first:
+                first.append(time.monotonic() - started)
+            chunks.append(text)
+
+        rec: dict[str, Any] = {"image": rel, "sha256": digest, "mode": self.mode, "prompt": self.user_prompt, "profile": name,
+                               "model": profile["model"], "ok": False, "error": ""}
+        try:
+            await asyncio.wait_for(
+                self.engine.stream(lambda client, key: open_generation(client, profile, contents, cfg), _on_chunk,
+                                   tokens=tokens),
+                self.deadline_s)
+            rec["ok"] = bool("".join(chunks).strip())
+            if not rec["ok"]:
+                rec["error"] = "empty response"
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            rec["error"] = f"timed out after {self.deadline_s:.0f}s"
+        except Exception as e:
+            rec["error"] = f"{type(e).__name__}: {e}"
+        rec["latency_s"] = round(time.monotonic() - started, 3)
+        rec["ttft_s"] = round(first[0], 3) if first else None
+        rec["tokens"] = tokens
+        await asyncio.to_thread(self._record, rec, "".join(chunks))
+        return rec
+
+    async def _run_all(self, todo: list[tuple[str, str, str]], on_progress) -> list[dict[str, Any]]:
+        # Bounded number of images in flight; the engine spreads their calls over the keys.
+        # Each image is loaded and converted only once it holds a slot, so memory stays
+        # bounded by the concurrency rather than the folder size.
+        gate = asyncio.Semaphore(self.concurrency)
+        results: list[dict[str, Any]] = []
+
+        async def _one(item):
+            path, rel, digest = item
+            async with gate:
+                try:
+                    data = await asyncio.to_thread(self._png_bytes, path)
+                except Exception as e:
+                    self.unreadable += 1
+                    print(f"  ! {rel}: cannot read image: {e}", file=sys.stderr)
+                    return
+                rec = await self._analyze(path, rel, digest, data)
+            results.append(rec)
+            on_progress(rec, len(results), len(todo))
+
+        await asyncio.gather(*(_one(item) for item in todo))
+        return results
+
+    def run(self) -> int:
+        """Process the folder; returns a process exit code (0 = every image succeeded)."""
+        if not self.api_keys:
+            print("No Gemini API key configured (Settings, config.json or GEMINI_API_KEY).", file=sys.stderr)
+            return 2
+        if not os.path.isdir(self.folder):
+            print(f"Not a folder: {self.folder}", file=sys.stderr)
+            return 2
+        os.makedirs(self.out_dir, exist_ok=True)
+        done = self.load_checkpoint()
+        todo: list[tuple[str, str, str]] = []
+        skipped = 0
+        self.unreadable = 0
+        for path in self.list_images():
+            rel = os.path.relpath(path, self.folder).replace(os.sep, "/")
             try:
-                return func()
-            except Exception as e:
-                last_err = e
-                if self._is_rate_limit_error(e) and self._rotate_api_key():
-                    continue
-                raise
-        if last_err:
-            raise last_err
+                h = hashlib.sha256()
+                with open(path, "rb") as f:
+                    for block in iter(lambda: f.read(1 << 20), b""):
+                        h.update(block)
+                digest = h.hexdigest()
+            except OSError as e:
+                self.unreadable += 1
+                print(f"  ! {rel}: cannot read image: {e}", file=sys.stderr)
+                continue
+            if (rel, digest) in done:
+                skipped += 1
+                continue
+            todo.append((path, rel, digest))
+        print(f"Batch Visionize: {len(todo)} image(s) to analyze, {skipped} already done; "
+              f"mode={self.mode}, profile={self.profile}, keys={len(self.api_keys)}, concurrency={self.concurrency}")
+
+        def _progress(rec: dict[str, Any], n: int, total: int) -> None:
+            status = f"ok {rec['latency_s']:.1f}s" if rec["ok"] else f"FAILED ({rec['error']})"
+            print(f"  [{n}/{total}] {rec['image']}: {status}", flush=True)
+
+        started = time.monotonic()
+        self.engine.start()
+        job = self.engine.submit(lambda: self._run_all(todo, _progress), name="Batch Visionize")
+        interrupted = False
+        try:
+            results = job.future.result() or []
+        except KeyboardInterrupt:
+            interrupted = True
+            job.cancel()
+            results = []
+            print("Interrupted; completed images are kept in the checkpoint.", file=sys.stderr)
+        finally:
+            self._save_key_quota()
+            self.engine.stop()
+        elapsed = time.monotonic() - started
+        if not interrupted:
+            self._print_stats(results, skipped, self.unreadable, elapsed)
+        failed = sum(1 for r in results if not r["ok"]) + self.unreadable
+        return 1 if (failed or interrupted) else 0
+
+    def _print_stats(self, results: list[dict[str, Any]], skipped: int, unreadable: int, elapsed: float) -> None:
+        ok = [r for r in results if r["ok"]]
+        failed = [r for r in results if not r["ok"]]
+        latencies = sorted(r["latency_s"] for r in ok)
+        ttfts = sorted(r["ttft_s"] for r in ok if r.get("ttft_s") is not None)
+
+        def pct(values: list[float], p: float) -> str:
+            return f"{values[min(len(values) - 1, int(p * len(values)))]:.1f}s" if values else "n/a"
+
+        print(f"\nDone in {elapsed:.1f}s: {len(ok)} ok, {len(failed)} failed, {skipped} skipped (checkpoint), "
+              f"{unreadable} unreadable")
+        if results and elapsed > 0:
+            print(f"Throughput: {len(ok) / elapsed * 60:.1f} images/min; "
+                  f"~{sum(r['tokens'] for r in ok) / elapsed * 60 / 1000:.1f}k input tokens/min")
+        if latencies:
+            print(f"Latency p50 {pct(latencies, 0.5)}, p95 {pct(latencies, 0.95)}, max {latencies[-1]:.1f}s; "
+                  f"first token p50 {pct(ttfts, 0.5)}")
+        if failed:
+            kinds: dict[str, int] = {}
+            for r in failed:
+                kind = r["error"].split(":", 1)[0]
+                kinds[kind] = kinds.get(kind, 0) + 1
+            print("Errors: " + ", ".join(f"{k} x{n}" for k, n in sorted(kinds.items(), key=lambda kv: -kv[1])))
+            print("Rerun the same command to retry the failed images.")
+        print(f"Results: {self.results_path}")
+
+    def _save_key_quota(self) -> None:
+        """Persist learned per-key limits and cooldowns, through the popup's config writer.
+
+        Only ``key_quota`` (and its version) changes; the file is re-read just before
+        the write so settings saved by the popup in the meantime are kept.
+        """
+        try:
+            with open(self.config_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            data["key_quota"] = self.scheduler.export_state()
+            data["key_quota_version"] = GeminiKeyScheduler.STATE_VERSION
+            write_config_file(self.config_path, data)
+        except Exception as e:
+            self._log(f"Could not save key quota: {e}")
+
+
+def run_batch_cli(argv: list[str]) -> int:
+    import argparse
+    parser = argparse.ArgumentParser(prog="MagicInput.py --batch",
+                                     description="Visionize every image in a folder without opening the popup.")
+    parser.add_argument("--batch", metavar="DIR", required=True, help="Folder of images to analyze")
+    parser.add_argument("--out", metavar="DIR", help="Output folder (default: DIR/visionize)")
+    parser.add_argument("--mode", choices=("plan", "describe", "combine"), default="describe")
+    parser.add_argument("--prompt", default="", help="User request sent with every image")
+    parser.add_argument("--concurrency", type=int, help="Images in flight (default: ai_max_concurrency)")
+    parser.add_argument("--profile", choices=(LatencyProfiles.AUTO,) + LatencyProfiles.NAMES,
+                        help="Latency profile (default: the Visionize profile from Settings)")
+    parser.add_argument("--recursive", action="store_true", help="Include images in subfolders")
+    parser.add_argument("--verbose", action="store_true", help="Print engine debug messages")
+    args = parser.parse_args(argv)
+    batch = BatchVisionizer(args.batch, out_dir=args.out, mode=args.mode, prompt=args.prompt,
+                            concurrency=args.concurrency, profile=args.profile, recursive=args.recursive,
+                            verbose=args.verbose)
+    return batch.run()
+
+
+# ---------------------------------------------------------------------- terminal capture
+
+def run_capture_cli(argv: list[str]) -> int:
+    """Run a command (default: the user's shell) and tee its output into the terminal ring."""
+    import argparse
+    parser = argparse.ArgumentParser(prog="MagicInput.py --capture",
+                                     description="Run a command in this terminal and keep its recent output "
+                                                 "for Visionize's terminal context.")
+    parser.add_argument("--capture", action="store_true", required=True)
+    parser.add_argument("--size-kb", type=int, default=1024, help="Ring buffer size (default: 1024 KB)")
+    parser.add_argument("command", nargs=argparse.REMAINDER, help="Command to run (default: $SHELL / %%COMSPEC%%)")
+    args = parser.parse_args(argv)
+    command = args.command[1:] if args.command[:1] == ["--"] else args.command
+    if os.environ.get("MAGICINPUT_CAPTURE"):
+        print("This terminal is already being captured.", file=sys.stderr)
+        return 2
+    if not command:
+        command = [os.environ.get("COMSPEC", "cmd.exe")] if platform.system() == "Windows" else [os.environ.get("SHELL", "/bin/sh")]
+    ring_path = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), "MagicInput", TerminalRing.FILENAME)
+    ring = TerminalRing(ring_path, args.size_kb * 1024)
+    os.environ["MAGICINPUT_CAPTURE"] = "1"
+    stamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    ring.write(f"\n[capture started {stamp}] $ {' '.join(command)}\n".encode("utf-8"))
+    try:
+        if platform.system() != "Windows":
+            import pty
+
+            def _read(fd: int) -> bytes:
+                data = os.read(fd, 65536)
+                ring.write(data)
+                return data
+            return os.waitstatus_to_exitcode(pty.spawn(command, _read))
+        # No pty on Windows: the output is piped, so some programs buffer it or drop colours
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        assert proc.stdout is not None
+        while True:
+            data = proc.stdout.read1(65536)
+            if not data:
+                break
+            sys.stdout.buffer.write(data)
+            sys.stdout.buffer.flush()
+            ring.write(data)
+        return proc.wait()
+    except FileNotFoundError as e:
+        print(f"Cannot run {command[0]}: {e}", file=sys.stderr)
+        return 127
+    except KeyboardInterrupt:
+        return 130
+    finally:
+        ring.close()
 
 
 # ---------------------------------------------------------------------- entry-point
 
 def main() -> None:
+    # Headless batch mode: python MagicInput.py --batch DIR [options]
+    if any(arg == "--batch" or arg.startswith("--batch=") for arg in sys.argv[1:]):
+        sys.exit(run_batch_cli(sys.argv[1:]))
+    # Terminal capture wrapper: python MagicInput.py --capture [-- command ...]
+    if sys.argv[1:2] == ["--capture"]:
+        sys.exit(run_capture_cli(sys.argv[1:]))
+
     if platform.system() == 'Windows':
         root = TkinterDnD.Tk()
     else:
@@ -0,0 +1,513 @@
+# gemini_standin.py
+# Local stand-in for the Gemini API, for exercising MagicInput's AI paths offline.
+#
+#   fake    Simulated backend: latency distributions, SSE streaming, per-key 429
+#           storms / RPM limits, 5xx errors and dropped streams. No keys needed.
+#   record  Proxy to the real API that stores every response as a fixture.
+#   replay  Serve recorded fixtures (optionally with their original timing).
+#
+# Point MagicInput at it with the MAGICINPUT_GEMINI_BASE_URL environment variable
+# (or "gemini_base_url" in MagicInput/config.json), e.g.
+#
+#   python scripts/gemini_standin.py fake --port 8765 --p429 0.05 --p5xx 0.02
+#   set MAGICINPUT_GEMINI_BASE_URL=http://127.0.0.1:8765
+#
+# Only the endpoints MagicInput uses are implemented: generateContent,
+# streamGenerateContent, countTokens, resumable file upload / files.get and
+# cachedContents create / delete. GET /_standin/stats returns request counters.
+
+import argparse
+import datetime
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+
+UPSTREAM = "https://generativelanguage.googleapis.com"
+MODEL_CALLS = (":generateContent", ":streamGenerateContent", ":countTokens")
+HEADINGS = ("Overview:", "Describe Image:", "Plan:")
+WORDS = ("the", "layout", "button", "panel", "shows", "error", "state", "value", "list", "header",
+         "update", "should", "check", "render", "input", "field", "log", "request", "align", "spacing")
+
+
+def _iso(ts: float) -> str:
+    return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def _prompt_text(body: dict[str, Any]) -> str:
+    """Concatenated text parts of a generate/countTokens request."""
+    texts: list[str] = []
+    contents = body.get("contents") or (body.get("generateContentRequest") or {}).get("contents") or []
+    if isinstance(contents, dict):
+        contents = [contents]
+    for content in contents:
+        for part in (content or {}).get("parts", []) or []:
+            if isinstance(part, dict) and isinstance(part.get("text"), str):
+                texts.append(part["text"])
+    return "\n".join(texts)
+
+
+def _estimate_tokens(text: str) -> int:
+    return max(1, len(text.encode("utf-8")) // 4)
+
+
+class FakeBackend:
+    """Synthetic responses with configurable latency and failure behaviour."""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.files: dict[str, dict[str, Any]] = {}
+        self.uploads: dict[str, dict[str, Any]] = {}
+        self.storms: dict[str, float] = {}
+        self.recent: dict[str, list[float]] = {}
+        self.stats: dict[str, int] = {}
+
+    def count(self, name: str) -> None:
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + 1
+
+    def sample_ms(self, median_ms: float, sigma: float) -> float:
+        """Log-normal latency with the given median (ms) and shape."""
+        with self.lock:
+            return median_ms * math.exp(sigma * self.rng.gauss(0.0, 1.0))
+
+    def chance(self, p: float) -> bool:
+        with self.lock:
+            return self.rng.random() < p
+
+    # ---------- faults ----------
+    def fault_for(self, api_key: str) -> tuple[int, dict[str, Any]] | None:
+        """Rate-limit or server error to return instead of a model response, if any."""
+        now = time.time()
+        a = self.args
+        with self.lock:
+            storm_until = self.storms.get(api_key, 0.0)
+            if storm_until <= now and self.rng.random() < a.p429:
+                storm_until = now + a.storm_s
+                self.storms[api_key] = storm_until
+            window = [t for t in self.recent.get(api_key, []) if t > now - 60]
+            over_rpm = a.rpm > 0 and len(window) >= a.rpm
+            if not over_rpm and storm_until <= now:
+                window.append(now)
+            self.recent[api_key] = window
+        if storm_until > now or over_rpm:
+            retry = storm_until - now if storm_until > now else 60 - (now - window[0])
+            self.count("429")
+            return 429, {"error": {
+                "code": 429,
+                "message": "You exceeded your current quota (stand-in).",
+                "status": "RESOURCE_EXHAUSTED",
+                "details": [
+                    {"@type": "type.googleapis.com/google.rpc.QuotaFailure",
+                     "violations": [{"quotaMetric": "generativelanguage.googleapis.com/generate_content_free_tier_requests",
+                                     "quotaId": "GenerateRequestsPerMinutePerProjectPerModel-FreeTier",
+                                     "quotaValue": str(a.rpm or 10)}]},
+                    {"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": f"{max(1, int(retry))}s"},
+                ],
+            }}
+        if self.chance(a.p5xx):
+            self.count("5xx")
+            code, status = (503, "UNAVAILABLE") if self.chance(0.7) else (500, "INTERNAL")
+            return code, {"error": {"code": code, "message": "The model is overloaded (stand-in).", "status": status}}
+        return None
+
+    # ---------- content ----------
+    def answer(self, prompt: str) -> str:
+        """Text shaped like the real answer: requested headings, or a refined prompt."""
+        marker = prompt.find("EXACTLY the following section headings")
+        requested = [h for h in HEADINGS if marker >= 0 and h in prompt[marker:marker + 200]]
+        words = self.args.words
+        with self.lock:
+            def para(n: int) -> str:
+                return " ".join(self.rng.choice(WORDS) for _ in range(n)).capitalize() + "."
+        if requested:
+            per = max(5, words // len(requested))
+            blocks = []
+            for h in requested:
+                if h == "Plan:":
+                    blocks.append(h + "\n" + "\n".join(f"- {para(max(4, per // 5))}" for _ in range(5)))
+                else:
+                    blocks.append(h + "\n" + para(per))
+            return "\n\n".join(blocks)
+        if "USER_PROMPT:" in prompt:
+            return "- Primary Goal: " + para(12) + "\n- Desired Outcome: " + para(10) + "\n- Instruction: " + para(10)
+        return para(words)
+
+    def chunks(self, text: str) -> list[str]:
+        words = re.findall(r"\S+\s*", text)
+        size = max(1, self.args.chunk_words)
+        return ["".join(words[i:i + size]) for i in range(0, len(words), size)] or [""]
+
+    @staticmethod
+    def response_json(text: str, prompt_tokens: int, finish: bool = True) -> dict[str, Any]:
+        out_tokens = _estimate_tokens(text)
+        resp: dict[str, Any] = {
+            "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}],
+            "modelVersion": "standin",
+        }
+        if finish:
+            resp["candidates"][0]["finishReason"] = "STOP"
+            resp["usageMetadata"] = {"promptTokenCount": prompt_tokens, "candidatesTokenCount": out_tokens,
+                                     "totalTokenCount": prompt_tokens + out_tokens}
+        return resp
+
+    # ---------- files / caches ----------
+    def new_file(self, origin: str, meta: dict[str, Any]) -> dict[str, Any]:
+        fid = uuid.uuid4().hex[:12]
+        info = {
+            "name": f"files/{fid}",
+            "displayName": meta.get("displayName", ""),
+            "mimeType": meta.get("mimeType", "application/octet-stream"),
+            "sizeBytes": str(meta.get("sizeBytes", 0)),
+            "createTime": _iso(time.time()),
+            "expirationTime": _iso(time.time() + 48 * 3600),
+            "uri": f"{origin}/v1beta/files/{fid}",
+            "state": "ACTIVE",
+        }
+        with self.lock:
+            self.files[fid] = info
+        return info
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    server_version = "GeminiStandin/1.0"
+    backend: FakeBackend | None = None
+    mode = "fake"
+    fixtures = ""
+    upstream = UPSTREAM
+    realtime = False
+
+    def log_message(self, fmt: str, *args: Any) -> None:
+        if not getattr(self.server, "quiet", False):
+            sys.stderr.write("[standin] " + (fmt % args) + "\n")
+
+    # ---------- helpers ----------
+    @property
+    def origin(self) -> str:
+        host = self.headers.get("Host") or f"{self.server.server_address[0]}:{self.server.server_address[1]}"
+        return f"http://{host}"
+
+    def _body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _api_key(self) -> str:
+        key = self.headers.get("x-goog-api-key") or ""
+        if not key:
+            m = re.search(r"[?&]key=([^&]+)", self.path)
+            key = m.group(1) if m else ""
+        return key
+
+    def _send_json(self, code: int, payload: Any, headers: dict[str, str] | None = None) -> None:
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _start_sse(self) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+    def _sse(self, payload: Any) -> None:
+        self.wfile.write(b"data: " + json.dumps(payload).encode("utf-8") + b"\r\n\r\n")
+        self.wfile.flush()
+
+    @staticmethod
+    def fixture_key(method: str, path: str, body: bytes) -> str:
+        """Request identity for record/replay: method, path (no query/key) and canonical body."""
+        try:
+            canon = json.dumps(json.loads(body), sort_keys=True).encode("utf-8") if body else b""
+        except ValueError:
+            canon = body
+        return hashlib.sha256(method.encode() + b" " + path.split("?")[0].encode() + b"\n" + canon).hexdigest()
+
+    # ---------- dispatch ----------
+    def do_GET(self) -> None:
+        self._dispatch("GET")
+
+    def do_POST(self) -> None:
+        self._dispatch("POST")
+
+    def do_DELETE(self) -> None:
+        self._dispatch("DELETE")
+
+    def _dispatch(self, method: str) -> None:
+        body = self._body() if method != "GET" else b""
+        try:
+            if self.path.startswith("/_standin/stats"):
+                stats = dict(self.backend.stats) if self.backend else {}
+                self._send_json(200, {"mode": self.mode, "stats": stats})
+            elif self.mode == "fake":
+                self._fake(method, body)
+            elif self.mode == "record":
+                self._record(method, body)
+            else:
+                self._replay(method, body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    # ---------- fake ----------
+    def _fake(self, method: str, body: bytes) -> None:
+        b = self.backend
+        assert b is not None
+        path = self.path.split("?")[0]
+        route = re.sub(r"/(files|cachedContents|_upload)/[^/:]+", r"/\1/*", re.sub(r"models/[^:]+", "models/*", path))
+        b.count(f"{method} {route}")
+        req = json.loads(body) if body and body[:1] in b"{[" else {}
+
+        if method == "POST" and path.endswith("/files") and self.headers.get("X-Goog-Upload-Protocol"):
+            upload_id = uuid.uuid4().hex[:16]
+            meta = (req.get("file") or {})
+            meta.setdefault("sizeBytes", self.headers.get("X-Goog-Upload-Header-Content-Length", "0"))
+            meta.setdefault("mimeType", self.headers.get("X-Goog-Upload-Header-Content-Type", "image/png"))
+            with b.lock:
+                b.uploads[upload_id] = {"meta": meta, "size": 0}
+            self._send_json(200, {}, {"X-Goog-Upload-URL": f"{self.origin}/_upload/{upload_id}",
+                                      "X-Goog-Upload-Status": "active"})
+            return
+        if method == "POST" and path.startswith("/_upload/"):
+            upload_id = path.rsplit("/", 1)[-1]
+            with b.lock:
+                up = b.uploads.get(upload_id)
+            if up is None:
+                self._send_json(404, {"error": {"code": 404, "message": "upload not found", "status": "NOT_FOUND"}})
+                return
+            up["size"] += len(body)
+            if "finalize" in (self.headers.get("X-Goog-Upload-Command") or ""):
+                up["meta"]["sizeBytes"] = up["size"]
+                info = b.new_file(self.origin, up["meta"])
+                self._send_json(200, {"file": info}, {"X-Goog-Upload-Status": "final"})
+            else:
+                self._send_json(200, {}, {"X-Goog-Upload-Status": "active"})
+            return
+        if method == "GET" and "/files/" in path:
+            with b.lock:
+                info = b.files.get(path.rsplit("/", 1)[-1])
+            if info is None:
+                self._send_json(404, {"error": {"code": 404, "message": "File not found.", "status": "NOT_FOUND"}})
+            else:
+                self._send_json(200, info)
+            return
+        if path.endswith("/cachedContents") and method == "POST":
+            text = _prompt_text(req)
+            if _estimate_tokens(text) < self.server.min_cache_tokens:  # type: ignore[attr-defined]
+                self._send_json(400, {"error": {"code": 400, "status": "INVALID_ARGUMENT",
+                                                "message": "Cached content is too small. min_total_token_count is "
+                                                           f"{self.server.min_cache_tokens}"}})  # type: ignore[attr-defined]
+                return
+            ttl = float(str(req.get("ttl", "3600s")).rstrip("s") or 3600)
+            self._send_json(200, {"name": f"cachedContents/{uuid.uuid4().hex[:12]}", "model": req.get("model"),
+                                  "displayName": req.get("displayName", ""), "expireTime": _iso(time.time() + ttl),
+                                  "usageMetadata": {"totalTokenCount": _estimate_tokens(text)}})
+            return
+        if "/cachedContents/" in path and method == "DELETE":
+            self._send_json(200, {})
+            return
+        if method == "POST" and any(path.endswith(c) for c in MODEL_CALLS):
+            self._fake_model_call(path, req)
+            return
+        self._send_json(404, {"error": {"code": 404, "message": f"stand-in: no route for {method} {path}",
+                                        "status": "NOT_FOUND"}})
+
+    def _fake_model_call(self, path: str, req: dict[str, Any]) -> None:
+        b = self.backend
+        assert b is not None
+        a = b.args
+        prompt = _prompt_text(req)
+        prompt_tokens = _estimate_tokens(prompt) + 258 * json.dumps(req).count('"inlineData"') + 258 * json.dumps(req).count('"fileData"')
+        if path.endswith(":countTokens"):
+            self._send_json(200, {"totalTokens": prompt_tokens})
+            return
+        fault = b.fault_for(self._api_key())
+        ttft = b.sample_ms(a.ttft_ms, a.ttft_sigma) / 1000.0
+        if fault is not None:
+            time.sleep(min(ttft, 0.2))
+            self._send_json(*fault)
+            return
+        text = b.answer(prompt)
+        time.sleep(ttft)
+        if path.endswith(":generateContent"):
+            time.sleep(b.sample_ms(a.chunk_ms, 0.3) * len(b.chunks(text)) / 1000.0)
+            self._send_json(200, b.response_json(text, prompt_tokens))
+            b.count("ok")
+            return
+        parts = b.chunks(text)
+        self._start_sse()
+        for i, part in enumerate(parts):
+            last = i == len(parts) - 1
+            if i > 0:
+                time.sleep(b.sample_ms(a.chunk_ms, 0.3) / 1000.0)
+                if b.chance(a.p_drop):
+                    b.count("dropped")
+                    return
+            self._sse(b.response_json(part, prompt_tokens, finish=last))
+        b.count("ok")
+
+    # ---------- record / replay ----------
+    def _fixture_path(self, key: str) -> str:
+        return os.path.join(self.fixtures, f"{key}.json")
+
+    def _record(self, method: str, body: bytes) -> None:
+        key = self.fixture_key(method, self.path, body)
+        headers = {k: v for k, v in self.headers.items()
+                   if k.lower() not in ("host", "content-length", "connection", "accept-encoding")}
+        req = urllib.request.Request(self.upstream + self.path, data=body or None, method=method, headers=headers)
+        started = time.monotonic()
+        try:
+            resp = urllib.request.urlopen(req, timeout=600)
+            status = resp.status
+        except urllib.error.HTTPError as e:
+            resp, status = e, e.code
+        out_headers = {}
+        for k in ("Content-Type", "X-Goog-Upload-URL", "X-Goog-Upload-Status"):
+            v = resp.headers.get(k)
+            if v:
+                # Keep resumable uploads flowing through whichever stand-in serves them
+                out_headers[k] = v.replace(self.upstream, "{origin}") if k == "X-Goog-Upload-URL" else v
+        streaming = "text/event-stream" in (out_headers.get("Content-Type") or "")
+        self.send_response(status)
+        for k, v in out_headers.items():
+            self.send_header(k, v.replace("{origin}", self.origin))
+        chunks: list[str] = []
+        delays: list[float] = []
+        if streaming:
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            for raw in resp:
+                line = raw.decode("utf-8", errors="replace")
+                self.wfile.write(raw)
+                self.wfile.flush()
+                if line.startswith("data:"):
+                    chunks.append(line[5:].strip())
+                    delays.append(round(time.monotonic() - started, 3))
+        else:
+            data = resp.read()
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            chunks.append(data.decode("utf-8", errors="replace"))
+            delays.append(round(time.monotonic() - started, 3))
+        fixture = {
+            "request": {"method": method, "path": self.path.split("?")[0]},
+            "status": status,
+            "headers": out_headers,
+            "stream": streaming,
+            "chunks": chunks,
+            "delays": delays,
+        }
+        os.makedirs(self.fixtures, exist_ok=True)
+        with open(self._fixture_path(key), "w", encoding="utf-8") as f:
+            json.dump(fixture, f, indent=1)
+
+    def _replay(self, method: str, body: bytes) -> None:
+        key = self.fixture_key(method, self.path, body)
+        try:
+            with open(self._fixture_path(key), "r", encoding="utf-8") as f:
+                fixture = json.load(f)
+        except OSError:
+            self._send_json(501, {"error": {"code": 501, "status": "UNIMPLEMENTED",
+                                            "message": f"stand-in replay: no fixture {key[:12]} for {method} {self.path.split('?')[0]}"}})
+            return
+        started = time.monotonic()
+
+        def _wait(i: int) -> None:
+            if self.realtime and i < len(fixture.get("delays", [])):
+                time.sleep(max(0.0, fixture["delays"][i] - (time.monotonic() - started)))
+
+        headers = {k: (v.replace("{origin}", self.origin)) for k, v in fixture.get("headers", {}).items()}
+        if not fixture.get("stream"):
+            _wait(0)
+            data = (fixture["chunks"][0] if fixture["chunks"] else "").encode("utf-8")
+            self.send_response(fixture["status"])
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        self.send_response(fixture["status"])
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        for i, chunk in enumerate(fixture["chunks"]):
+            _wait(i)
+            self.wfile.write(b"data: " + chunk.encode("utf-8") + b"\r\n\r\n")
+            self.wfile.flush()
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Local Gemini API stand-in (fake / record / replay).")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--quiet", action="store_true", help="Do not log each request")
+    sub = parser.add_subparsers(dest="mode", required=True)
+
+    fake = sub.add_parser("fake", help="Simulated backend")
+    fake.add_argument("--ttft-ms", type=float, default=700, help="Median time to first token")
+    fake.add_argument("--ttft-sigma", type=float, default=0.5, help="Log-normal shape of the TTFT distribution")
+    fake.add_argument("--chunk-ms", type=float, default=40, help="Median gap between stream chunks")
+    fake.add_argument("--chunk-words", type=int, default=8)
+    fake.add_argument("--words", type=int, default=160, help="Approximate answer length")
+    fake.add_argument("--p429", type=float, default=0.0, help="Chance a request starts a 429 storm for its key")
+    fake.add_argument("--storm-s", type=float, default=20.0, help="Length of a 429 storm")
+    fake.add_argument("--rpm", type=int, default=0, help="Per-key requests per minute (0 = unlimited)")
+    fake.add_argument("--p5xx", type=float, default=0.0, help="Chance of a 500/503 response")
+    fake.add_argument("--p-drop", type=float, default=0.0, help="Chance per chunk of dropping a stream")
+    fake.add_argument("--min-cache-tokens", type=int, default=1024)
+    fake.add_argument("--seed", type=int, default=None)
+
+    rec = sub.add_parser("record", help="Proxy to the real API and store fixtures")
+    rec.add_argument("--fixtures", default="fixtures")
+    rec.add_argument("--upstream", default=UPSTREAM)
+
+    rep = sub.add_parser("replay", help="Serve stored fixtures")
+    rep.add_argument("--fixtures", default="fixtures")
+    rep.add_argument("--realtime", action="store_true", help="Reproduce the recorded timing")
+
+    args = parser.parse_args(argv)
+    StandinHandler.mode = args.mode
+    if args.mode == "fake":
+        StandinHandler.backend = FakeBackend(args)
+    else:
+        StandinHandler.fixtures = os.path.abspath(args.fixtures)
+        StandinHandler.upstream = getattr(args, "upstream", UPSTREAM).rstrip("/")
+        StandinHandler.realtime = bool(getattr(args, "realtime", False))
+
+    server = ThreadingHTTPServer((args.host, args.port), StandinHandler)
+    server.daemon_threads = True
+    server.quiet = args.quiet  # type: ignore[attr-defined]
+    server.min_cache_tokens = getattr(args, "min_cache_tokens", 1024)  # type: ignore[attr-defined]
+    print(f"Gemini stand-in ({args.mode}) on http://{args.host}:{args.port}  "
+          f"-> set MAGICINPUT_GEMINI_BASE_URL=http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
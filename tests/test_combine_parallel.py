@@ -0,0 +1,70 @@
+import asyncio
+import os
+import sys
+import unittest
+
+os.environ.setdefault("PYSTRAY_BACKEND", "dummy")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import MagicInput  # noqa: E402
+
+
+def make_popup(describe_chunks, plan_chunks, describe_error=None):
+    """An InputPopup without Tk whose single-call stream is scripted per section list."""
+    popup = object.__new__(MagicInput.InputPopup)
+    popup.plan_cancelled = False
+
+    async def fake_stream(request, on_chunk, sections=None, hedge=True):
+        if sections == ["Plan:"]:
+            try:
+                for chunk in plan_chunks:
+                    await asyncio.sleep(0)
+                    on_chunk(chunk)
+                await asyncio.sleep(0.05)
+            except asyncio.CancelledError:
+                popup.plan_cancelled = True
+                raise
+            return
+        for chunk in describe_chunks:
+            await asyncio.sleep(0.01)
+            on_chunk(chunk)
+        if describe_error is not None:
+            raise describe_error
+
+    popup._stream_visionize = fake_stream
+    return popup
+
+
+class CombineParallelTest(unittest.TestCase):
+    def run_combine(self, popup):
+        received = []
+        asyncio.run(popup._stream_combine_parallel({}, received.append))
+        return received
+
+    def test_plan_is_appended_after_the_describe_answer(self):
+        popup = make_popup(["Overview:\nA form.", "\n\nDescribe Image:\nTwo fields."],
+                           ["Plan:\n1. Add", " validation."])
+        received = self.run_combine(popup)
+        self.assertEqual(received[:2], ["Overview:\nA form.", "\n\nDescribe Image:\nTwo fields."])
+        self.assertEqual("".join(received),
+                         "Overview:\nA form.\n\nDescribe Image:\nTwo fields.\n\nPlan:\n1. Add validation.")
+
+    def test_missing_plan_heading_is_added(self):
+        popup = make_popup(["Overview:\nA form."], ["  1. Add validation."])
+        received = self.run_combine(popup)
+        self.assertEqual("".join(received), "Overview:\nA form.\n\nPlan:\n1. Add validation.")
+
+    def test_short_plan_is_flushed_at_the_end(self):
+        popup = make_popup(["Overview:\nA form."], ["Ok"])
+        received = self.run_combine(popup)
+        self.assertEqual("".join(received), "Overview:\nA form.\n\nPlan:\nOk")
+
+    def test_describe_failure_cancels_the_plan(self):
+        popup = make_popup(["Overview:\n"], ["Plan:\n1. Step"], describe_error=RuntimeError("boom"))
+        with self.assertRaises(RuntimeError):
+            self.run_combine(popup)
+        self.assertTrue(popup.plan_cancelled)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+os.environ.setdefault("PYSTRAY_BACKEND", "dummy")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import MagicInput  # noqa: E402
+
+
+class ConfigFileTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        self.path = os.path.join(self.tmp, "config.json")
+
+    def test_write_replaces_whole_file_compactly(self):
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write('{"model": "old", "stale": true, "padding": "' + "x" * 1000 + '"}')
+        MagicInput.write_config_file(self.path, {"model": "gemini-2.5-flash"})
+        with open(self.path, encoding="utf-8") as f:
+            self.assertEqual(f.read(), '{"model": "gemini-2.5-flash"}')
+        self.assertEqual(os.listdir(self.tmp), ["config.json"])
+
+    def test_batch_saves_only_key_quota_in_popup_format(self):
+        settings = {"model": "gemini-2.5-flash", "ui_prefs": {"theme": "dark"}}
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(settings, f)
+        batch = object.__new__(MagicInput.BatchVisionizer)
+        batch.config_path = self.path
+        batch.scheduler = MagicInput.GeminiKeyScheduler()
+        batch.scheduler.record_rate_limit("key-1", {"rpm": 5, "retry_after": 30})
+        batch._log = lambda *a, **k: None
+        batch._save_key_quota()
+        with open(self.path, encoding="utf-8") as f:
+            text = f.read()
+        self.assertNotIn("\n", text)
+        data = json.loads(text)
+        self.assertEqual({k: data[k] for k in settings}, settings)
+        self.assertEqual(data["key_quota"], batch.scheduler.export_state())
+        self.assertEqual(data["key_quota_version"], MagicInput.GeminiKeyScheduler.STATE_VERSION)
+        self.assertEqual(os.listdir(self.tmp), ["config.json"])
+
+
+if __name__ == "__main__":
+    unittest.main()
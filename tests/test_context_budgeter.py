@@ -0,0 +1,49 @@
+import os
+import sys
+import tempfile
+import unittest
+
+os.environ.setdefault("PYSTRAY_BACKEND", "dummy")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import MagicInput  # noqa: E402
+
+
+class StaleLineRangeTest(unittest.TestCase):
+    """Attached files can shrink after their line range was recorded."""
+
+    def setUp(self):
+        self.budgeter = MagicInput.ContextBudgeter()
+        self.extractor = MagicInput.FileContextExtractor(margin_lines=5)
+        self.dir = tempfile.mkdtemp()
+
+    def _write(self, name, text):
+        path = os.path.join(self.dir, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+        return path
+
+    def test_trim_around_clamps_to_existing_lines(self):
+        self.assertEqual(self.budgeter.trim_around([], 5, 6, 100), (1, 0))
+        self.assertEqual(self.budgeter.trim_around(["a\n", "b\n"], 10, 12, 100), (1, 2))
+
+    def test_range_past_end_of_small_file(self):
+        path = self._write("a.py", "a\nb\nc\n")
+        blocks = self.budgeter.pack_files([self.extractor.extract(path, (10, 20, 30))], 1000)
+        self.assertEqual(len(blocks), 1)
+        self.assertIn("past its end", blocks[0])
+
+    def test_range_in_emptied_file(self):
+        path = self._write("a.py", "")
+        blocks = self.budgeter.pack_files([self.extractor.extract(path, (10, 20, 30))], 1000)
+        self.assertIn("no longer exist", blocks[0])
+
+    def test_range_past_end_of_mapped_file(self):
+        path = self._write("big.py", "x = 1\n" * 200_000)
+        excerpt = self.extractor.extract(path, (900_000, 900_010, 900_010))
+        blocks = self.budgeter.pack_files([excerpt], 1000)
+        self.assertIn("no longer exist", blocks[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import sys
+import time
+import types
+import unittest
+
+os.environ.setdefault("PYSTRAY_BACKEND", "dummy")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import MagicInput  # noqa: E402
+
+
+class ApiError(Exception):
+    def __init__(self, code, message):
+        super().__init__(f"{code} {message}")
+        self.code = code
+
+
+class FakeCaches:
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def create(self, model, config):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return types.SimpleNamespace(name=f"cachedContents/{self.calls}", expire_time=None)
+
+    def delete(self, name):
+        pass
+
+
+class ContextCacheFailureTest(unittest.TestCase):
+    TEXT = "project brief line\n" * 400
+
+    def _cache(self, *errors):
+        client = types.SimpleNamespace(caches=FakeCaches(errors))
+        return MagicInput.GeminiContextCache(), client
+
+    def test_transient_400_only_pauses_the_model(self):
+        cache, client = self._cache(ApiError(400, "INVALID_ARGUMENT: request contains an invalid argument"))
+        self.assertIsNone(cache.handle_for(client, "k", "m", self.TEXT))
+        self.assertIsNone(cache.handle_for(client, "k", "m", self.TEXT))
+        self.assertEqual(client.caches.calls, 1)
+        cache._model_paused_until["m"] = 0.0  # the pause has run out
+        self.assertEqual(cache.handle_for(client, "k", "m", self.TEXT), "cachedContents/2")
+
+    def test_unsupported_model_is_paused_longer(self):
+        cache, client = self._cache(ApiError(400, "Model m does not support cachedContent"))
+        self.assertIsNone(cache.handle_for(client, "k", "m", self.TEXT))
+        paused = cache._model_paused_until["m"] - time.time()
+        self.assertGreater(paused, MagicInput.GeminiContextCache.FAILURE_RETRY_S)
+
+    def test_too_small_block_does_not_pause_the_model(self):
+        cache, client = self._cache(ApiError(400, "Cached content is too small. min_total_token_count=4096"))
+        self.assertIsNone(cache.handle_for(client, "k", "m", self.TEXT))
+        self.assertNotIn("m", cache._model_paused_until)
+        self.assertEqual(cache.handle_for(client, "k", "m", self.TEXT + "more\n"), "cachedContents/2")
+
+
+if __name__ == "__main__":
+    unittest.main()
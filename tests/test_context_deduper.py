@@ -0,0 +1,59 @@
+import os
+import sys
+import unittest
+
+os.environ.setdefault("PYSTRAY_BACKEND", "dummy")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import MagicInput  # noqa: E402
+
+ContextDeduper = MagicInput.ContextDeduper
+
+FUNCTION = "\n".join([
+    "def load_settings(path):",
+    "    with open(path, encoding='utf-8') as handle:",
+    "        data = json.load(handle)",
+    "    data.setdefault('theme', 'dark')",
+    "    return Settings(**data)",
+])
+
+
+class ContextDeduperTests(unittest.TestCase):
+    def test_span_from_the_prompt_becomes_a_back_reference(self):
+        dedup = ContextDeduper()
+        dedup.seed("the user request", f"Why does this fail?\n{FUNCTION}")
+        out = dedup.dedupe("attached file settings.py", f"import json\n\n{FUNCTION}\n\nSETTINGS = None")
+        self.assertEqual(out.split("\n"), [
+            "import json", "",
+            "[... 5 lines omitted: already included above in the user request]", "",
+            "SETTINGS = None"])
+        self.assertGreater(dedup.saved_chars, 0)
+
+    def test_later_section_refers_to_the_first_one(self):
+        dedup = ContextDeduper()
+        first = dedup.dedupe("PROJECT OVERVIEW [settings.py:1-5]", FUNCTION)
+        second = dedup.dedupe("attached file settings.py", FUNCTION)
+        self.assertEqual(first, FUNCTION)
+        self.assertEqual(second, "[... 5 lines omitted: already included above in PROJECT OVERVIEW [settings.py:1-5]]")
+
+    def test_whitespace_differences_still_match(self):
+        dedup = ContextDeduper()
+        dedup.seed("the user request", FUNCTION.replace("    ", "\t"))
+        self.assertIn("already included above", dedup.dedupe("attached file settings.py", FUNCTION))
+
+    def test_short_repeated_lines_are_kept(self):
+        dedup = ContextDeduper()
+        braces = "}\n}\n}\n}\n}"
+        dedup.seed("the user request", braces)
+        self.assertEqual(dedup.dedupe("attached file a.js", braces), braces)
+
+    def test_unrelated_text_is_unchanged(self):
+        dedup = ContextDeduper()
+        dedup.seed("the user request", FUNCTION)
+        text = "\n".join(f"unrelated line number {i} with enough characters" for i in range(8))
+        self.assertEqual(dedup.dedupe("TERMINAL OUTPUT", text), text)
+        self.assertEqual(dedup.saved_chars, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
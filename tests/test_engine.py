@@ -0,0 +1,321 @@
+import asyncio
+import concurrent.futures
+import os
+import sys
+import threading
+import time
+import unittest
+
+os.environ.setdefault("PYSTRAY_BACKEND", "dummy")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import MagicInput  # noqa: E402
+
+
+class GeminiEngineSubmitTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = MagicInput.GeminiEngine(lambda key: None, lambda: ["k1"])
+        self.engine.start()
+        self.addCleanup(self.engine.stop)
+        # Deliver callbacks later, on another thread, the way call_tk does on the Tk loop
+        self.delivered = []
+
+    def _dispatch(self, func, delay=0):
+        self.delivered.append(func)
+
+    def _run_delivered(self):
+        for func in self.delivered:
+            func()
+
+    def test_failed_job_passes_exception_to_on_error(self):
+        errors = []
+
+        async def failing():
+            raise ValueError("boom")
+
+        job = self.engine.submit(failing, name="t", dispatch=self._dispatch, on_error=errors.append)
+        job.future.result(5)
+        self._run_delivered()
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], ValueError)
+        self.assertEqual(str(errors[0]), "boom")
+
+    def test_timed_out_job_passes_timeout_to_on_error(self):
+        errors = []
+
+        async def slow():
+            await asyncio.sleep(5)
+
+        job = self.engine.submit(slow, name="slow", timeout=0.05, dispatch=self._dispatch, on_error=errors.append)
+        job.future.result(5)
+        self._run_delivered()
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], TimeoutError)
+
+    def test_result_is_delivered(self):
+        results = []
+
+        async def ok():
+            return 42
+
+        job = self.engine.submit(ok, dispatch=self._dispatch, on_result=results.append)
+        job.future.result(5)
+        self._run_delivered()
+        self.assertEqual(results, [42])
+
+
+class Chunk:
+    def __init__(self, text):
+        self.text = text
+        self.usage_metadata = None
+
+
+class SlowStream:
+    """Async chunk iterator that yields one chunk per ``delay`` seconds and records aclose."""
+
+    def __init__(self, delay=0.05, count=100):
+        self.delay = delay
+        self.count = count
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.count <= 0:
+            raise StopAsyncIteration
+        self.count -= 1
+        await asyncio.sleep(self.delay)
+        return Chunk("x")
+
+    async def aclose(self):
+        self.closed = True
+
+
+class GeminiEngineCancellationTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = MagicInput.GeminiEngine(lambda key: object(), lambda: ["k1"], max_concurrency=1)
+        self.engine.start()
+        self.addCleanup(self.engine.stop)
+        self.events = []
+
+    def _dispatch(self, func, delay=0):
+        func()
+
+    def _submit(self, coro_fn, timeout=None):
+        return self.engine.submit(coro_fn, name="job", timeout=timeout, dispatch=self._dispatch,
+                                  on_error=lambda e: self.events.append(("error", type(e).__name__)),
+                                  on_cancel=lambda: self.events.append(("cancel",)),
+                                  on_result=lambda r: self.events.append(("result", r)))
+
+    def test_cancel_closes_the_stream_and_frees_the_slot(self):
+        stream = SlowStream()
+        received = []
+        first = threading.Event()
+
+        async def job():
+            async def open_stream(client, key):
+                return stream
+
+            def on_chunk(text):
+                received.append(text)
+                first.set()
+            await self.engine.stream(open_stream, on_chunk)
+
+        handle = self._submit(job)
+        self.assertTrue(first.wait(5))
+        handle.cancel()
+        with self.assertRaises(concurrent.futures.CancelledError):
+            handle.result(5)
+        time.sleep(0.1)
+        self.assertTrue(stream.closed)
+        self.assertEqual(self.events, [("cancel",)])
+        self.assertTrue(handle.cancel_event.is_set())
+        count = len(received)
+        time.sleep(0.2)
+        self.assertEqual(len(received), count)
+
+        # With max_concurrency=1 this only runs if the cancelled stream gave its slot back
+        async def again():
+            async def open_stream(client, key):
+                return SlowStream(delay=0, count=2)
+            return await self.engine.stream(open_stream, lambda text: None)
+        self.assertTrue(self.engine.run_sync(again, timeout=5))
+
+    def test_blocking_helper_sees_cancellation(self):
+        started, noticed = threading.Event(), threading.Event()
+
+        def blocking():
+            started.set()
+            deadline = time.monotonic() + 5
+            while time.monotonic() < deadline:
+                if MagicInput.cancel_requested():
+                    noticed.set()
+                    return
+                time.sleep(0.01)
+
+        async def job():
+            await asyncio.to_thread(blocking)
+
+        handle = self._submit(job)
+        self.assertTrue(started.wait(5))
+        self.assertFalse(MagicInput.cancel_requested())
+        handle.cancel()
+        self.assertTrue(noticed.wait(5))
+
+    def test_deadline_reports_timeout_and_stops_blocking_helpers(self):
+        noticed = threading.Event()
+
+        def blocking():
+            deadline = time.monotonic() + 5
+            while time.monotonic() < deadline and not MagicInput.cancel_requested():
+                time.sleep(0.01)
+            if MagicInput.cancel_requested():
+                noticed.set()
+
+        async def job():
+            await asyncio.to_thread(blocking)
+
+        handle = self._submit(job, timeout=0.1)
+        self.assertIsNone(handle.result(5))
+        self.assertEqual(self.events, [("error", "TimeoutError")])
+        self.assertTrue(noticed.wait(5))
+
+
+class ServerError(Exception):
+    def __init__(self, code, status=""):
+        super().__init__(f"{code} {status}")
+        self.code = code
+        self.status = status
+
+
+class TimeoutException(Exception):
+    """Named like httpx's transport timeout, which the policy matches by class name."""
+
+
+class GeminiRetryPolicyTest(unittest.TestCase):
+    def test_only_errors_without_output_are_retryable(self):
+        policy = MagicInput.GeminiRetryPolicy()
+        self.assertTrue(policy.is_retryable(ServerError(503)))
+        self.assertTrue(policy.is_retryable(ServerError(None, "UNAVAILABLE")))
+        self.assertTrue(policy.is_retryable(TimeoutError()))
+        self.assertTrue(policy.is_retryable(ConnectionResetError()))
+        self.assertTrue(policy.is_retryable(TimeoutException()))
+        self.assertFalse(policy.is_retryable(ServerError(400, "INVALID_ARGUMENT")))
+        self.assertFalse(policy.is_retryable(ServerError(429, "RESOURCE_EXHAUSTED")))
+        self.assertFalse(policy.is_retryable(ValueError("bad")))
+
+    def test_backoff_is_bounded_by_the_exponential_cap(self):
+        policy = MagicInput.GeminiRetryPolicy(base_delay_s=1.0, max_delay_s=5.0)
+        for retry, cap in ((0, 1.0), (1, 2.0), (2, 4.0), (3, 5.0), (10, 5.0)):
+            for _ in range(50):
+                self.assertTrue(0.0 <= policy.backoff(retry) <= cap)
+
+    def test_settings_are_clamped(self):
+        policy = MagicInput.GeminiRetryPolicy(max_retries=-1, base_delay_s=2.0, max_delay_s=1.0)
+        self.assertEqual(policy.max_retries, 0)
+        self.assertEqual(policy.max_delay_s, 2.0)
+
+
+class GeminiEngineRetryTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = MagicInput.GeminiEngine(
+            lambda key: object(), lambda: ["k1"],
+            retry_policy=MagicInput.GeminiRetryPolicy(max_retries=2, base_delay_s=0.0))
+        self.engine.start()
+        self.addCleanup(self.engine.stop)
+
+    def test_transient_error_before_the_first_chunk_is_retried(self):
+        opened = []
+
+        async def job():
+            async def open_stream(client, key):
+                opened.append(key)
+                if len(opened) == 1:
+                    raise ServerError(503, "UNAVAILABLE")
+                return SlowStream(delay=0, count=3)
+            received = []
+            ok = await self.engine.stream(open_stream, received.append)
+            return ok, received
+
+        ok, received = self.engine.run_sync(job, timeout=5)
+        self.assertTrue(ok)
+        self.assertEqual(received, ["x", "x", "x"])
+        self.assertEqual(len(opened), 2)
+
+    def test_error_after_text_is_not_retried(self):
+        opened = []
+
+        class BrokenStream(SlowStream):
+            async def __anext__(self):
+                if self.count == 1:
+                    raise ServerError(503, "UNAVAILABLE")
+                return await super().__anext__()
+
+        async def job():
+            async def open_stream(client, key):
+                opened.append(key)
+                return BrokenStream(delay=0, count=3)
+            await self.engine.stream(open_stream, lambda text: None)
+
+        with self.assertRaises(ServerError):
+            self.engine.run_sync(job, timeout=5)
+        self.assertEqual(len(opened), 1)
+
+    def test_generate_gives_up_after_max_retries(self):
+        calls = []
+
+        async def job():
+            async def make_call(client, key):
+                calls.append(key)
+                raise ServerError(500, "INTERNAL")
+            return await self.engine.generate(make_call)
+
+        with self.assertRaises(ServerError):
+            self.engine.run_sync(job, timeout=5)
+        self.assertEqual(len(calls), 3)
+
+    def test_permanent_error_is_raised_at_once(self):
+        calls = []
+
+        async def job():
+            async def make_call(client, key):
+                calls.append(key)
+                raise ServerError(400, "INVALID_ARGUMENT")
+            return await self.engine.generate(make_call)
+
+        with self.assertRaises(ServerError):
+            self.engine.run_sync(job, timeout=5)
+        self.assertEqual(len(calls), 1)
+
+
+class FakeAio:
+    def __init__(self):
+        self.closed = False
+
+    async def aclose(self):
+        self.closed = True
+
+
+class FakeClient:
+    def __init__(self, key):
+        self.key = key
+        self.aio = FakeAio()
+
+
+class GeminiEngineClientPoolTest(unittest.TestCase):
+    def test_reset_closes_only_dropped_clients(self):
+        engine = MagicInput.GeminiEngine(FakeClient, lambda: ["k1", "k2"])
+        engine.RETIRED_CLIENT_GRACE_S = 0.0
+        engine.start()
+        self.addCleanup(engine.stop)
+        c1, c2 = engine.client_for("k1"), engine.client_for("k2")
+        engine.reset_clients(keep=["k1"])
+        engine.run_sync(lambda: asyncio.sleep(0.05))
+        self.assertFalse(c1.aio.closed)
+        self.assertTrue(c2.aio.closed)
+        self.assertIs(engine.client_for("k1"), c1)
+        self.assertIsNot(engine.client_for("k2"), c2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+os.environ.setdefault("PYSTRAY_BACKEND", "dummy")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import MagicInput  # noqa: E402
+
+
+class SmallExtractor(MagicInput.FileContextExtractor):
+    """Same logic, with limits small enough for test files."""
+
+    WHOLE_FILE_BYTES = 2_000
+    WINDOW_BYTES = 1_000
+
+
+def source_lines(n):
+    """A Python-like file: a ``def`` every 10th line, numbered so lines can be checked."""
+    return "".join(f"def func_{i}():\n" if i % 10 == 0 else f"    value = {i}\n" for i in range(1, n + 1))
+
+
+class FileContextExtractorTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, ignore_errors=True)
+        self.extractor = SmallExtractor(margin_lines=3)
+
+    def _write(self, name, text):
+        path = os.path.join(self.dir, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+        return path
+
+    def test_small_file_is_read_whole(self):
+        path = self._write("small.py", source_lines(20))
+        excerpt = self.extractor.extract(path, (5, 6, 20))
+        self.assertEqual(excerpt.text, source_lines(20))
+        self.assertFalse(excerpt.partial)
+
+    def test_range_of_a_large_file_with_margins(self):
+        path = self._write("large.py", source_lines(2000))
+        excerpt = self.extractor.extract(path, (500, 505, 2000))
+        lines = excerpt.text.splitlines()
+        self.assertEqual(excerpt.first_line, 497)
+        self.assertEqual(lines[0], "    value = 497")
+        self.assertEqual(lines[-1], "    value = 508")
+        self.assertEqual(excerpt.note.split(" of ")[0], "lines 497-508")
+        self.assertIn("L10: def func_10():", excerpt.outline)
+        self.assertNotIn("L500: def func_500():", excerpt.outline)
+
+    def test_huge_range_is_cut_at_a_line_end(self):
+        path = self._write("large.py", source_lines(2000))
+        excerpt = self.extractor.extract(path, (100, 1900, 2000))
+        self.assertLessEqual(len(excerpt.text.encode()), SmallExtractor.WINDOW_BYTES)
+        self.assertTrue(excerpt.text.endswith("\n"))
+        self.assertEqual(excerpt.first_line, 100)
+
+    def test_large_file_without_range_reads_the_head(self):
+        path = self._write("large.py", source_lines(2000))
+        excerpt = self.extractor.extract(path)
+        self.assertTrue(excerpt.text.startswith("    value = 1\n"))
+        self.assertTrue(excerpt.note.startswith("first "))
+        self.assertIn("L1000: def func_1000():", excerpt.outline)
+
+    def test_large_log_reads_the_tail(self):
+        path = self._write("build.log", "".join(f"step {i}\n" for i in range(1, 2001)))
+        excerpt = self.extractor.extract(path)
+        self.assertTrue(excerpt.text.endswith("step 2000\n"))
+        self.assertTrue(excerpt.text.startswith("step "))
+        self.assertIsNone(excerpt.first_line)
+        self.assertTrue(excerpt.note.startswith("last "))
+
+
+if __name__ == "__main__":
+    unittest.main()
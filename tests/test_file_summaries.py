@@ -0,0 +1,101 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+os.environ.setdefault("PYSTRAY_BACKEND", "dummy")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import MagicInput  # noqa: E402
+
+FileSummaryCache = MagicInput.FileSummaryCache
+
+MODULE = '''"""Load and validate user settings."""
+import json
+
+
+class Settings:
+    pass
+
+
+def load_settings(path):
+    return json.load(open(path))
+'''
+
+
+class FileSummaryCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, True)
+        self.cache_path = os.path.join(self.dir, "MagicInput", "file_summaries.json")
+
+    def write(self, name, text):
+        path = os.path.join(self.dir, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+        return path
+
+    def test_outline_has_size_lead_and_names(self):
+        outline = FileSummaryCache.outline(self.write("settings.py", MODULE))
+        self.assertTrue(outline.startswith("11 lines."))
+        self.assertIn("Load and validate user settings.", outline)
+        self.assertIn("Defines: Settings, load_settings", outline)
+
+    def test_markdown_outline_lists_headings(self):
+        outline = FileSummaryCache.outline(self.write("notes.md", "# Setup\n\ntext\n\n## Usage\n"))
+        self.assertIn("Defines: Setup, Usage", outline)
+
+    def test_missing_file_has_empty_outline(self):
+        self.assertEqual(FileSummaryCache.outline(os.path.join(self.dir, "nope.py")), "")
+
+    def test_entries_are_keyed_by_content(self):
+        cache = FileSummaryCache(self.cache_path)
+        path = self.write("settings.py", MODULE)
+        digest = FileSummaryCache.digest(path)
+        self.assertEqual(cache.get(digest, "settings.py", path)["kind"], "outline")
+
+        # A renamed copy with the same content reuses the entry
+        moved = self.write("config.py", MODULE)
+        self.assertEqual(FileSummaryCache.digest(moved), digest)
+        cache.put_model(digest, "settings.py", "Reads settings.json into a Settings object.")
+        entry = cache.get(FileSummaryCache.digest(moved), "config.py", moved)
+        self.assertEqual(entry["kind"], "model")
+        self.assertEqual(entry["text"], "Reads settings.json into a Settings object.")
+
+        # An edit gets a fresh outline
+        edited = self.write("settings.py", MODULE + "\ndef save_settings(path):\n    pass\n")
+        entry = cache.get(FileSummaryCache.digest(edited), "settings.py", edited)
+        self.assertEqual(entry["kind"], "outline")
+        self.assertIn("save_settings", entry["text"])
+
+    def test_save_and_reload(self):
+        cache = FileSummaryCache(self.cache_path)
+        cache.put_model("abc", "a.py", "Summary.")
+        cache.save()
+        reloaded = FileSummaryCache(self.cache_path)
+        self.assertEqual(reloaded.entries["abc"]["text"], "Summary.")
+        self.assertFalse(os.path.exists(self.cache_path + ".tmp"))
+
+    def test_save_drops_least_recently_used_entries(self):
+        cache = FileSummaryCache(self.cache_path)
+        cache.MAX_ENTRIES = 2
+        for i, digest in enumerate(("old", "mid", "new")):
+            cache.entries[digest] = {"kind": "model", "text": digest, "path": f"{digest}.py", "used": 1000 + i}
+        cache._dirty = True
+        cache.save()
+        self.assertEqual(sorted(FileSummaryCache(self.cache_path).entries), ["mid", "new"])
+
+    def test_other_versions_and_broken_files_start_empty(self):
+        os.makedirs(os.path.dirname(self.cache_path))
+        with open(self.cache_path, "w", encoding="utf-8") as f:
+            json.dump({"version": FileSummaryCache.VERSION + 1, "entries": {"x": {}}}, f)
+        self.assertEqual(FileSummaryCache(self.cache_path).entries, {})
+        with open(self.cache_path, "w", encoding="utf-8") as f:
+            f.write("{not json")
+        self.assertEqual(FileSummaryCache(self.cache_path).entries, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+os.environ.setdefault("PYSTRAY_BACKEND", "dummy")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import MagicInput  # noqa: E402
+
+GitChanges = MagicInput.GitChanges
+
+
+class ParseStatusTests(unittest.TestCase):
+    def test_rename_source_is_a_separate_field(self):
+        status = "R  new name.py\0old name.py\0 M src/app.py\0?? notes.txt\0"
+        self.assertEqual(GitChanges._parse_status(status), [
+            ("R ", "new name.py"), ("<-", "old name.py"), (" M", "src/app.py"), ("??", "notes.txt")])
+
+    def test_short_source_path_is_not_taken_for_an_entry(self):
+        status = "C  b.py\0a\0 M c.py\0"
+        self.assertEqual(GitChanges._parse_status(status), [("C ", "b.py"), ("<-", "a"), (" M", "c.py")])
+
+
+@unittest.skipIf(shutil.which("git") is None, "git is not installed")
+class CollectTests(unittest.TestCase):
+    def git(self, *args):
+        subprocess.run(["git", "-C", self.root, "-c", "user.name=t", "-c", "user.email=t@example.com", *args],
+                       check=True, capture_output=True)
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.git("init", "-q")
+        with open(os.path.join(self.root, "original_module.py"), "w") as f:
+            f.write("".join(f"line {i}\n" for i in range(40)))
+        self.git("add", "-A")
+        self.git("commit", "-q", "-m", "init")
+
+    def test_outside_a_repository(self):
+        self.assertEqual(GitChanges(self.root + "-missing").collect(), "")
+
+    def test_clean_repository(self):
+        self.assertEqual(GitChanges(self.root).collect(), "")
+
+    def test_rename_and_untracked_paths_are_whole(self):
+        self.git("mv", "original_module.py", "renamed_module.py")
+        with open(os.path.join(self.root, "scratch notes.txt"), "w") as f:
+            f.write("todo\n")
+        changes = GitChanges(self.root)
+        text = changes.collect()
+        self.assertIn("## Staged changes", text)
+        self.assertIn("renamed_module.py", text)
+        self.assertIn("## Untracked files\nscratch notes.txt", text)
+
+    def test_recollects_after_an_edit(self):
+        changes = GitChanges(self.root)
+        with open(os.path.join(self.root, "original_module.py"), "a") as f:
+            f.write("first edit\n")
+        self.assertIn("+first edit", changes.collect())
+        with open(os.path.join(self.root, "original_module.py"), "a") as f:
+            f.write("second edit\n")
+        self.assertIn("+second edit", changes.collect())
+
+
+class FitTests(unittest.TestCase):
+    def test_every_file_gets_its_first_hunk_before_later_hunks(self):
+        def file_diff(name, hunks):
+            body = "".join(f"@@ -{i},1 +{i},1 @@\n-old {i}\n+new {i} {'x' * 200}\n" for i in range(hunks))
+            return f"diff --git a/{name} b/{name}\n--- a/{name}\n+++ b/{name}\n{body}"
+        text = "## Unstaged changes\n" + file_diff("a.py", 6) + file_diff("b.py", 6)
+        fitted = GitChanges.fit(text, 250, lambda s: len(s) // 4 + 1)
+        self.assertIn("+new 0", fitted.split("diff --git a/b.py")[0])
+        self.assertIn("diff --git a/b.py b/b.py", fitted)
+        self.assertIn("more hunk(s) of this file omitted", fitted)
+
+    def test_within_budget_unchanged(self):
+        self.assertEqual(GitChanges.fit("## Untracked files\na.txt", 100, len), "## Untracked files\na.txt")
+
+
+if __name__ == "__main__":
+    unittest.main()
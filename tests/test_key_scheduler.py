@@ -0,0 +1,69 @@
+import os
+import sys
+import unittest
+
+os.environ.setdefault("PYSTRAY_BACKEND", "dummy")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import MagicInput  # noqa: E402
+
+GeminiKeyScheduler = MagicInput.GeminiKeyScheduler
+
+
+class KeySchedulerLimitsTest(unittest.TestCase):
+    def test_configured_defaults_apply_to_new_keys(self):
+        sched = GeminiKeyScheduler(default_rpm=300, default_tpm=2_000_000)
+        self.assertIn("/300 req/min", sched.describe("k1"))
+
+    def test_learned_limit_grows_back_after_successes(self):
+        sched = GeminiKeyScheduler(default_rpm=100)
+        sched.record_rate_limit("k1", {"rpm": 10, "retry_after": 0.01})
+        self.assertEqual(sched._slot("k1")["rpm"], 10)
+        for _ in range(GeminiKeyScheduler.GROWBACK_SUCCESSES * 20):
+            sched.record_success("k1")
+        self.assertEqual(sched._slot("k1")["rpm"], 100)
+
+    def test_rate_limit_resets_the_success_streak(self):
+        sched = GeminiKeyScheduler(default_rpm=100)
+        sched.record_rate_limit("k1", {"rpm": 10, "retry_after": 0.01})
+        for _ in range(GeminiKeyScheduler.GROWBACK_SUCCESSES - 1):
+            sched.record_success("k1")
+        sched.record_rate_limit("k1", {"retry_after": 0.01})
+        sched.record_success("k1")
+        self.assertEqual(sched._slot("k1")["rpm"], 10)
+
+    def test_export_keeps_only_learned_limits(self):
+        sched = GeminiKeyScheduler(default_rpm=60)
+        sched.describe("k1")
+        sched.record_rate_limit("k2", {"rpm": 5, "retry_after": 0.01})
+        state = sched.export_state()
+        self.assertNotIn(GeminiKeyScheduler.fingerprint("k1"), state)
+        self.assertEqual(state[GeminiKeyScheduler.fingerprint("k2")]["rpm"], 5)
+
+    def test_legacy_state_with_builtin_defaults_is_not_a_learned_limit(self):
+        sched = GeminiKeyScheduler(default_rpm=60)
+        fp = GeminiKeyScheduler.fingerprint("k1")
+        sched.import_state({fp: {"rpm": GeminiKeyScheduler.DEFAULT_RPM, "tpm": GeminiKeyScheduler.DEFAULT_TPM,
+                                 "cooldown_until": 0}}, version=1)
+        self.assertEqual(sched._slot("k1")["rpm"], 60)
+
+    def test_learned_limit_equal_to_builtin_defaults_survives_a_restart(self):
+        sched = GeminiKeyScheduler(default_rpm=60, default_tpm=1_000_000)
+        sched.record_rate_limit("k1", {"rpm": GeminiKeyScheduler.DEFAULT_RPM, "tpm": GeminiKeyScheduler.DEFAULT_TPM,
+                                       "retry_after": 0.01})
+        restored = GeminiKeyScheduler(default_rpm=60, default_tpm=1_000_000)
+        restored.import_state(sched.export_state(), GeminiKeyScheduler.STATE_VERSION)
+        self.assertEqual(restored._slot("k1")["rpm"], GeminiKeyScheduler.DEFAULT_RPM)
+        self.assertEqual(restored._slot("k1")["tpm"], GeminiKeyScheduler.DEFAULT_TPM)
+
+    def test_raising_defaults_moves_unlearned_keys_only(self):
+        sched = GeminiKeyScheduler()
+        sched.describe("k1")
+        sched.record_rate_limit("k2", {"rpm": 4, "retry_after": 0.01})
+        sched.set_defaults(50, 500_000)
+        self.assertEqual(sched._slot("k1")["rpm"], 50)
+        self.assertEqual(sched._slot("k2")["rpm"], 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
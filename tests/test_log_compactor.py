@@ -0,0 +1,70 @@
+import os
+import sys
+import unittest
+
+os.environ.setdefault("PYSTRAY_BACKEND", "dummy")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import MagicInput  # noqa: E402
+
+LogCompactor = MagicInput.LogCompactor
+
+
+def traceback(i):
+    return "\n".join([
+        "Traceback (most recent call last):",
+        '  File "worker.py", line 3, in <module>',
+        "    run()",
+        '  File "worker.py", line 2, in run',
+        '    raise ValueError("bad")',
+        f"ValueError: bad {i}",
+    ])
+
+
+class CompactTests(unittest.TestCase):
+    def test_clean_strips_ansi_and_keeps_last_redraw(self):
+        self.assertEqual(LogCompactor.clean("\x1b[31mred\x1b[0m\n10%\r50%\r100%\r"), ["red", "100%"])
+
+    def test_similar_lines_collapse_to_first_and_last(self):
+        out = LogCompactor.compact("\n".join(f"Downloading chunk {i}/100" for i in range(100))).split("\n")
+        self.assertEqual(out, ["Downloading chunk 0/100", "[... 98 similar lines]", "Downloading chunk 99/100"])
+
+    def test_repeated_block_without_error_keeps_one_copy(self):
+        text = "\n".join(["poll", "sleep 1s"] * 50 + ["ready"])
+        self.assertEqual(LogCompactor.compact(text).split("\n"),
+                         ["poll", "sleep 1s", "[... previous 2 lines repeated 49 more times]", "ready"])
+
+    def test_looping_traceback_keeps_first_and_last(self):
+        out = LogCompactor.compact("\n".join(traceback(i) for i in range(300)))
+        self.assertIn("ValueError: bad 0", out)
+        self.assertIn("ValueError: bad 299", out)
+        self.assertNotIn("ValueError: bad 150", out)
+        self.assertIn("repeated 298 more times", out)
+        self.assertLess(len(out.split("\n")), 20)
+
+    def test_scattered_errors_keep_first_and_last(self):
+        lines = []
+        for i in range(10):
+            lines += [f"step {i} started", f"building module {chr(97 + i)}", "error: disk quota exceeded"]
+        out = LogCompactor.compact("\n".join(lines)).split("\n")
+        self.assertEqual(out.count("error: disk quota exceeded"), 2)
+        self.assertIn("[... 8 earlier occurrences of the following omitted]", out)
+        self.assertEqual(out[-1], "error: disk quota exceeded")
+
+
+class FitTests(unittest.TestCase):
+    def test_fit_keeps_latest_output_and_errors(self):
+        lines = [f"line {i} of routine output" for i in range(400)]
+        lines[37] = "fatal: could not read from remote repository"
+        text = "\n".join(lines)
+        out = LogCompactor.fit(text, 300, lambda s: max(1, len(s) // 4))
+        self.assertIn("fatal: could not read from remote repository", out)
+        self.assertTrue(out.rstrip().endswith("line 399 of routine output"))
+        self.assertIn("lines omitted]", out)
+
+    def test_fit_returns_text_within_budget_unchanged(self):
+        self.assertEqual(LogCompactor.fit("a\nb", 100, len), "a\nb")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+os.environ.setdefault("PYSTRAY_BACKEND", "dummy")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import MagicInput  # noqa: E402
+
+ProjectIndex = MagicInput.ProjectIndex
+
+
+class ProjectIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.index_path = os.path.join(self.root, "MagicInput", "project_index.json")
+        self._write("auth.py", "def check_password(user, password):\n    return hash_password(password) == user.hash\n")
+        self._write("cart.py", "class ShoppingCart:\n    def add_item(self, item):\n        self.items.append(item)\n")
+        self._write("node_modules/lib.js", "function checkPassword() {}\n")
+
+    def _write(self, rel, text):
+        path = os.path.join(self.root, rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+
+    def test_tokenize_splits_identifiers(self):
+        tokens = ProjectIndex.tokenize("The checkPassword and hash_password helpers")
+        for token in ("checkpassword", "check", "password", "hash_password", "hash", "helpers"):
+            self.assertIn(token, tokens)
+        self.assertNotIn("the", tokens)
+
+    def test_search_ranks_the_matching_file_and_skips_vendored_dirs(self):
+        index = ProjectIndex(self.root, self.index_path)
+        self.assertEqual(index.update(force=True), 2)
+        hits = index.search("password check fails")
+        self.assertEqual(hits[0][:3], ("auth.py", 1, 2))
+        self.assertNotIn("node_modules/lib.js", [h[0] for h in hits])
+        self.assertEqual(index.read_lines("auth.py", 1, 1), "def check_password(user, password):")
+
+    def test_update_reindexes_only_changed_files_and_drops_deleted_ones(self):
+        index = ProjectIndex(self.root, self.index_path)
+        index.update(force=True)
+        self._write("cart.py", "class ShoppingCart:\n    def checkout(self):\n        charge_card(self.total)\n")
+        os.remove(os.path.join(self.root, "auth.py"))
+        self.assertEqual(index.update(force=True), 2)
+        self.assertEqual(index.search("password"), [])
+        self.assertEqual(index.search("checkout card")[0][0], "cart.py")
+
+    def test_saved_index_is_reused(self):
+        ProjectIndex(self.root, self.index_path).update(force=True)
+        reopened = ProjectIndex(self.root, self.index_path)
+        self.assertEqual(reopened.update(force=True), 0)
+        self.assertEqual(reopened.search("shopping cart item")[0][0], "cart.py")
+
+    def test_long_files_are_chunked_with_overlap(self):
+        self._write("big.py", "".join(f"line_{i} = {i}\n" for i in range(100)))
+        index = ProjectIndex(self.root, self.index_path)
+        index.update(force=True)
+        ranges = [(c[0], c[1]) for c in index.files["big.py"]["chunks"]]
+        self.assertEqual(ranges, [(1, 40), (31, 70), (61, 100)])
+
+
+if __name__ == "__main__":
+    unittest.main()
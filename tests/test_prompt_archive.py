@@ -0,0 +1,118 @@
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+os.environ.setdefault("PYSTRAY_BACKEND", "dummy")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import MagicInput  # noqa: E402
+
+SEPARATOR = "-" * 50
+
+
+def legacy_entry(timestamp, text):
+    return f"[{timestamp}]\nPrompt:\n{text}\n{SEPARATOR}\n\n"
+
+
+class PromptArchiveTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        self.directory = os.path.join(self.tmp, "Prompts Archive")
+
+    def test_append_and_read_both_directions(self):
+        archive = MagicInput.PromptArchive(self.directory)
+        for i in range(5):
+            archive.append(f"[2025-01-0{i + 1} 10:00:00]", f"prompt {i}")
+        self.assertEqual(archive.count(), 5)
+        self.assertEqual([t for t, _ in archive.entries()][0], "2025-01-01 10:00:00")
+        self.assertEqual([body for _, body in archive.iter_newest()],
+                         [f"prompt {i}" for i in range(4, -1, -1)])
+        self.assertEqual([body for _, body in archive.entries(1, 3)], ["prompt 1", "prompt 2"])
+
+    def test_segments_roll_over(self):
+        archive = MagicInput.PromptArchive(self.directory)
+        archive.SEGMENT_BYTES = 200
+        for i in range(6):
+            archive.append(f"[2025-01-01 10:00:0{i}]", "x" * 80)
+        segments = [n for n in os.listdir(self.directory) if n.startswith("segment-")]
+        self.assertGreater(len(segments), 1)
+        self.assertEqual(len(list(archive.iter_newest())), 6)
+
+    def test_recovers_entry_written_without_index_record(self):
+        archive = MagicInput.PromptArchive(self.directory)
+        archive.append("[2025-01-01 10:00:00]", "first")
+        with open(os.path.join(self.directory, "segment-000001.txt"), "a", encoding="utf-8") as f:
+            f.write(f"[2025-01-01 10:00:01]\nsecond\n{SEPARATOR}\n")
+        reopened = MagicInput.PromptArchive(self.directory)
+        self.assertEqual([body for _, body in reopened.iter_newest()], ["second", "first"])
+
+    def test_migrates_mixed_order_legacy_file_newest_first(self):
+        legacy = os.path.join(self.tmp, "Prompts Archive.txt")
+        newest_first = ["2025-08-21 17:54:40", "2025-08-20 09:00:00", "2025-08-18 00:32:00"]
+        oldest_first = ["2025-08-16 13:03:00", "2025-08-17 08:00:00", "2025-08-18 00:24:10"]
+        with open(legacy, "w", encoding="utf-8") as f:
+            for ts in newest_first + oldest_first:
+                f.write(legacy_entry(ts, f"prompt at {ts}"))
+        archive = MagicInput.PromptArchive(self.directory, legacy_path=legacy)
+        timestamps = [t for t, _ in archive.iter_newest()]
+        self.assertEqual(timestamps, sorted(newest_first + oldest_first, reverse=True))
+        self.assertEqual(next(archive.entries())[0], "2025-08-16 13:03:00")
+        self.assertFalse(os.path.exists(legacy))
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, "Prompts Archive (migrated).txt")))
+
+
+class PromptHistoryTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        self.archive = MagicInput.PromptArchive(os.path.join(self.tmp, "Prompts Archive"))
+
+    def test_search_prefers_matching_prompt_and_sees_later_appends(self):
+        self.archive.append("[2025-01-01 10:00:00]", "fix the tokenizer crash on empty input")
+        self.archive.append("[2025-01-02 10:00:00]", "restyle the settings dialog")
+        history = MagicInput.PromptHistory(self.archive)
+        hits = history.search("tokenizer crash", k=1)
+        self.assertEqual(len(hits), 1)
+        self.assertIn("tokenizer", hits[0][1])
+        self.archive.append("[2025-01-03 10:00:00]", "speed up the websocket reconnect")
+        hits = history.search("websocket reconnect", k=1)
+        self.assertIn("websocket", hits[0][1])
+
+    def test_recency_breaks_ties_between_equal_matches(self):
+        self.archive.append("[2025-01-01 10:00:00]", "fix the login form validation")
+        self.archive.append("[2025-03-01 10:00:00]", "fix the login form validation")
+        history = MagicInput.PromptHistory(self.archive)
+        now = datetime.datetime(2025, 3, 2).timestamp()
+        hits = history.search("login validation", k=2, now=now)
+        self.assertEqual([h[0] for h in hits], ["2025-03-01 10:00:00", "2025-01-01 10:00:00"])
+
+    def test_strong_old_match_beats_unrelated_recent_prompt(self):
+        self.archive.append("[2025-01-01 10:00:00]", "the payment webhook retries twice on timeout")
+        self.archive.append("[2025-03-01 10:00:00]", "make the header sticky")
+        history = MagicInput.PromptHistory(self.archive)
+        hits = history.search("payment webhook timeout", k=1, now=datetime.datetime(2025, 3, 2).timestamp())
+        self.assertEqual(hits[0][0], "2025-01-01 10:00:00")
+
+    def test_without_matching_terms_newest_come_first(self):
+        for day in range(1, 4):
+            self.archive.append(f"[2025-01-0{day} 10:00:00]", f"prompt number {day}")
+        history = MagicInput.PromptHistory(self.archive)
+        hits = history.search("zebra", k=2, now=datetime.datetime(2025, 1, 4).timestamp())
+        self.assertEqual([h[0] for h in hits], ["2025-01-03 10:00:00", "2025-01-02 10:00:00"])
+
+    def test_add_indexes_the_appended_prompt(self):
+        self.archive.append("[2025-01-01 10:00:00]", "first prompt about caching")
+        history = MagicInput.PromptHistory(self.archive)
+        history.search("caching")
+        self.archive.append("[2025-01-02 10:00:00]", "second prompt about tracing")
+        history.add("2025-01-02 10:00:00", "second prompt about tracing")
+        self.assertEqual(len(history.entries), 2)
+        self.assertIn("tracing", history.search("tracing", k=1)[0][1])
+
+
+if __name__ == "__main__":
+    unittest.main()
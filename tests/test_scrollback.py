@@ -0,0 +1,75 @@
+import os
+import sys
+import unittest
+
+os.environ.setdefault("PYSTRAY_BACKEND", "dummy")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import MagicInput  # noqa: E402
+
+
+class FakeTmux(MagicInput.MultiplexerScrollback):
+    """A pane of ``height`` rows whose output is ``self.output``; everything above the screen is history."""
+
+    def __init__(self, height=5):
+        super().__init__()
+        self.height = height
+        self.output: list[str] = []
+
+    def _run(self, args):
+        history = max(0, len(self.output) - self.height)
+        cursor_y = len(self.output) - history - 1
+        if args[1] == "display-message":
+            return f"{history} {cursor_y} {self.height}\n"
+        start, end = int(args[args.index("-S") + 1]), int(args[args.index("-E") + 1])
+        return "\n".join(self.output[history + start:history + end + 1]) + "\n"
+
+
+class MergeTests(unittest.TestCase):
+    def setUp(self):
+        self.scrollback = MagicInput.MultiplexerScrollback()
+
+    def test_repeated_lines_keep_new_output(self):
+        lines = ["a", "x", "x", "x", "x"]
+        fetched = ["x"] * 4 + ["new1"] + ["x"] * 4
+        self.assertTrue(self.scrollback._merge(lines, fetched, replace=False))
+        self.assertIn("new1", lines)
+        self.assertEqual(lines[0], "a")
+        self.assertGreaterEqual(len(lines), 5)
+
+    def test_repeated_lines_at_known_position(self):
+        lines = ["a", "x", "x", "x", "x"]
+        fetched = ["x"] * 4 + ["new1"] + ["x"] * 4
+        self.assertTrue(self.scrollback._merge(lines, fetched, replace=False, at=0))
+        self.assertEqual(lines, ["a", "x", "x", "x"] + fetched[3:])
+
+    def test_blank_lines_neither_lost_nor_repeated(self):
+        lines = ["$ make", "", "", "", "", ""]
+        fetched = ["$ make", "", "", "", "", "", "done"]
+        self.assertTrue(self.scrollback._merge(lines, fetched, replace=False))
+        self.assertEqual(lines, fetched)
+
+    def test_no_overlap_replaces_only_when_asked(self):
+        lines = ["one", "two", "three", "four"]
+        self.assertFalse(self.scrollback._merge(lines, ["p", "q"], replace=False))
+        self.assertEqual(lines, ["one", "two", "three", "four"])
+        self.assertFalse(self.scrollback._merge(lines, ["p", "q"], replace=True))
+        self.assertEqual(lines, ["p", "q"])
+
+
+class CaptureTmuxTests(unittest.TestCase):
+    def test_incremental_capture_follows_repetitive_output(self):
+        pane = FakeTmux()
+        pane.output = ["start"] + ["x"] * 8
+        self.assertEqual(pane.capture("tmux:%1").split("\n"), pane.output)
+        pane.output += ["new1"] + ["x"] * 4 + [""] * 3 + ["end"]
+        self.assertEqual(pane.capture("tmux:%1").split("\n"), pane.output)
+
+    def test_pane_gone(self):
+        pane = FakeTmux()
+        pane._run = lambda args: None
+        self.assertIsNone(pane.capture("tmux:%1"))
+
+
+if __name__ == "__main__":
+    unittest.main()
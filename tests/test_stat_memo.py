@@ -0,0 +1,77 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+os.environ.setdefault("PYSTRAY_BACKEND", "dummy")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import MagicInput  # noqa: E402
+
+StatMemo = MagicInput.StatMemo
+
+
+class StatMemoTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, True)
+        self.path = os.path.join(self.dir, "a.txt")
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write("one")
+        self.calls = 0
+
+    def compute(self):
+        self.calls += 1
+        with open(self.path, encoding="utf-8") as f:
+            return f.read()
+
+    def test_unchanged_file_is_served_from_memory(self):
+        memo = StatMemo()
+        self.assertEqual(memo.get("k", [self.path], self.compute), "one")
+        self.assertEqual(memo.get("k", [self.path], self.compute), "one")
+        self.assertEqual(self.calls, 1)
+
+    def test_changed_size_or_mtime_recomputes(self):
+        memo = StatMemo()
+        memo.get("k", [self.path], self.compute)
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write("three")
+        self.assertEqual(memo.get("k", [self.path], self.compute), "three")
+
+        # Same size, different mtime
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write("seven")
+        st = os.stat(self.path)
+        os.utime(self.path, ns=(st.st_atime_ns, st.st_mtime_ns + 5_000_000_000))
+        self.assertEqual(memo.get("k", [self.path], self.compute), "seven")
+        self.assertEqual(self.calls, 3)
+
+    def test_missing_file_is_part_of_the_stamp(self):
+        memo = StatMemo()
+        other = os.path.join(self.dir, "b.txt")
+        memo.get("k", [self.path, other], self.compute)
+        memo.get("k", [self.path, other], self.compute)
+        self.assertEqual(self.calls, 1)
+        with open(other, "w", encoding="utf-8") as f:
+            f.write("new")
+        memo.get("k", [self.path, other], self.compute)
+        self.assertEqual(self.calls, 2)
+
+    def test_keys_without_paths_never_go_stale(self):
+        memo = StatMemo()
+        self.assertEqual(memo.get(("digest", "x"), (), lambda: 42), 42)
+        self.assertEqual(memo.get(("digest", "x"), (), lambda: 0), 42)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        memo = StatMemo(max_entries=2)
+        memo.get("a", (), lambda: 1)
+        memo.get("b", (), lambda: 2)
+        memo.get("a", (), lambda: 0)  # touch "a" so "b" is the oldest
+        memo.get("c", (), lambda: 3)
+        self.assertEqual(memo.get("a", (), lambda: 0), 1)
+        self.assertEqual(memo.get("b", (), lambda: 20), 20)
+
+
+if __name__ == "__main__":
+    unittest.main()
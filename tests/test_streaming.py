@@ -0,0 +1,160 @@
+import os
+import sys
+import threading
+import unittest
+
+os.environ.setdefault("PYSTRAY_BACKEND", "dummy")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import MagicInput  # noqa: E402
+
+TkTextStream = MagicInput.TkTextStream
+
+
+class QueuedDispatch:
+    """Stands in for ``call_tk``: records scheduled callbacks and runs them on demand."""
+
+    def __init__(self):
+        self.queue = []
+        self.lock = threading.Lock()
+
+    def __call__(self, func, delay=0):
+        with self.lock:
+            self.queue.append((func, delay))
+
+    def run(self):
+        with self.lock:
+            pending, self.queue = self.queue, []
+        for func, _delay in pending:
+            func()
+        return len(pending)
+
+
+class TkTextStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.dispatch = QueuedDispatch()
+        self.flushed = []
+        self.stream = TkTextStream(self.dispatch, self.flushed.append, interval_ms=50)
+
+    def test_chunks_between_flushes_are_batched(self):
+        for chunk in ("a", "b", "c"):
+            self.stream.feed(chunk)
+        self.assertEqual(len(self.dispatch.queue), 1)
+        self.assertEqual(self.dispatch.queue[0][1], 50)
+        self.dispatch.run()
+        self.assertEqual(self.flushed, ["abc"])
+
+        self.stream.feed("d")
+        self.assertEqual(len(self.dispatch.queue), 1)
+        self.dispatch.run()
+        self.assertEqual(self.flushed, ["abc", "d"])
+        self.assertEqual(self.stream.text, "abcd")
+
+    def test_close_flushes_the_tail(self):
+        self.stream.feed("head")
+        self.dispatch.run()
+        self.stream.feed("tail")
+        self.stream.close()
+        self.dispatch.run()
+        self.assertEqual("".join(self.flushed), "headtail")
+        self.assertNotIn("", self.flushed)
+
+    def test_empty_chunks_are_ignored(self):
+        self.stream.feed("")
+        self.assertEqual(self.dispatch.queue, [])
+        self.assertFalse(self.stream.has_output)
+        self.assertIsNone(self.stream.time_to_first_chunk())
+        self.stream.feed("x")
+        self.assertTrue(self.stream.has_output)
+        self.assertGreaterEqual(self.stream.time_to_first_chunk(), 0.0)
+
+    def test_flush_errors_do_not_stop_the_stream(self):
+        calls = []
+
+        def on_flush(text):
+            calls.append(text)
+            raise RuntimeError("widget destroyed")
+        stream = TkTextStream(self.dispatch, on_flush)
+        stream.feed("a")
+        self.dispatch.run()
+        stream.feed("b")
+        self.dispatch.run()
+        self.assertEqual(calls, ["a", "b"])
+
+    def test_feeding_from_many_threads_keeps_every_chunk(self):
+        def worker(n):
+            for i in range(200):
+                self.stream.feed(f"{n}:{i};")
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.stream.close()
+        while self.dispatch.run():
+            pass
+        flushed = "".join(self.flushed)
+        self.assertEqual(len(flushed), len(self.stream.text))
+        self.assertEqual(sorted(flushed.split(";")), sorted(self.stream.text.split(";")))
+        for n in range(4):
+            self.assertEqual(flushed.count(f"{n}:"), 200)
+
+
+class SpeculativeRunTest(unittest.TestCase):
+    def test_adopting_replays_buffered_text_then_forwards_live(self):
+        run = MagicInput.SpeculativeRun("key")
+        run.feed("Hel")
+        run.feed("lo")
+        received, finished = [], []
+        self.assertTrue(run.adopt(received.append, lambda *args: finished.append(args)))
+        run.feed(" world")
+        run.finish(True)
+        self.assertEqual(received, ["Hello", " world"])
+        self.assertEqual(finished, [(True, False, None)])
+        self.assertEqual(run.text, "Hello world")
+
+    def test_adopting_a_finished_run_is_refused(self):
+        run = MagicInput.SpeculativeRun("key")
+        run.feed("done")
+        err = RuntimeError("boom")
+        run.finish(False, error=err)
+        received = []
+        self.assertFalse(run.adopt(received.append, lambda *args: None))
+        self.assertEqual(received, [])
+        self.assertTrue(run.done)
+        self.assertFalse(run.ok)
+        self.assertIs(run.error, err)
+        self.assertEqual(run.text, "done")
+
+    def test_unadopted_finish_notifies_nobody(self):
+        run = MagicInput.SpeculativeRun("key")
+        run.finish(False, cancelled=True)
+        self.assertTrue(run.done)
+
+    def test_cancellation_is_reported_to_the_adopter(self):
+        run = MagicInput.SpeculativeRun("key")
+        finished = []
+        run.adopt(lambda text: None, lambda *args: finished.append(args))
+        run.finish(False, cancelled=True)
+        self.assertEqual(finished, [(False, True, None)])
+
+    def test_chunks_fed_while_adopting_are_not_lost_or_doubled(self):
+        run = MagicInput.SpeculativeRun("key")
+        received = []
+        stop = threading.Event()
+
+        def producer():
+            i = 0
+            while not stop.is_set() or i < 500:
+                run.feed(f"{i};")
+                i += 1
+        thread = threading.Thread(target=producer)
+        thread.start()
+        run.adopt(received.append, lambda *args: None)
+        stop.set()
+        thread.join()
+        self.assertEqual("".join(received), run.text)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+os.environ.setdefault("PYSTRAY_BACKEND", "dummy")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import MagicInput  # noqa: E402
+
+TerminalRing = MagicInput.TerminalRing
+
+
+def write_lines(path, tag, count):
+    ring = TerminalRing(path, 1 << 16)
+    try:
+        for i in range(count):
+            ring.write(f"{tag}{i:05d}\n".encode())
+    finally:
+        ring.close()
+
+
+class TerminalRingTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        self.path = os.path.join(self.tmp, TerminalRing.FILENAME)
+
+    def test_tail_after_wrapping(self):
+        ring = TerminalRing(self.path, 4096)
+        for i in range(1000):
+            ring.write(f"line {i}\n".encode())
+        ring.close()
+        text, stamp = TerminalRing.read_tail(self.path, 100)
+        lines = text.strip().split("\n")
+        self.assertEqual(lines[-1], "line 999")
+        self.assertTrue(all(l.startswith("line ") for l in lines))
+        self.assertGreater(stamp, 0)
+
+    def test_concurrent_writers_do_not_overwrite_each_other(self):
+        TerminalRing(self.path, 1 << 16).close()
+        writers = [multiprocessing.Process(target=write_lines, args=(self.path, tag, 1000)) for tag in "ABC"]
+        for p in writers:
+            p.start()
+        for p in writers:
+            p.join()
+        text, _ = TerminalRing.read_tail(self.path, 1 << 16)
+        lines = text.strip().split("\n")
+        self.assertEqual(len(lines), 3000)
+        self.assertTrue(all(len(l) == 6 for l in lines))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+import os
+import sys
+import unittest
+
+os.environ.setdefault("PYSTRAY_BACKEND", "dummy")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import MagicInput  # noqa: E402
+
+
+class ApiError(Exception):
+    def __init__(self, code, message):
+        super().__init__(f"{code} {message}")
+        self.code = code
+
+
+class StaleReferenceErrorTests(unittest.TestCase):
+    def stale(self, err):
+        return MagicInput.GeminiUploadManager.is_stale_reference_error(err)
+
+    def test_rejected_file_or_cache_is_stale(self):
+        self.assertTrue(self.stale(ApiError(403, "PERMISSION_DENIED. You do not have permission to access the "
+                                                 "File abc123 or it may not exist.")))
+        self.assertTrue(self.stale(ApiError(404, "NOT_FOUND. files/abc123 not found")))
+        self.assertTrue(self.stale(ApiError(403, "CachedContent not found (or permission denied)")))
+        self.assertTrue(self.stale(RuntimeError("cachedContents/xyz does not exist")))
+
+    def test_other_403_404_propagate(self):
+        self.assertFalse(self.stale(ApiError(404, "NOT_FOUND. models/gemini-9 is not found for API version "
+                                                  "v1beta")))
+        self.assertFalse(self.stale(ApiError(403, "PERMISSION_DENIED. API key not valid for this project")))
+        self.assertFalse(self.stale(ApiError(404, "profile not found")))
+
+    def test_file_mentioned_without_rejection_is_not_stale(self):
+        self.assertFalse(self.stale(ApiError(400, "INVALID_ARGUMENT. file too large")))
+
+
+if __name__ == "__main__":
+    unittest.main()